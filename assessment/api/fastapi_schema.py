@@ -1,4 +1,5 @@
-from typing import Dict
+from datetime import datetime
+from typing import Dict, Optional, Union
 
 from pydantic import BaseModel
 
@@ -9,3 +10,41 @@ class PeopleStatsOut(BaseModel):
     avg_age: float
     city_with_most_people: str
     top_5_interests: list
+
+
+class StatsCacheInfoOut(BaseModel):
+    hits: int
+    misses: int
+    snapshots: int
+    revalidations: int
+    ttl: float
+    generation: Union[int, None]
+
+
+class PoolMetricsOut(BaseModel):
+    size: Optional[int] = None
+    checked_out: Optional[int] = None
+    checked_in: Optional[int] = None
+    overflow: Optional[int] = None
+    checkouts: Optional[int] = None
+    wait_seconds: Optional[float] = None
+    max_wait_seconds: Optional[float] = None
+
+
+class PeopleStatsSnapshotOut(BaseModel):
+    load_id: int
+    created_at: datetime
+    max_age: Union[int, None]
+    min_age: Union[int, None]
+    avg_age: Union[float, None]
+    city_with_most_people: Union[str, None]
+    top_interests: list
+
+
+class GroupedStatsOut(BaseModel):
+    group: Union[int, str, None]
+    person_count: int
+    max_age: Union[int, None]
+    min_age: Union[int, None]
+    avg_age: Union[float, None]
+    top_interests: list
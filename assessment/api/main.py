@@ -1,7 +1,30 @@
-from database.database_handler import PeopleDB
-from fastapi import FastAPI
+import asyncio
+import inspect
+import os
+from typing import Dict, List, Union
 
-from api.fastapi_schema import PeopleStatsOut
+from database.async_database_handler import AsyncPeopleDB
+from database.db_config import (
+    dispose_engines,
+    get_async_engine,
+    get_engine,
+    pool_metrics,
+    session_scope,
+)
+from database.people_queries import PEOPLE_COLUMNS, PeopleQueries
+from database.stats_cache import StatsCache
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from monitoring.metrics import METRICS, PROMETHEUS_CONTENT_TYPE, instrumented
+
+from api.fastapi_schema import (
+    GroupedStatsOut,
+    PeopleStatsOut,
+    PeopleStatsSnapshotOut,
+    PoolMetricsOut,
+    StatsCacheInfoOut,
+)
+from api.streaming import EXPORT_MEDIA_TYPES, aencode_batches, encode_batches
 
 app = FastAPI(
     title="ETLConceptAPI",
@@ -11,29 +34,263 @@ app = FastAPI(
     version="1.0.0",
 )
 
+# set at startup (see startup)
+people_db = None
+stats_cache = None
+
+
+@app.on_event("startup")
+def startup():
+    """Create the process engines (one per worker) and the people stats cache. People stats only change when run.py
+    loads the data again: they are cached for STATS_CACHE_TTL seconds, then revalidated against the last load. They
+    are read from the stats snapshot written by the load unless STATS_SNAPSHOT=0 and, if the load has none, computed
+    unless STATS_LIVE_FALLBACK=0. They are queried with the asyncio driver unless API_ASYNC_DB=0 (blocking driver in a
+    thread)
+    """
+    global people_db, stats_cache
+
+    people_db = (
+        AsyncPeopleDB(get_async_engine())
+        if os.environ.get("API_ASYNC_DB", "1") == "1"
+        else PeopleQueries(get_engine())
+    )
+    stats_cache = StatsCache(
+        people_db,
+        ttl=float(os.environ.get("STATS_CACHE_TTL", 60)),
+        top_x=5,
+        use_snapshot=os.environ.get("STATS_SNAPSHOT", "1") == "1",
+        live_fallback=os.environ.get("STATS_LIVE_FALLBACK", "1") == "1",
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Close the pooled connections of the process engines"""
+    await dispose_engines()
+
+
+class ResponseMetricsMiddleware:
+    """Count the responses of each endpoint by status code (see metrics). Plain ASGI middlewares (instead of
+    app.middleware ones) pass response bodies through as they are sent: a BaseHTTPMiddleware queues them without bound,
+    so a streamed response (e.g. /people) to a slow client would pile up in memory
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # set by the router on the request scope
+            endpoint = scope.get("endpoint")
+            METRICS.record_response(endpoint.__name__ if endpoint else "none", status)
+
+
+class RequestSessionMiddleware:
+    """Scope a database session to each request: PeopleQueries of the request share it (it only connects if used). It's
+    bound to the engine of people_db, so no other engine is created for it, and there's none with the asyncio driver
+    (AsyncPeopleDB has no sessions)"""
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http" or not isinstance(people_db, PeopleQueries):
+            await self.app(scope, receive, send)
+            return
+
+        with session_scope(people_db.engine):
+            await self.app(scope, receive, send)
+
+
+# the last one added runs first
+app.add_middleware(ResponseMetricsMiddleware)
+app.add_middleware(RequestSessionMiddleware)
+
 
 @app.get(
     "/people_stats",
     response_model=PeopleStatsOut,
     tags=["PeopleStats"],
 )
-def people_stats():
-    """Get people stats: max, min, and average age; city with most people; and their top 5 interests
+@instrumented("api.people_stats")
+async def people_stats(request: Request, response: Response):
+    """Get people stats: max, min, and average age; city with most people; and their top 5 interests. Responses carry
+    an ETag of the data load they come from and a Cache-Control max-age of the cache TTL, and a request with a matching
+    If-None-Match gets an empty 304 response
 
     :return: A dictionary with the mentioned stats
     """
-    people_db = PeopleDB()
+    # the stats snapshot of the last load is read (or the stat statements run concurrently) only when the cached stats
+    # are outdated
+    try:
+        stats, generation = await stats_cache.aget()
+    except LookupError as error:
+        raise HTTPException(status_code=503, detail=str(error))
 
-    max_age = people_db.max_age()
-    min_age = people_db.min_age()
-    avg_age = people_db.avg_age()
-    city_with_most_people = people_db.most_frequent_city()
-    top_5_interests = people_db.top_x_interests(x=5)
+    headers = {
+        "ETag": stats_cache.etag(generation),
+        "Cache-Control": f"max-age={int(stats_cache.ttl)}",
+    }
+    if request.headers.get("If-None-Match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
 
     return {
-        "max_age": max_age,
+        "max_age": stats["max_age"],
+        "min_age": stats["min_age"],
+        "avg_age": stats["avg_age"],
+        "city_with_most_people": stats["city_with_most_people"],
+        "top_5_interests": stats["top_interests"],
+    }
+
+
+@app.get(
+    "/people_stats/cache",
+    response_model=StatsCacheInfoOut,
+    tags=["PeopleStats"],
+)
+@instrumented("api.people_stats_cache")
+def people_stats_cache():
+    """Get the people stats cache counters: hits, misses, snapshots (misses read from a stats snapshot) and
+    revalidations (load generation checks)
+
+    :return: A dictionary with the counters, the cache TTL and the load generation of the cached stats
+    """
+    return stats_cache.info()
+
+
+@app.get(
+    "/people_stats/grouped",
+    response_model=List[GroupedStatsOut],
+    tags=["PeopleStats"],
+)
+@instrumented("api.people_stats_grouped")
+async def people_stats_grouped(
+    by: str = Query("city", regex="^(city|title|age_bucket)$"),
+    top_x: int = Query(5, ge=1, le=100),
+    city: Union[str, None] = None,
+    title: Union[str, None] = None,
+    age_bucket: Union[int, None] = Query(None, ge=0),
+):
+    """Get the people stats of each city, title or age bucket (by): people count, max, min, and average age, and
+    their top_x interests, optionally for a city, title and/or age bucket only (e.g. by=age_bucket&city=austin for the
+    age histogram of a city). Age buckets are ten years wide (age_bucket=30 for ages 30 to 39). The stats are added up
+    from the rollup cube kept up to date by the loads, so they take the same time whatever the number of people
+
+    :return: A list of dictionaries with the group and its stats, ordered by group
+    """
+    filters = {
+        # the data is cleaned to lower case and trimmed
+        "city": city.lower().strip() if city is not None else None,
+        "title": title.lower().strip() if title is not None else None,
+        "age_bucket": age_bucket,
+    }
+    if isinstance(people_db, AsyncPeopleDB):
+        return await people_db.grouped_stats(by, top_x, **filters)
+
+    return await asyncio.to_thread(people_db.grouped_stats, by, top_x, **filters)
+
+
+@app.get(
+    "/people_stats/history",
+    response_model=List[PeopleStatsSnapshotOut],
+    tags=["PeopleStats"],
+)
+@instrumented("api.people_stats_history")
+async def people_stats_history(limit: int = Query(10, ge=1, le=1000)):
+    """Get the people stats snapshots of the last loads, from the last one
+
+    :return: A list of dictionaries with the load id, when the snapshot was taken and its stats
+    """
+    if isinstance(people_db, AsyncPeopleDB):
+        return await people_db.stats_history(limit)
+
+    return await asyncio.to_thread(people_db.stats_history, limit)
+
+
+@app.get("/people", response_class=StreamingResponse, tags=["People"])
+@instrumented("api.people")
+async def people(
+    city: Union[str, None] = None,
+    min_age: Union[int, None] = Query(None, ge=0),
+    max_age: Union[int, None] = Query(None, ge=0),
+    title: Union[str, None] = None,
+    interest: Union[str, None] = None,
+    after_id: Union[int, None] = Query(None, ge=0),
+    limit: Union[int, None] = Query(None, ge=1),
+    export_format: str = Query("ndjson", alias="format", regex="^(ndjson|csv)$"),
+):
+    """Get the people matching some filters (city, age range, title and interest, case-insensitive), ordered by id,
+    streamed as NDJSON (one object per line) or csv (format=csv). Rows are read from a server-side cursor and sent in
+    batches as they are read, so server memory stays the same whatever the number of rows (without limit, the whole
+    table is exported). Pages are requested with keyset pagination: limit rows after_id, then the next page after the
+    id of the last row received, which is as fast deep in the table as on the first page
+
+    :return: The streamed rows
+    """
+    filters = {
+        "city": city,
         "min_age": min_age,
-        "avg_age": avg_age,
-        "city_with_most_people": city_with_most_people,
-        "top_5_interests": top_5_interests,
+        "max_age": max_age,
+        "title": title,
+        "interest": interest,
     }
+    # the data is cleaned to lower case and trimmed
+    filters = {
+        key: value.lower().strip() if isinstance(value, str) else value
+        for key, value in filters.items()
+    }
+    batches = people_db.iter_people_batches(after_id=after_id, limit=limit, **filters)
+    encode = aencode_batches if inspect.isasyncgen(batches) else encode_batches
+
+    return StreamingResponse(
+        encode(batches, PEOPLE_COLUMNS, export_format),
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+    )
+
+
+@app.get(
+    "/db_pool",
+    response_model=Dict[str, PoolMetricsOut],
+    tags=["Database"],
+)
+@instrumented("api.db_pool")
+def db_pool():
+    """Get the connection pool metrics of the engine the API queries with ('async' with the asyncio driver, else
+    'sync'): connections checked out and in, overflow, and the time checkouts waited for a free connection. No other
+    engine is created to report on it
+
+    :return: A dictionary with the metrics of the engine (empty before startup)
+    """
+    if people_db is None:
+        return {}
+
+    kind = "async" if isinstance(people_db, AsyncPeopleDB) else "sync"
+
+    return {kind: pool_metrics(people_db.engine)}
+
+
+@app.get("/metrics", tags=["Monitoring"])
+def metrics():
+    """Get the metrics of this process in the Prometheus text format (with several workers, each one is scraped
+    apart): calls, errors, wall time, rows in/out, peak memory and SQL statements of each stage (CSVHandler stages,
+    cleaning_utils functions, PeopleQueries/PeopleDB queries and API handlers), SQL statements per kind and responses
+    per endpoint and status
+
+    :return: The metrics text
+    """
+    return Response(METRICS.render_prometheus(), media_type=PROMETHEUS_CONTENT_TYPE)
@@ -0,0 +1,50 @@
+import csv
+import io
+import json
+from typing import AsyncIterator, Iterable, Iterator
+
+# media types of the row export formats
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def encode_batch(batch: list, columns: list, export_format: str) -> str:
+    """Encode a batch of rows as NDJSON (one object per line) or csv lines
+
+    :param batch: The rows (values in the order of columns)
+    :param columns: The column names
+    :param export_format: 'ndjson' or 'csv'
+    :return: The encoded lines
+    """
+    if export_format == "ndjson":
+        return "".join(json.dumps(dict(zip(columns, row))) + "\n" for row in batch)
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(batch)
+
+    return buffer.getvalue()
+
+
+def encode_batches(
+    batches: Iterable[list], columns: list, export_format: str
+) -> Iterator[str]:
+    """Encode batches of rows one after the other (see encode_batch), with a header line first for csv
+
+    :param batches: The batches of rows (e.g. PeopleQueries.iter_people_batches)
+    :param columns: The column names
+    :param export_format: 'ndjson' or 'csv'
+    :yield: The encoded lines of each batch
+    """
+    if export_format == "csv":
+        yield encode_batch([columns], columns, export_format)
+    for batch in batches:
+        yield encode_batch(batch, columns, export_format)
+
+
+async def aencode_batches(
+    batches: AsyncIterator[list], columns: list, export_format: str
+) -> AsyncIterator[str]:
+    """Same as encode_batches, for asynchronous batches (e.g. AsyncPeopleDB.iter_people_batches)"""
+    if export_format == "csv":
+        yield encode_batch([columns], columns, export_format)
+    async for batch in batches:
+        yield encode_batch(batch, columns, export_format)
@@ -0,0 +1,106 @@
+"""Cold start of an API worker: time from spawning a uvicorn worker to its first response, and its resident memory
+(RSS) then. The API as it is (database.people_queries, no pandas) is compared with a worker that imports the ETL
+modules first (database.database_handler, which imports pandas, numpy and pyarrow), as the API did before the query
+layer was split from them.
+
+Run from assessment/ (RSS is read from /proc, Linux only):
+
+    python -m benchmarks.api_startup --runs 5
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+# worker process: import the preloaded modules (argv[2:]), then serve the API on a port (argv[1])
+WORKER = """
+import importlib
+import sys
+
+import uvicorn
+
+for module in sys.argv[2:]:
+    importlib.import_module(module)
+uvicorn.run("api.main:app", host="127.0.0.1", port=int(sys.argv[1]), log_level="warning")
+"""
+# modules imported by each worker before the API
+VARIANTS = {
+    "api": [],
+    "api + etl modules": ["database.database_handler"],
+}
+
+
+def start_worker(port: int, preload: list, env: dict) -> tuple:
+    """Spawn a worker and wait for its first response (/metrics doesn't query the database)
+
+    :param port: The port of the worker
+    :param preload: Modules imported before the API
+    :param env: The worker environment
+    :return: Tuple of (the worker process, seconds until it responded, its RSS in bytes then)
+    """
+    start = time.perf_counter()
+    worker = subprocess.Popen(
+        [sys.executable, "-c", WORKER, str(port)] + preload, env=env
+    )
+    while True:
+        if worker.poll() is not None:
+            raise RuntimeError(f"The worker exited with code {worker.returncode}")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=1).read()
+            break
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.005)
+
+    return worker, time.perf_counter() - start, rss(worker.pid)
+
+
+def rss(pid: int) -> int:
+    """Resident memory of a process in bytes"""
+    for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1]) * 1024
+
+    raise ValueError(f"No VmRSS for process {pid}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--runs", type=int, default=5, help="workers started per variant"
+    )
+    parser.add_argument("--port", type=int, default=8766)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # the engines are created at startup, but connect only when queried
+        env = {
+            **os.environ,
+            "DATABASE_URL": f"sqlite:///{Path(tmp_dir).joinpath('people.db')}",
+        }
+
+        print(f"{'worker':>18} {'startup ms':>11} {'rss MB':>7}")
+        for name, preload in VARIANTS.items():
+            seconds, memory = [], []
+            for _ in range(args.runs):
+                worker, startup, worker_rss = start_worker(args.port, preload, env)
+                worker.terminate()
+                worker.wait()
+                seconds.append(startup)
+                memory.append(worker_rss)
+
+            # medians: the first start also pays for cold file caches
+            print(
+                f"{name:>18} {statistics.median(seconds) * 1000:>11.0f}"
+                f" {statistics.median(memory) / 2**20:>7.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Compare load time and peak RSS of the raw people dataset stored as json (the former people.json), csv, parquet and
+feather (the CSVHandler columnar cache). Every load runs in a fresh process so peak RSS isn't shared.
+
+Run from assessment/:
+
+    python -m benchmarks.cache_formats --rows 1000000
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from benchmarks.synthetic import people_frame
+from datahandling.csv_file_handler import CSVHandler
+
+FORMATS = ("json", "csv", "parquet", "feather")
+
+
+def write_files(df: pd.DataFrame, data_path: Path) -> None:
+    """Write df in every format, the same way CSVHandler.download_files does"""
+    df.to_json(data_path.joinpath("people.json"))
+    df.to_csv(data_path.joinpath("people.csv"))
+    for cache_format in CSVHandler.CACHE_FORMATS:
+        csv_handler = CSVHandler(None, cache_format=cache_format)
+        csv_handler._write_cache(df, data_path.joinpath(f"people.{cache_format}"))
+
+
+def load(file_format: str, data_path: Path) -> pd.DataFrame:
+    """Load people.<file_format> as CSVHandler.load_dataframe would"""
+    path = data_path.joinpath(f"people.{file_format}")
+    if file_format == "json":
+        return pd.read_json(path)
+    if file_format == "csv":
+        return pd.read_csv(path, index_col=0)
+
+    return CSVHandler(None, cache_format=file_format)._read_cache(path)
+
+
+def child(file_format: str, data_path: Path) -> None:
+    """Load one format and print its seconds and peak RSS (MB) as json (runs in its own process)"""
+    start = time.perf_counter()
+    df = load(file_format, data_path)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in KB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    print(json.dumps({"seconds": seconds, "peak_rss_mb": peak_rss, "rows": len(df)}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--child", nargs=2, metavar=("FORMAT", "DATA_PATH"))
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], Path(args.child[1]))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_path = Path(tmp_dir)
+        write_files(people_frame(args.rows), data_path)
+
+        print(f"{'format':>8} {'MB on disk':>11} {'seconds':>9} {'peak RSS MB':>12}")
+        for file_format in FORMATS:
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.cache_formats"]
+                + ["--child", file_format, tmp_dir],
+                capture_output=True,
+                check=True,
+                text=True,
+            ).stdout
+            result = json.loads(output.splitlines()[-1])
+            size = data_path.joinpath(f"people.{file_format}").stat().st_size
+            print(
+                f"{file_format:>8} {size / 1024**2:>11.1f} {result['seconds']:>9.3f}"
+                f" {result['peak_rss_mb']:>12.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Planned CleaningPipeline (fused string steps, columns dropped before they are cleaned) against the same steps called
+one after the other, plus the pipeline report of every step (with memory tracking).
+
+Run from assessment/:
+
+    python -m benchmarks.cleaning_pipeline --rows 1000000
+"""
+
+import argparse
+import time
+
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import datahandling.cleaning_utils as clut
+from benchmarks.synthetic import raw_people_frame
+from datahandling.csv_file_handler import CSVHandler
+from datahandling.pipeline import CleaningPipeline
+
+
+def clean_step_by_step(df: pd.DataFrame) -> pd.DataFrame:
+    """The cleaning steps of CSVHandler.PIPELINE_STEPS as separate cleaning_utils calls, without any planning"""
+    df = clut.update_column_types(df, {"Age": int})
+    df = clut.rename_columns(
+        df, {"PhoneNumber": "phone_number"}, rules_to_apply=[lambda x: x.lower()]
+    )
+    df = clut.data_to_lower_case(df)
+    df = clut.trim_data(df)
+    df = clut.split_titles_from_name(df)
+    df = clut.drop_null_columns(
+        df, null_percentage_threshold=CSVHandler.NULL_COLUMNS_THRESHOLD, info_only=False
+    )
+    interest_columns = [col for col in CSVHandler.INTEREST_COLUMNS if col in df.columns]
+
+    return clut.drop_null_rows(
+        df,
+        null_count=len(interest_columns),
+        info_only=False,
+        cols_of_interest=interest_columns,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    raw_df = raw_people_frame(args.rows)
+
+    start = time.perf_counter()
+    expected = clean_step_by_step(raw_df.copy())
+    step_by_step_seconds = time.perf_counter() - start
+
+    pipeline = CleaningPipeline(CSVHandler.PIPELINE_STEPS)
+    start = time.perf_counter()
+    df = pipeline.run(raw_df.copy())
+    pipeline_seconds = time.perf_counter() - start
+    assert_frame_equal(df, expected)
+
+    # measured again with the memory of every step, which takes time of its own
+    pipeline = CleaningPipeline(CSVHandler.PIPELINE_STEPS, track_memory=True)
+    pipeline.run(raw_df.copy())
+
+    print(f"step by step: {step_by_step_seconds:.3f}s")
+    print(f"pipeline:     {pipeline_seconds:.3f}s")
+    print(f"{'step':>24} {'seconds':>9} {'rows':>9} {'memory MB':>10}")
+    for record in pipeline.report:
+        print(
+            f"{record['step']:>24} {record['seconds']:>9.3f} {record['rows']:>9}"
+            f" {record['memory_mb']:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Scaling of CSVHandler.clean_data from 1 to N worker processes (the result is checked to be the same as serial).
+
+Run from assessment/:
+
+    python -m benchmarks.parallel_cleaning --rows 1000000 --workers 1 2 4 8 16 32
+"""
+
+import argparse
+import contextlib
+import io
+import time
+
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from benchmarks.synthetic import raw_people_frame
+from datahandling.csv_file_handler import CSVHandler
+
+
+def clean(raw_df: pd.DataFrame, workers: int) -> tuple:
+    """Clean a copy of raw_df with some workers (clean_data prints are discarded)
+
+    :return: Tuple of (cleaned dataframe, seconds)
+    """
+    csv_handler = CSVHandler(None)
+    csv_handler.df = raw_df.copy()
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        df = csv_handler.clean_data(workers=workers)
+
+    return df, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    raw_df = raw_people_frame(args.rows)
+    serial_df, serial_seconds = clean(raw_df, 1)
+    serial_hash = pd.util.hash_pandas_object(serial_df)
+
+    print(f"{'workers':>8} {'seconds':>9} {'speedup':>8}")
+    for workers in args.workers:
+        if workers == 1:
+            df, seconds = serial_df, serial_seconds
+        else:
+            df, seconds = clean(raw_df, workers)
+            assert_frame_equal(df, serial_df)
+            assert pd.util.hash_pandas_object(df).equals(serial_hash)
+        print(f"{workers:>8} {seconds:>9.3f} {serial_seconds / seconds:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
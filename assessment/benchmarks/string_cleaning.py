@@ -0,0 +1,52 @@
+"""Compare the former applymap string cleaning (lower case then trim, cell by cell) against the fused vectorized
+cleaning_utils.normalize_strings.
+
+Run from assessment/:
+
+    python -m benchmarks.string_cleaning --rows 1000000
+"""
+
+import argparse
+import time
+
+from pandas.testing import assert_frame_equal
+
+from benchmarks.synthetic import people_frame
+from datahandling.cleaning_utils import normalize_strings
+
+
+def applymap_clean(df):
+    """The former data_to_lower_case + trim_data"""
+    df = df.applymap(lambda x: x.lower() if isinstance(x, str) else x)
+    return df.applymap(lambda x: x.strip() if isinstance(x, str) else x)
+
+
+def timed(func, *args, **kwargs) -> tuple:
+    """Run func once and return (result, seconds)"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    # add case and whitespace noise to the synthetic data
+    df = people_frame(args.rows)
+    for col in ("name", "city", "interest1"):
+        df[col] = "  " + df[col].str.upper() + " "
+
+    expected, applymap_seconds = timed(applymap_clean, df)
+    result, vectorized_seconds = timed(normalize_strings, df)
+    _, arrow_seconds = timed(normalize_strings, df, string_dtype="string[pyarrow]")
+    assert_frame_equal(result, expected)
+
+    print(f"{'applymap':>20} {applymap_seconds:>8.3f}s")
+    print(f"{'normalize_strings':>20} {vectorized_seconds:>8.3f}s")
+    print(f"{'+ string[pyarrow]':>20} {arrow_seconds:>8.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import argparse
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import csv
+
+CITIES = [
+    "austin",
+    "dallas",
+    "houston",
+    "san antonio",
+    "el paso",
+    "fort worth",
+    "plano",
+    "lubbock",
+]
+INTERESTS = [
+    "swimming",
+    "chess",
+    "music",
+    "reading",
+    "hiking",
+    "cooking",
+    "gaming",
+    "painting",
+    "running",
+    "travel",
+    "yoga",
+    "photography",
+]
+TITLES = ["dr", "mr", "mrs", "ms", "prof"]
+FIRST_NAMES = [
+    "john",
+    "mary",
+    "james",
+    "patricia",
+    "robert",
+    "jennifer",
+    "michael",
+    "linda",
+    "david",
+    "susan",
+]
+LAST_NAMES = [
+    "smith",
+    "johnson",
+    "williams",
+    "brown",
+    "jones",
+    "garcia",
+    "miller",
+    "davis",
+    "lopez",
+    "wilson",
+]
+# columns of people.csv
+RAW_COLUMNS = [
+    "Name",
+    "Age",
+    "City",
+    "Interest1",
+    "Interest2",
+    "Interest3",
+    "Interest4",
+    "PhoneNumber",
+]
+# noise of raw_people_frame text values: case and whitespace around them (blank is the most likely)
+NOISE_CASES = [str.lower, str.upper, str.title, str.capitalize]
+NOISE_PADDING = ["", "", "", " ", "  ", "\t"]
+# phone number formats of raw_people_frame (each d is a digit)
+PHONE_FORMATS = [
+    "ddd-ddd-dddd",
+    "(ddd) ddd dddd",
+    "ddd.ddd.dddd",
+    "+1 ddd.ddd.dddd",
+    "1-ddd-ddd-dddd",
+    "dddddddddd",
+]
+
+
+def people_frame(rows: int, seed: int = 0, start_id: int = 0) -> pd.DataFrame:
+    """Generate a cleaned-like people dataframe (same columns as the 'person' table) with random values
+
+    :param rows: How many rows to generate
+    :param seed: Seed of the random generator, defaults to 0
+    :param start_id: First index value, so chunks can be generated one after the other, defaults to 0
+    :return: The generated dataframe indexed by id
+    """
+    rng = np.random.default_rng(seed)
+
+    def interest_column(null_ratio: float) -> np.ndarray:
+        values = rng.choice(INTERESTS, size=rows).astype(object)
+        values[rng.random(rows) < null_ratio] = None
+        return values
+
+    return pd.DataFrame(
+        {
+            "title": rng.choice(TITLES + ["unknown"] * 5, size=rows),
+            "name": np.char.add(
+                "person ", np.arange(start_id, start_id + rows).astype(str)
+            ),
+            "age": rng.integers(18, 90, size=rows),
+            "city": rng.choice(CITIES, size=rows),
+            "interest1": interest_column(0.1),
+            "interest2": interest_column(0.3),
+            "interest3": interest_column(0.5),
+            "interest4": interest_column(0.7),
+            "phone_number": rng.integers(2000000000, 9999999999, size=rows).astype(str),
+        },
+        index=pd.RangeIndex(start_id, start_id + rows, name="id"),
+    )
+
+
+def people_chunks(rows: int, chunk_size: int = 1_000_000, seed: int = 0):
+    """Generate people_frame chunks until 'rows' rows are produced (so big datasets never live in memory at once)
+
+    :param rows: Total number of rows to generate
+    :param chunk_size: Rows per chunk, defaults to 1_000_000
+    :param seed: Seed of the first chunk (incremented per chunk), defaults to 0
+    :yield: Dataframes of at most chunk_size rows
+    """
+    for chunk_number, start in enumerate(range(0, rows, chunk_size)):
+        yield people_frame(min(chunk_size, rows - start), seed + chunk_number, start)
+
+
+def raw_people_frame(rows: int, seed: int = 0, start_id: int = 0) -> pd.DataFrame:
+    """Generate a raw-like people dataframe with the same columns and kinds of dirt of people.csv: titles in some names
+    (e.g. 'Dr. '), random case and extra whitespace in every text column, null cities and interests (Interest1 almost
+    always null, some people with no interest at all) and phone numbers in mixed formats. To be cleaned by
+    CSVHandler.clean_data
+
+    :param rows: How many rows to generate
+    :param seed: Seed of the random generator, defaults to 0
+    :param start_id: Position of the rows in the whole dataset, so chunks can be generated one after the other with
+    different values, defaults to 0
+    :return: The generated dataframe (default index, as read from the csv)
+    """
+    rng = np.random.default_rng((seed, start_id))
+
+    def codes(size: int, null_ratio: float = 0.0) -> np.ndarray:
+        values = rng.integers(0, size, size=rows)
+        values[rng.random(rows) < null_ratio] = -1
+        return values
+
+    # names with one of the titles or without title (index len(TITLES), half of the people)
+    names = [
+        f"{title}. {first} {last}" if title else f"{first} {last}"
+        for title in TITLES + [None]
+        for first in FIRST_NAMES
+        for last in LAST_NAMES
+    ]
+    titles = np.minimum(codes(2 * len(TITLES)), len(TITLES))
+    name_codes = titles * len(FIRST_NAMES) * len(LAST_NAMES) + codes(
+        len(FIRST_NAMES) * len(LAST_NAMES)
+    )
+
+    return pd.DataFrame(
+        {
+            "Name": _messy(names, name_codes, rng),
+            "Age": rng.integers(18, 90, size=rows),
+            "City": _messy(CITIES, codes(len(CITIES), 0.02), rng),
+            "Interest1": _messy(INTERESTS, codes(len(INTERESTS), 0.95), rng),
+            "Interest2": _messy(INTERESTS, codes(len(INTERESTS), 0.3), rng),
+            "Interest3": _messy(INTERESTS, codes(len(INTERESTS), 0.5), rng),
+            "Interest4": _messy(INTERESTS, codes(len(INTERESTS), 0.7), rng),
+            "PhoneNumber": _phone_numbers(rows, rng),
+        }
+    )
+
+
+def raw_people_chunks(rows: int, chunk_size: int = 1_000_000, seed: int = 0):
+    """Generate raw_people_frame chunks until 'rows' rows are produced (see people_chunks)
+
+    :param rows: Total number of rows to generate
+    :param chunk_size: Rows per chunk, defaults to 1_000_000
+    :param seed: Seed of the first chunk (incremented per chunk), defaults to 0
+    :yield: Dataframes of at most chunk_size rows
+    """
+    for chunk_number, start in enumerate(range(0, rows, chunk_size)):
+        yield raw_people_frame(
+            min(chunk_size, rows - start), seed + chunk_number, start
+        )
+
+
+def write_raw_people_csv(
+    path: Union[str, Path], rows: int, chunk_size: int = 1_000_000, seed: int = 0
+) -> Path:
+    """Write a raw people csv (as served at the people.csv url, with quoted text values) chunk by chunk, so any size
+    (e.g. 100M rows) can be generated with the memory of one chunk. Written with the Arrow csv writer, several times
+    faster than DataFrame.to_csv
+
+    :param path: The csv path
+    :param rows: How many rows to write
+    :param chunk_size: Rows generated at a time, defaults to 1_000_000
+    :param seed: Seed of the random generator, defaults to 0
+    :return: The csv path
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # explicit, so a chunk with a column of nulls only has the same schema
+    schema = pa.schema(
+        [
+            (column, pa.int64() if column == "Age" else pa.string())
+            for column in RAW_COLUMNS
+        ]
+    )
+    with csv.CSVWriter(str(path), schema) as writer:
+        for chunk in raw_people_chunks(rows, chunk_size, seed):
+            writer.write_table(
+                pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+            )
+
+    return path
+
+
+def _messy(vocabulary: list, codes: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    """Values of a vocabulary (code -1 is null) in random case with random leading/trailing whitespace. Every variant
+    of every value is built once, so rows are only picked from them (no string operation per row)
+
+    :param vocabulary: The values (lower case)
+    :param codes: Position of the value of each row in vocabulary, -1 for null
+    :param rng: The random generator
+    :return: Object array of the values
+    """
+    variants = [
+        before + case(value) + after
+        for value in vocabulary
+        for case in NOISE_CASES
+        for before in NOISE_PADDING
+        for after in NOISE_PADDING
+    ]
+    variants = np.array(variants + [None], dtype=object)
+
+    per_value = len(NOISE_CASES) * len(NOISE_PADDING) ** 2
+    index = codes * per_value + rng.integers(0, per_value, size=len(codes))
+    index[codes < 0] = len(variants) - 1
+
+    return variants[index]
+
+
+def _phone_numbers(rows: int, rng: np.random.Generator) -> np.ndarray:
+    """Random 10-digit phone numbers in mixed formats (e.g. '111-222-3333', '(111) 222 3333', '+1 111.222.3333'). The
+    digits are written straight into the bytes of each format (no string operation per row)
+
+    :param rows: How many numbers to generate
+    :param rng: The random generator
+    :return: Object array of the numbers
+    """
+    digits = rng.integers(0, 10, size=(rows, 10), dtype=np.uint8) + ord("0")
+    # no area code starts with 0 or 1
+    digits[:, 0] = rng.integers(2, 10, size=rows, dtype=np.uint8) + ord("0")
+    choice = rng.integers(0, len(PHONE_FORMATS), size=rows)
+
+    numbers = np.empty(rows, dtype=object)
+    for number, phone_format in enumerate(PHONE_FORMATS):
+        mask = choice == number
+        template = np.frombuffer(phone_format.encode(), dtype=np.uint8)
+        buffer = np.tile(template, (int(mask.sum()), 1))
+        buffer[:, template == ord("d")] = digits[mask]
+        numbers[mask] = buffer.view(f"S{len(template)}").ravel().astype(str)
+
+    return numbers
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write a raw people csv (see raw_people_frame)"
+    )
+    parser.add_argument("path")
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--chunk-size", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    write_raw_people_csv(args.path, args.rows, args.chunk_size, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,688 @@
+from collections import Counter
+from typing import Union
+
+import pandas as pd
+from sqlalchemy import Column, Table
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import (
+    and_,
+    bindparam,
+    delete,
+    func,
+    insert,
+    or_,
+    select,
+    update,
+)
+
+from database.data_schema import (
+    CityCount,
+    InterestCount,
+    InterestRollup,
+    PeopleAggregate,
+    PeopleRollup,
+    Person,
+    PersonInterest,
+)
+from database.people_queries import AGGREGATE_ID, ROLLUP_DIMENSIONS
+
+# years of age per age bucket (0-9, 10-19...)
+AGE_BUCKET_WIDTH = 10
+# aggregates of a people_rollup cell
+ROLLUP_VALUES = ["person_count", "age_count", "age_sum", "min_age", "max_age"]
+# rollup cells looked up at a time in the cell index of the rollup tables by loads
+CELL_LOOKUP_SIZE = 200
+# dtypes of the rollup columns on both sides of the merges of _apply_rollup: columns that are all null (e.g. loads
+# without titles or ages) are grouped as floats by pandas and read from the database as None objects
+ROLLUP_DTYPES = {
+    "city": object,
+    "title": object,
+    "age_bucket": "float64",
+    "interest": object,
+    "min_age": "float64",
+    "max_age": "float64",
+}
+
+
+class AggregateDelta:
+    """Changes of the people aggregates during a load: loads add the people they insert and remove the ones they delete
+    (read before deleting them), then apply_delta updates the stored aggregates in the same transaction. The cost is
+    proportional to the rows changed, not to the rows stored. The rollup cells changed are counted with a groupby of
+    the rows, so it's a single vectorized pass per chunk"""
+
+    def __init__(self, reset: bool = False) -> None:
+        """
+        :param reset: If the stored aggregates are dropped first (every row is deleted, e.g. 'replace' load), defaults
+        to False
+        """
+        self.reset = reset
+        self.person_count = 0
+        self.age_count = 0
+        self.age_sum = 0
+        # min/max of the ages added and of the ages removed (None if there are none)
+        self.added_ages = (None, None)
+        self.removed_ages = (None, None)
+        self.city_counts = Counter()
+        self.interest_counts = Counter()
+        # people_rollup and interest_rollup changes of each chunk (see rollup_cells), summed by apply_delta
+        self.cells = []
+        self.interest_cells = []
+
+    def add(self, people: pd.DataFrame, interests: pd.DataFrame) -> None:
+        """Count people inserted
+
+        :param people: The people dataframe indexed by person id (with 'age', 'city' and 'title' columns)
+        :param interests: Their non-null interests (interests_frame(people))
+        """
+        self._update(
+            1, people.get("age"), people.get("city"), interests["interest"], len(people)
+        )
+        self._update_cells(1, people, interests)
+
+    def remove(self, people: pd.DataFrame, interests: pd.DataFrame) -> None:
+        """Count people deleted
+
+        :param people: Their 'age', 'city' and 'title' indexed by person id
+        :param interests: Their non-null interests, with 'person_id' and 'interest' columns
+        """
+        self._update(
+            -1, people["age"], people["city"], interests["interest"], len(people)
+        )
+        self._update_cells(-1, people, interests)
+
+    def _update_cells(
+        self, sign: int, people: pd.DataFrame, interests: pd.DataFrame
+    ) -> None:
+        if people.empty:
+            return
+
+        keys = rollup_keys(people)
+        self.cells.append(rollup_cells(keys, people.get("age"), sign))
+        self.interest_cells.append(
+            interests.join(keys, on="person_id")
+            .groupby(
+                ROLLUP_DIMENSIONS + ["interest"],
+                dropna=False,
+                sort=False,
+                observed=True,
+            )
+            .size()
+            .mul(sign)
+            .rename("quantity")
+            .reset_index()
+            # an all-null interest column is read as float (e.g. people without interests)
+            .astype({"interest": object})
+        )
+
+    def _update(self, sign: int, ages, cities, interests, rows: int) -> None:
+        self.person_count += sign * rows
+
+        if ages is not None:
+            ages = ages.dropna().astype("int64")
+            self.age_count += sign * len(ages)
+            self.age_sum += sign * int(ages.sum())
+            if len(ages):
+                current = self.added_ages if sign > 0 else self.removed_ages
+                bounds = (
+                    _min(current[0], int(ages.min())),
+                    _max(current[1], int(ages.max())),
+                )
+                if sign > 0:
+                    self.added_ages = bounds
+                else:
+                    self.removed_ages = bounds
+
+        for counter, values in (
+            (self.city_counts, cities),
+            (self.interest_counts, interests),
+        ):
+            if values is None:
+                continue
+            # categories count every value, even the ones not present
+            counts = values.value_counts()
+            for value, count in counts[counts > 0].items():
+                counter[value] += sign * int(count)
+
+
+def apply_delta(connection: Connection, delta: AggregateDelta) -> None:
+    """Update the stored aggregates with the changes of a load. If there are no stored aggregates yet (and the delta
+    doesn't reset them), they are rebuilt from the person table instead.
+
+    The aggregates are read and written back whole (and the rollup tables have no unique key on their cells), so
+    concurrent loads are serialized here: the people_aggregate row is read first with SELECT ... FOR UPDATE, which
+    locks it until the load commits, and the counters and rollup cells are read FOR UPDATE as well, so they are the
+    last ones committed even under snapshot isolation (e.g. MySQL's REPEATABLE READ). SQLite ignores FOR UPDATE, but
+    it only runs one write transaction at a time anyway
+
+    :param connection: The connection of the load transaction, after its inserts and deletes
+    :param delta: The changes of the load
+    """
+    stored = connection.execute(
+        select(PeopleAggregate)
+        .where(PeopleAggregate.id == AGGREGATE_ID)
+        .with_for_update()
+    ).one_or_none()
+    if stored is None and not delta.reset:
+        rebuild_aggregates(connection)
+        return
+
+    if delta.reset or stored is None:
+        connection.execute(delete(CityCount))
+        connection.execute(delete(InterestCount))
+        connection.execute(delete(PeopleAggregate))
+        connection.execute(delete(PeopleRollup))
+        connection.execute(delete(InterestRollup))
+        person_count, age_count, age_sum = 0, 0, 0
+        min_age, max_age = None, None
+    else:
+        person_count, age_count, age_sum = (
+            stored.person_count,
+            stored.age_count,
+            stored.age_sum,
+        )
+        min_age, max_age = stored.min_age, stored.max_age
+
+    removed_min, removed_max = delta.removed_ages
+    if removed_min is not None and (
+        (min_age is not None and removed_min <= min_age)
+        or (max_age is not None and removed_max >= max_age)
+    ):
+        # a removed age was the min or the max: the next ones are only known from the rows left (age index lookups)
+        min_age, max_age = connection.execute(
+            select(func.min(Person.age), func.max(Person.age))
+        ).one()
+    else:
+        min_age = _min(min_age, delta.added_ages[0])
+        max_age = _max(max_age, delta.added_ages[1])
+
+    values = {
+        "person_count": person_count + delta.person_count,
+        "age_count": age_count + delta.age_count,
+        "age_sum": age_sum + delta.age_sum,
+        "min_age": min_age,
+        "max_age": max_age,
+    }
+    if delta.reset or stored is None:
+        connection.execute(insert(PeopleAggregate).values(id=AGGREGATE_ID, **values))
+    else:
+        connection.execute(
+            update(PeopleAggregate)
+            .where(PeopleAggregate.id == AGGREGATE_ID)
+            .values(**values)
+        )
+
+    _apply_counts(connection, CityCount.city, CityCount.person_count, delta.city_counts)
+    _apply_counts(
+        connection,
+        InterestCount.interest,
+        InterestCount.quantity,
+        delta.interest_counts,
+    )
+    _apply_rollup(connection, delta)
+
+
+def rollup_keys(people: pd.DataFrame) -> pd.DataFrame:
+    """Cells of the people_rollup cube the people belong to
+
+    :param people: The people dataframe (missing 'city', 'title' or 'age' columns are null)
+    :return: Dataframe of ROLLUP_DIMENSIONS indexed as people (age_bucket as float, NaN if there's no age)
+    """
+    keys = people.reindex(columns=["city", "title", "age"])
+    # categories (e.g. CSVHandler.compact_data) group as their values
+    keys = keys.astype({"city": object, "title": object})
+    ages = keys.pop("age").astype("float64")
+    keys["age_bucket"] = ages // AGE_BUCKET_WIDTH * AGE_BUCKET_WIDTH
+
+    return keys
+
+
+def rollup_cells(keys: pd.DataFrame, ages: Union[pd.Series, None], sign: int):
+    """Aggregate people by people_rollup cell
+
+    :param keys: Their rollup_keys
+    :param ages: Their ages (None if there are none)
+    :param sign: 1 for people added, -1 for people removed
+    :return: Dataframe of ROLLUP_DIMENSIONS, the 'person_count', 'age_count' and 'age_sum' changes and the
+    'added_min'/'added_max' (or 'removed_min'/'removed_max') ages of each cell
+    """
+    ages = (
+        ages.astype("float64")
+        if ages is not None
+        else pd.Series(float("nan"), index=keys.index)
+    )
+    bounds = ("added_min", "added_max") if sign > 0 else ("removed_min", "removed_max")
+    cells = (
+        keys.assign(person_count=sign, age_count=ages.notna() * sign, age=ages)
+        .assign(age_sum=ages.fillna(0) * sign)
+        .groupby(ROLLUP_DIMENSIONS, dropna=False, sort=False, observed=True)
+        .agg(
+            person_count=("person_count", "sum"),
+            age_count=("age_count", "sum"),
+            age_sum=("age_sum", "sum"),
+            **{bounds[0]: ("age", "min"), bounds[1]: ("age", "max")},
+        )
+    )
+
+    return cells.reset_index().reindex(
+        columns=ROLLUP_DIMENSIONS
+        + ["person_count", "age_count", "age_sum"]
+        + ["added_min", "added_max", "removed_min", "removed_max"]
+    )
+
+
+def age_bucket_expression():
+    """SQL expression of the age bucket of a person (as in rollup_keys)"""
+    return Person.age - Person.age % AGE_BUCKET_WIDTH
+
+
+def recompute_aggregates(connection: Connection) -> dict:
+    """Compute the aggregates from every stored row (what the incremental aggregates must be equal to)
+
+    :param connection: The connection
+    :return: Dictionary with 'person_count', 'age_count', 'age_sum', 'min_age', 'max_age', 'city_counts' and
+    'interest_counts' ({value: count}) keys, and 'rollup' ({(city, title, age_bucket): ROLLUP_VALUES tuple}) and
+    'interest_rollup' ({(city, title, age_bucket, interest): count}) keys
+    """
+    person_count, age_count, age_sum, min_age, max_age = connection.execute(
+        select(
+            func.count(),
+            func.count(Person.age),
+            func.coalesce(func.sum(Person.age), 0),
+            func.min(Person.age),
+            func.max(Person.age),
+        )
+    ).one()
+    city_counts = connection.execute(
+        select(Person.city, func.count())
+        .where(Person.city.isnot(None))
+        .group_by(Person.city)
+    ).all()
+    interest_counts = connection.execute(
+        select(PersonInterest.interest, func.count()).group_by(PersonInterest.interest)
+    ).all()
+    # one grouped pass per rollup table
+    age_bucket = age_bucket_expression()
+    rollup = connection.execute(
+        select(
+            Person.city,
+            Person.title,
+            age_bucket,
+            func.count(),
+            func.count(Person.age),
+            func.coalesce(func.sum(Person.age), 0),
+            func.min(Person.age),
+            func.max(Person.age),
+        ).group_by(Person.city, Person.title, age_bucket)
+    ).all()
+    interest_rollup = connection.execute(
+        select(
+            Person.city,
+            Person.title,
+            age_bucket,
+            PersonInterest.interest,
+            func.count(),
+        )
+        .join_from(PersonInterest, Person, PersonInterest.person_id == Person.id)
+        .group_by(Person.city, Person.title, age_bucket, PersonInterest.interest)
+    ).all()
+
+    return {
+        "person_count": person_count,
+        "age_count": age_count,
+        "age_sum": int(age_sum),
+        "min_age": min_age,
+        "max_age": max_age,
+        "city_counts": dict(city_counts),
+        "interest_counts": dict(interest_counts),
+        "rollup": {
+            (city, title, bucket): (count, age_count, int(age_sum), min_age, max_age)
+            for city, title, bucket, count, age_count, age_sum, min_age, max_age in rollup
+        },
+        "interest_rollup": {
+            (city, title, bucket, interest): count
+            for city, title, bucket, interest, count in interest_rollup
+        },
+    }
+
+
+def stored_aggregates(connection: Connection) -> Union[dict, None]:
+    """Read the incremental aggregates
+
+    :param connection: The connection
+    :return: Dictionary as returned by recompute_aggregates, None if there are no aggregates stored
+    """
+    stored = connection.execute(
+        select(PeopleAggregate).where(PeopleAggregate.id == AGGREGATE_ID)
+    ).one_or_none()
+    if stored is None:
+        return None
+
+    return {
+        "person_count": stored.person_count,
+        "age_count": stored.age_count,
+        "age_sum": int(stored.age_sum),
+        "min_age": stored.min_age,
+        "max_age": stored.max_age,
+        "city_counts": dict(
+            connection.execute(select(CityCount.city, CityCount.person_count)).all()
+        ),
+        "interest_counts": dict(
+            connection.execute(
+                select(InterestCount.interest, InterestCount.quantity)
+            ).all()
+        ),
+        "rollup": {
+            (cell.city, cell.title, cell.age_bucket): (
+                cell.person_count,
+                cell.age_count,
+                int(cell.age_sum),
+                cell.min_age,
+                cell.max_age,
+            )
+            for cell in connection.execute(select(PeopleRollup))
+        },
+        "interest_rollup": {
+            (cell.city, cell.title, cell.age_bucket, cell.interest): cell.quantity
+            for cell in connection.execute(select(InterestRollup))
+        },
+    }
+
+
+def rebuild_aggregates(connection: Connection) -> None:
+    """Replace the stored aggregates by a full recompute (e.g. for data loaded before aggregates existed)
+
+    :param connection: The connection of a transaction
+    """
+    aggregates = recompute_aggregates(connection)
+    connection.execute(delete(CityCount))
+    connection.execute(delete(InterestCount))
+    connection.execute(delete(PeopleAggregate))
+    connection.execute(delete(PeopleRollup))
+    connection.execute(delete(InterestRollup))
+
+    connection.execute(
+        insert(PeopleAggregate).values(
+            id=AGGREGATE_ID,
+            **{
+                key: value
+                for key, value in aggregates.items()
+                if key
+                not in ("city_counts", "interest_counts", "rollup", "interest_rollup")
+            },
+        )
+    )
+    if aggregates["city_counts"]:
+        connection.execute(
+            insert(CityCount),
+            [
+                {"city": city, "person_count": count}
+                for city, count in aggregates["city_counts"].items()
+            ],
+        )
+    if aggregates["interest_counts"]:
+        connection.execute(
+            insert(InterestCount),
+            [
+                {"interest": interest, "quantity": count}
+                for interest, count in aggregates["interest_counts"].items()
+            ],
+        )
+    if aggregates["rollup"]:
+        connection.execute(
+            insert(PeopleRollup),
+            [
+                dict(zip(ROLLUP_DIMENSIONS + ROLLUP_VALUES, key + values))
+                for key, values in aggregates["rollup"].items()
+            ],
+        )
+    if aggregates["interest_rollup"]:
+        connection.execute(
+            insert(InterestRollup),
+            [
+                dict(zip(ROLLUP_DIMENSIONS + ["interest", "quantity"], key + (count,)))
+                for key, count in aggregates["interest_rollup"].items()
+            ],
+        )
+
+
+def _apply_rollup(connection: Connection, delta: AggregateDelta) -> None:
+    """Add the rollup cells changed by a load to the stored ones (after the stored aggregates were reset if the delta
+    resets them). Only the stored cells changed are read (cell index lookups), so the cost is proportional to the
+    cells changed, not to the size of the cube, and merged with the changes in pandas. Runs under the
+    people_aggregate row lock of apply_delta
+
+    :param connection: The connection of the load transaction, after its inserts and deletes
+    :param delta: The changes of the load
+    """
+    if delta.cells:
+        changes = (
+            pd.concat(delta.cells)
+            .groupby(ROLLUP_DIMENSIONS, dropna=False, sort=False, observed=True)
+            .agg(
+                {
+                    "person_count": "sum",
+                    "age_count": "sum",
+                    "age_sum": "sum",
+                    "added_min": "min",
+                    "added_max": "max",
+                    "removed_min": "min",
+                    "removed_max": "max",
+                }
+            )
+            .reset_index()
+        )
+        changes = _with_dtypes(changes)
+        cells = changes.merge(
+            _read_cells(connection, PeopleRollup, changes),
+            on=ROLLUP_DIMENSIONS,
+            how="left",
+            suffixes=("", "_stored"),
+        )
+        for col in ("person_count", "age_count", "age_sum"):
+            cells[col] += cells[f"{col}_stored"].fillna(0)
+
+        # a removed age was the min or the max of its cell: the next ones are only known from the rows left
+        recount = cells["removed_min"].notna() & (
+            (cells["removed_min"] <= cells["min_age"])
+            | (cells["removed_max"] >= cells["max_age"])
+        )
+        cells["min_age"] = cells[["min_age", "added_min"]].min(axis=1)
+        cells["max_age"] = cells[["max_age", "added_max"]].max(axis=1)
+        if recount.any():
+            bounds = cells.loc[recount, ROLLUP_DIMENSIONS].merge(
+                _age_bounds(connection, cells.loc[recount, "city"]),
+                on=ROLLUP_DIMENSIONS,
+                how="left",
+            )
+            cells.loc[recount, ["min_age", "max_age"]] = bounds[
+                ["min_age", "max_age"]
+            ].values
+
+        _write_cells(connection, PeopleRollup.__table__, cells, "person_count")
+
+    if delta.interest_cells:
+        keys = ROLLUP_DIMENSIONS + ["interest"]
+        changes = (
+            pd.concat(delta.interest_cells)
+            .groupby(keys, dropna=False, sort=False, observed=True)["quantity"]
+            .sum()
+            .reset_index()
+            .pipe(_with_dtypes)
+        )
+        cells = changes.merge(
+            _read_cells(connection, InterestRollup, changes),
+            on=keys,
+            how="left",
+            suffixes=("", "_stored"),
+        )
+        cells["quantity"] += cells["quantity_stored"].fillna(0)
+        _write_cells(connection, InterestRollup.__table__, cells, "quantity")
+
+
+def _read_cells(connection: Connection, table, changes: pd.DataFrame) -> pd.DataFrame:
+    """Read (and lock) the stored cells of a rollup table that have changes, CELL_LOOKUP_SIZE cells per statement
+
+    :param connection: The connection of the load transaction
+    :param table: The rollup table model (PeopleRollup or InterestRollup)
+    :param changes: The changed cells: ROLLUP_DIMENSIONS, and 'interest' for InterestRollup (can be null)
+    :return: Dataframe of the stored cells (with ROLLUP_DTYPES)
+    """
+    keys = ROLLUP_DIMENSIONS + (["interest"] if "interest" in changes else [])
+    cells = _records(changes.drop_duplicates(keys), keys)
+
+    stored = []
+    for start in range(0, len(cells), CELL_LOOKUP_SIZE):
+        condition = or_(
+            *[
+                and_(
+                    *[
+                        getattr(table, key).is_(None)
+                        if value is None
+                        else getattr(table, key) == value
+                        for key, value in cell.items()
+                    ]
+                )
+                for cell in cells[start : start + CELL_LOOKUP_SIZE]
+            ]
+        )
+        stored.append(
+            pd.read_sql(select(table).where(condition).with_for_update(), connection)
+        )
+
+    return _with_dtypes(pd.concat(stored, ignore_index=True))
+
+
+def _with_dtypes(cells: pd.DataFrame) -> pd.DataFrame:
+    """Cast the rollup columns of cells to ROLLUP_DTYPES"""
+    return cells.astype(
+        {col: dtype for col, dtype in ROLLUP_DTYPES.items() if col in cells}
+    )
+
+
+def _age_bounds(connection: Connection, cities: pd.Series) -> pd.DataFrame:
+    """Query the min and max age of the people_rollup cells of some cities from the person table (city index lookups)
+
+    :param connection: The connection of the load transaction
+    :param cities: The cities (can be null)
+    :return: Dataframe of ROLLUP_DIMENSIONS, 'min_age' and 'max_age'
+    """
+    condition = Person.city.in_(list(cities.dropna().unique()))
+    if cities.isna().any():
+        condition = or_(condition, Person.city.is_(None))
+
+    age_bucket = age_bucket_expression().label("age_bucket")
+    bounds = pd.read_sql(
+        select(
+            Person.city,
+            Person.title,
+            age_bucket,
+            func.min(Person.age).label("min_age"),
+            func.max(Person.age).label("max_age"),
+        )
+        .where(condition)
+        .group_by(Person.city, Person.title, age_bucket),
+        connection,
+    )
+
+    return _with_dtypes(bounds)
+
+
+def _write_cells(
+    connection: Connection, table: Table, cells: pd.DataFrame, count: str
+) -> None:
+    """Store the updated cells of a rollup table: cells already stored are updated (or deleted when no count is left)
+    and the others inserted
+
+    :param connection: The connection of the load transaction
+    :param table: The rollup table
+    :param cells: The cells with their new values, and the 'id' of the stored ones (null for new cells)
+    :param count: The count column of the table (e.g. 'person_count')
+    """
+    columns = [col.name for col in table.columns if col.name != "id"]
+    stored = cells["id"].notna()
+    kept = cells[count] > 0
+
+    deleted = [int(cell_id) for cell_id in cells.loc[stored & ~kept, "id"]]
+    for start in range(0, len(deleted), 500):
+        connection.execute(
+            delete(table).where(table.c.id.in_(deleted[start : start + 500]))
+        )
+
+    updates = _records(cells.loc[stored & kept], ["id"] + columns)
+    if updates:
+        connection.execute(
+            update(table)
+            .where(table.c.id == bindparam("b_id"))
+            .values({col: bindparam(f"b_{col}") for col in columns}),
+            [{f"b_{key}": value for key, value in row.items()} for row in updates],
+        )
+    inserts = _records(cells.loc[~stored & kept], columns)
+    if inserts:
+        connection.execute(insert(table), inserts)
+
+
+def _records(cells: pd.DataFrame, columns: list) -> list:
+    """Rows of cells as dictionaries of python values (ints, strings or None)"""
+    cells = cells[columns].astype(
+        {col: "Int64" for col in columns if cells[col].dtype.kind in "fiu"}
+    )
+
+    return cells.astype(object).where(cells.notna(), None).to_dict("records")
+
+
+def _apply_counts(
+    connection: Connection, key: Column, count: Column, deltas: Counter
+) -> None:
+    """Add count deltas to a counter table (key, count): existing keys are updated, new ones inserted and keys left
+    with no count deleted
+
+    :param connection: The connection of the load transaction
+    :param key: The key column (e.g. CityCount.city)
+    :param count: The count column (e.g. CityCount.person_count)
+    :param deltas: Counter of {key: count delta}
+    """
+    deltas = {value: delta for value, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    table: Table = key.table
+    existing = set()
+    values = list(deltas)
+    for start in range(0, len(values), 500):
+        existing.update(
+            connection.execute(
+                select(key)
+                .where(key.in_(values[start : start + 500]))
+                .with_for_update()
+            ).scalars()
+        )
+
+    updates = [
+        {"b_key": value, "b_delta": delta}
+        for value, delta in deltas.items()
+        if value in existing
+    ]
+    if updates:
+        connection.execute(
+            update(table)
+            .where(key == bindparam("b_key"))
+            .values({count.name: count + bindparam("b_delta")}),
+            updates,
+        )
+    inserts = [
+        {key.name: value, count.name: delta}
+        for value, delta in deltas.items()
+        if value not in existing
+    ]
+    if inserts:
+        connection.execute(insert(table), inserts)
+
+    connection.execute(delete(table).where(count <= 0))
+
+
+def _min(a, b):
+    return b if a is None else a if b is None else min(a, b)
+
+
+def _max(a, b):
+    return b if a is None else a if b is None else max(a, b)
@@ -0,0 +1,154 @@
+import asyncio
+from typing import AsyncIterator, Union
+
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.sql import func, select
+
+from database.data_schema import LoadWatermark, PeopleStatsSnapshot
+from database.people_queries import (
+    PEOPLE_BATCH_SIZE,
+    age_stats_statement,
+    aggregate_stats_statement,
+    aggregate_top_city_statement,
+    aggregate_top_interests_statement,
+    grouped_interests_statement,
+    grouped_stats_rows,
+    grouped_stats_statement,
+    people_statement,
+    snapshot_stats,
+    stats_history_rows,
+    stats_history_statement,
+    top_city_statement,
+    top_interests_statement,
+)
+from database.db_config import get_async_engine
+from monitoring.metrics import instrumented
+
+
+class AsyncPeopleDB:
+    """Read-only asyncio version of PeopleDB (SQLAlchemy asyncio extension, aiomysql for MySQL and aiosqlite for
+    SQLite), for the API: waiting on the database doesn't hold a thread, so concurrency isn't capped by the threadpool
+    """
+
+    def __init__(self, db_engine: Union[AsyncEngine, None] = None) -> None:
+        """
+        :param db_engine: The async engine, defaults to the async engine of the process (db_config.get_async_engine)
+        """
+        self.engine = db_engine or get_async_engine()
+
+    @instrumented()
+    async def stats(self, top_x: int = 5) -> dict:
+        """Same as PeopleQueries.stats, but the independent statements (age aggregates, top city and top interests) run
+        concurrently, each on its own pooled connection
+
+        :param top_x: How many interests to get, defaults to 5
+        :return: Dictionary with 'max_age', 'min_age', 'avg_age', 'city_with_most_people' and 'top_interests' keys
+        """
+        age_stats, top_city, top_interests = await asyncio.gather(
+            self._all(aggregate_stats_statement()),
+            self._all(aggregate_top_city_statement()),
+            self._all(aggregate_top_interests_statement(top_x)),
+        )
+        if age_stats:
+            max_age, min_age, age_sum, age_count = age_stats[0]
+            avg_age = age_sum / age_count if age_count else None
+        else:
+            # no people aggregates (see PeopleDB.create): computed from all the rows
+            age_stats, top_city, top_interests = await asyncio.gather(
+                self._all(age_stats_statement()),
+                self._all(top_city_statement()),
+                self._all(top_interests_statement(top_x)),
+            )
+            max_age, min_age, avg_age = age_stats[0]
+
+        return {
+            "max_age": max_age,
+            "min_age": min_age,
+            "avg_age": float(avg_age) if avg_age is not None else None,
+            "city_with_most_people": top_city[0][0] if top_city else None,
+            "top_interests": [interest for interest, _ in top_interests],
+        }
+
+    @instrumented()
+    async def grouped_stats(self, by: str = "city", top_x: int = 5, **filters) -> list:
+        """Same as PeopleQueries.grouped_stats, with the two statements run concurrently
+
+        :param by: 'city', 'title' or 'age_bucket', defaults to 'city'
+        :param top_x: How many interests to get per group, defaults to 5
+        :param filters: Only people of a city, title and/or age_bucket
+        :return: List of dictionaries as returned by grouped_stats_rows
+        """
+        stats_rows, interest_rows = await asyncio.gather(
+            self._all(grouped_stats_statement(by, **filters)),
+            self._all(grouped_interests_statement(by, **filters)),
+        )
+
+        return grouped_stats_rows(stats_rows, interest_rows, top_x)
+
+    @instrumented()
+    async def stats_snapshot(
+        self, top_x: int = 5, load_id: Union[int, None] = None
+    ) -> Union[dict, None]:
+        """Same as PeopleQueries.stats_snapshot
+
+        :param top_x: How many interests to get (up to the snapshot_top_x of the load), defaults to 5
+        :param load_id: The load watermark id (e.g. load_generation()), defaults to the last load
+        :return: Dictionary as returned by stats, None if the load has no snapshot or one with fewer interests
+        """
+        if load_id is None:
+            load_id = await self.load_generation()
+
+        rows = await self._all(
+            select(PeopleStatsSnapshot).where(PeopleStatsSnapshot.load_id == load_id)
+        )
+
+        # core rows have the snapshot columns as attributes, like the ORM object
+        return snapshot_stats(rows[0] if rows else None, top_x)
+
+    @instrumented()
+    async def stats_history(self, limit: int = 10) -> list:
+        """Same as PeopleQueries.stats_history
+
+        :param limit: How many loads to get, defaults to 10
+        :return: List of dictionaries as returned by stats_history_rows
+        """
+        return stats_history_rows(await self._all(stats_history_statement(limit)))
+
+    @instrumented()
+    async def load_generation(self) -> int:
+        """Same as PeopleQueries.load_generation
+
+        :return: The load generation
+        """
+        rows = await self._all(select(func.max(LoadWatermark.id)))
+
+        return rows[0][0] or 0
+
+    async def iter_people_batches(
+        self, batch_size: int = PEOPLE_BATCH_SIZE, **filters
+    ) -> AsyncIterator[list]:
+        """Same as PeopleQueries.iter_people_batches (server-side cursor of AsyncConnection.stream)
+
+        :param batch_size: Rows per batch, defaults to PEOPLE_BATCH_SIZE
+        :param filters: people_statement filters (e.g. city, min_age, after_id, limit)
+        :yield: Lists of rows (PEOPLE_COLUMNS values) ordered by id
+        """
+        async with self.engine.connect() as connection:
+            result = await connection.stream(people_statement(**filters))
+            async for batch in result.partitions(batch_size):
+                yield batch
+
+    async def dispose(self) -> None:
+        """Close the connections of the engine pool"""
+        await self.engine.dispose()
+
+    async def _all(self, statement) -> list:
+        """Execute a statement on a connection of the pool
+
+        :param statement: The select to execute
+        :return: List of the result rows
+        """
+        async with self.engine.connect() as connection:
+            result = await connection.execute(statement)
+
+            return result.all()
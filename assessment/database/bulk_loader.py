@@ -0,0 +1,182 @@
+import os
+import tempfile
+import time
+
+import pandas as pd
+from sqlalchemy import Table
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import text
+
+
+class BulkLoader:
+    """Insert a dataframe into a table, chunk_size rows at a time, and report the load speed. Subclasses implement
+    _insert_chunk with a strategy (e.g. executemany or LOAD DATA)"""
+
+    name = None
+
+    def __init__(self, chunk_size: int = 10_000) -> None:
+        self.chunk_size = chunk_size
+
+    def load(self, connection: Connection, table: Table, df: pd.DataFrame) -> dict:
+        """Insert the df columns that belong to the table, chunk by chunk, using the connection transaction
+
+        :param connection: The connection to insert with (commit is up to the caller)
+        :param table: The table to insert into
+        :param df: The dataframe to insert (its index is not inserted, reset it first if needed)
+        :return: Dictionary with 'strategy', 'rows', 'seconds' and 'rows_per_sec' of the load
+        """
+        columns = [col.name for col in table.columns if col.name in df.columns]
+
+        start = time.perf_counter()
+        for chunk_start in range(0, len(df), self.chunk_size):
+            chunk = df.iloc[chunk_start : chunk_start + self.chunk_size][columns]
+            self._insert_chunk(connection, table, chunk)
+        seconds = time.perf_counter() - start
+
+        return {
+            "strategy": self.name,
+            "rows": len(df),
+            "seconds": seconds,
+            "rows_per_sec": len(df) / seconds if seconds else 0.0,
+        }
+
+    def _insert_chunk(
+        self, connection: Connection, table: Table, chunk: pd.DataFrame
+    ) -> None:
+        raise NotImplementedError
+
+    @staticmethod
+    def _records(chunk: pd.DataFrame) -> list:
+        """Convert a chunk into a list of tuples of python values (nulls as None), as expected by DBAPI drivers
+
+        :param chunk: The dataframe chunk
+        :return: List of row tuples
+        """
+        values = chunk.astype(object)
+
+        return list(
+            values.where(chunk.notna(), None).itertuples(index=False, name=None)
+        )
+
+
+class MultiValuesLoader(BulkLoader):
+    """pandas to_sql(method='multi'): one multi-row INSERT per chunk (the former loader, kept for comparison)"""
+
+    name = "multi"
+
+    def _insert_chunk(
+        self, connection: Connection, table: Table, chunk: pd.DataFrame
+    ) -> None:
+        chunk.to_sql(
+            name=table.name,
+            con=connection,
+            if_exists="append",
+            method="multi",
+            index=False,
+        )
+
+
+class ExecutemanyLoader(BulkLoader):
+    """One parametrized INSERT sent with the driver's executemany per chunk (mysqlclient batches the rows into
+    statements that respect max_allowed_packet)"""
+
+    name = "executemany"
+
+    def _insert_chunk(
+        self, connection: Connection, table: Table, chunk: pd.DataFrame
+    ) -> None:
+        columns = list(chunk.columns)
+        records = [dict(zip(columns, row)) for row in self._records(chunk)]
+        connection.execute(table.insert(), records)
+
+
+class SQLiteLoader(BulkLoader):
+    """sqlite3 cursor.executemany with positional parameters, skipping SQLAlchemy parameter processing (local runs)"""
+
+    name = "sqlite"
+
+    def _insert_chunk(
+        self, connection: Connection, table: Table, chunk: pd.DataFrame
+    ) -> None:
+        columns = ", ".join(chunk.columns)
+        placeholders = ", ".join("?" * len(chunk.columns))
+        cursor = connection.connection.cursor()
+        cursor.executemany(
+            f"INSERT INTO {table.name} ({columns}) VALUES ({placeholders})",
+            self._records(chunk),
+        )
+        cursor.close()
+
+
+class LoadDataInfileLoader(BulkLoader):
+    """MySQL LOAD DATA LOCAL INFILE from a temporary csv file per chunk (the server's native bulk path). The engine must
+    allow it, e.g. create_engine(..., connect_args={"local_infile": 1}) and local_infile=ON on the server
+    """
+
+    name = "load_data"
+
+    def _insert_chunk(
+        self, connection: Connection, table: Table, chunk: pd.DataFrame
+    ) -> None:
+        # backslash is the LOAD DATA escape character, so it's escaped in the data and \N stands for NULL
+        strings = chunk.select_dtypes(include=["object", "category", "string"]).columns
+        chunk = chunk.assign(
+            **{
+                col: chunk[col].str.replace("\\", "\\\\", regex=False)
+                for col in strings
+            }
+        )
+
+        file = tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False)
+        try:
+            chunk.to_csv(file, index=False, header=False, na_rep="\\N")
+            file.close()
+            connection.execute(
+                text(
+                    f"LOAD DATA LOCAL INFILE '{file.name}' INTO TABLE {table.name} "
+                    "FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' "
+                    "LINES TERMINATED BY '\\n' "
+                    f"({', '.join(chunk.columns)})"
+                )
+            )
+        finally:
+            file.close()
+            os.remove(file.name)
+
+
+BULK_LOADERS = {
+    loader.name: loader
+    for loader in (
+        MultiValuesLoader,
+        ExecutemanyLoader,
+        SQLiteLoader,
+        LoadDataInfileLoader,
+    )
+}
+
+
+def get_bulk_loader(strategy: str, chunk_size: int = 10_000) -> BulkLoader:
+    """Instantiate a bulk loader by its strategy name
+
+    :param strategy: One of BULK_LOADERS keys ('multi', 'executemany', 'sqlite' or 'load_data')
+    :param chunk_size: Rows per insert chunk, defaults to 10_000
+    :return: The bulk loader
+    """
+    if strategy not in BULK_LOADERS:
+        raise ValueError(
+            f"'{strategy}' is not a bulk load strategy ({', '.join(BULK_LOADERS)})"
+        )
+
+    return BULK_LOADERS[strategy](chunk_size)
+
+
+def default_bulk_loader(dialect: str, chunk_size: int = 10_000) -> BulkLoader:
+    """Pick the bulk loader for a database dialect: sqlite3 executemany for SQLite, chunked executemany otherwise
+
+    :param dialect: The engine dialect name (e.g. 'mysql', 'sqlite')
+    :param chunk_size: Rows per insert chunk, defaults to 10_000
+    :return: The bulk loader
+    """
+    return get_bulk_loader(
+        "sqlite" if dialect == "sqlite" else "executemany", chunk_size
+    )
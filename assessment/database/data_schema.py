@@ -1,21 +1,200 @@
-from sqlalchemy import Column, Integer, String
+from datetime import datetime
+
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Column,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    Text,
+)
 
 from database.db_config import Base
 
 
+def key_string(length: int) -> String:
+    """String type of the columns the aggregates are keyed by, compared byte for byte: their values are counted in
+    python, where e.g. 'café' and 'cafe' are different keys, but the default MySQL collation (utf8mb4_0900_ai_ci)
+    ignores accents and case, so it's utf8mb4_bin on MySQL
+
+    :param length: The column length
+    :return: The column type
+    """
+    return String(length).with_variant(String(length, collation="utf8mb4_bin"), "mysql")
+
+
 class Person(Base):
     __tablename__ = "person"
 
     id = Column(Integer, primary_key=True)
-    title = Column(String(10))
+    title = Column(key_string(10))
     name = Column(String(100))
-    age = Column(Integer)
-    city = Column(String(100))
+    age = Column(Integer, index=True)
+    city = Column(key_string(100), index=True)
     interest1 = Column(String(100))
     interest2 = Column(String(100))
     interest3 = Column(String(100))
     interest4 = Column(String(100))
     phone_number = Column(String(50))
+    # content hash of the columns above, to detect changed rows on upsert
+    row_hash = Column(BigInteger)
+    # hash of name, phone_number and city, to find the same person across loads
+    fingerprint = Column(BigInteger, index=True)
 
     def __repr__(self):
         return f"<Person(title='{self.title}', name='{self.name}', age='{self.age}')>"
+
+
+class PersonInterest(Base):
+    """Normalized interests of a person: one row per non-null interest1, 2, 3, and 4 value"""
+
+    __tablename__ = "person_interest"
+
+    person_id = Column(
+        Integer, ForeignKey("person.id", ondelete="CASCADE"), primary_key=True
+    )
+    position = Column(Integer, primary_key=True)  # 1 to 4, as in interest1 to interest4
+    interest = Column(key_string(100), nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<PersonInterest(person_id='{self.person_id}', interest='{self.interest}')>"
+
+
+class LoadWatermark(Base):
+    """One row per save_from_dataframe call, to know what was loaded last (and skip loading the same data again)"""
+
+    __tablename__ = "load_watermark"
+
+    id = Column(Integer, primary_key=True)
+    mode = Column(String(10), nullable=False)
+    source_hash = Column(String(64), nullable=False)
+    # hash of the input (raw file and cleaning configuration) the data came from, if known
+    input_key = Column(String(64))
+    # if the load was an 'upsert' that deleted the stored rows missing from its data
+    delete_missing = Column(Boolean, nullable=False, default=False)
+    row_count = Column(Integer, nullable=False)
+    inserted = Column(Integer, nullable=False, default=0)
+    updated = Column(Integer, nullable=False, default=0)
+    deleted = Column(Integer, nullable=False, default=0)
+    loaded_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<LoadWatermark(id='{self.id}', mode='{self.mode}', loaded_at='{self.loaded_at}')>"
+
+
+class PeopleAggregate(Base):
+    """Running aggregates of the person table (a single row), updated by every load with the rows it inserts and
+    deletes (see database.aggregates), so stats don't scan the table"""
+
+    __tablename__ = "people_aggregate"
+
+    id = Column(Integer, primary_key=True)
+    person_count = Column(Integer, nullable=False)
+    # people with an age, and the sum of their ages (average age is age_sum / age_count)
+    age_count = Column(Integer, nullable=False)
+    age_sum = Column(BigInteger, nullable=False)
+    min_age = Column(Integer)
+    max_age = Column(Integer)
+
+    def __repr__(self):
+        return f"<PeopleAggregate(person_count='{self.person_count}')>"
+
+
+class CityCount(Base):
+    """Running count of people per city (non-null cities with at least one person)"""
+
+    __tablename__ = "city_count"
+
+    city = Column(key_string(100), primary_key=True)
+    person_count = Column(Integer, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<CityCount(city='{self.city}', person_count='{self.person_count}')>"
+
+
+class InterestCount(Base):
+    """Running count of person_interest rows per interest"""
+
+    __tablename__ = "interest_count"
+
+    interest = Column(key_string(100), primary_key=True)
+    quantity = Column(Integer, nullable=False, index=True)
+
+    def __repr__(self):
+        return (
+            f"<InterestCount(interest='{self.interest}', quantity='{self.quantity}')>"
+        )
+
+
+class PeopleRollup(Base):
+    """Running people aggregates per cell of the (city, title, age bucket) cube, kept up to date by every load like
+    people_aggregate (see database.aggregates): grouped stats add up the cells of each group, so they don't scan the
+    person table. Null dimensions (e.g. people with no city) are cells of their own. There's no unique key on the
+    cells (it wouldn't hold the null ones in most databases): loads write them under the people_aggregate row lock of
+    apply_delta, which serializes them"""
+
+    __tablename__ = "people_rollup"
+    # loads look up the cells they change
+    __table_args__ = (Index("ix_people_rollup_cell", "city", "title", "age_bucket"),)
+
+    id = Column(Integer, primary_key=True)
+    city = Column(key_string(100))
+    title = Column(key_string(10))
+    # first age of the bucket (ages age_bucket to age_bucket + AGE_BUCKET_WIDTH - 1), null for people with no age
+    age_bucket = Column(Integer)
+    person_count = Column(Integer, nullable=False)
+    age_count = Column(Integer, nullable=False)
+    age_sum = Column(BigInteger, nullable=False)
+    min_age = Column(Integer)
+    max_age = Column(Integer)
+
+    def __repr__(self):
+        return f"<PeopleRollup(city='{self.city}', title='{self.title}', age_bucket='{self.age_bucket}')>"
+
+
+class InterestRollup(Base):
+    """Running count of person_interest rows per interest and cell of the people_rollup cube"""
+
+    __tablename__ = "interest_rollup"
+    __table_args__ = (
+        Index("ix_interest_rollup_cell", "city", "title", "age_bucket", "interest"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    city = Column(key_string(100))
+    title = Column(key_string(10))
+    age_bucket = Column(Integer)
+    interest = Column(key_string(100), nullable=False)
+    quantity = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return (
+            f"<InterestRollup(interest='{self.interest}', quantity='{self.quantity}')>"
+        )
+
+
+class PeopleStatsSnapshot(Base):
+    """People stats computed at the end of a load (one row per load, keyed by its watermark id), so they are read with a
+    primary key lookup instead of aggregating every row, and kept as a history across loads
+    """
+
+    __tablename__ = "people_stats_snapshot"
+
+    load_id = Column(
+        Integer, ForeignKey("load_watermark.id", ondelete="CASCADE"), primary_key=True
+    )
+    max_age = Column(Integer)
+    min_age = Column(Integer)
+    avg_age = Column(Float(precision=53))
+    city_with_most_people = Column(String(100))
+    # json list of the top interests, the first top_x of the ranking
+    top_interests = Column(Text, nullable=False)
+    top_x = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<PeopleStatsSnapshot(load_id='{self.load_id}', created_at='{self.created_at}')>"
@@ -1,114 +1,509 @@
-from typing import Union
+import hashlib
+import json
+from typing import Iterable, Union
 
+import numpy as np
 import pandas as pd
-from sqlalchemy.orm import Session
-from sqlalchemy.sql import desc, func
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.sql import delete, func, insert, select
 
-from database.data_schema import Person
-from database.db_config import Base, engine
+from database.aggregates import (
+    AggregateDelta,
+    apply_delta,
+    rebuild_aggregates,
+    recompute_aggregates,
+    stored_aggregates,
+)
+from database.bulk_loader import BulkLoader, default_bulk_loader
+from database.data_schema import (
+    LoadWatermark,
+    PeopleStatsSnapshot,
+    Person,
+    PersonInterest,
+)
+from database.db_config import Base
+from database.people_queries import (
+    PERSON_COLUMNS,
+    PeopleQueries,
+    covers_load,
+    query_stats,
+)
+from datahandling.cleaning_utils import row_fingerprints
+from monitoring.metrics import instrumented
 
+INTEREST_COLUMNS = ("interest1", "interest2", "interest3", "interest4")
+LOAD_MODES = ("replace", "append", "upsert")
+DELETE_CHUNK_SIZE = 500
+# fingerprints looked up at a time in the person.fingerprint index by deduplicating loads
+FINGERPRINT_LOOKUP_SIZE = 1000
+# top interests kept in each stats snapshot: stats_snapshot serves any top_x up to it
+SNAPSHOT_TOP_X = 10
 
-class PeopleDB:
+
+class PeopleDB(PeopleQueries):
+    """The people queries (see PeopleQueries) and the loads of people dataframes, with the ETL dependencies (pandas)"""
+
+    def __init__(
+        self,
+        db_engine: Union[Engine, None] = None,
+        bulk_loader: Union[BulkLoader, None] = None,
+        snapshot_top_x: int = SNAPSHOT_TOP_X,
+    ) -> None:
+        # defaults to the engine of the process (db_config.get_engine)
+        super().__init__(db_engine)
+        # how save_from_dataframe inserts rows, defaults to the best strategy for the engine dialect
+        self.bulk_loader = bulk_loader or default_bulk_loader(self.engine.dialect.name)
+        # top interests kept in the stats snapshot written by every load
+        self.snapshot_top_x = snapshot_top_x
+        # functions called (with no arguments) after every committed load, e.g. StatsCache.invalidate
+        self.load_listeners = []
+
+    @instrumented()
     def create(self):
-        """Create the database schema to the database engine"""
-        Base.metadata.create_all(engine)
+        """Create the database schema to the database engine, and build the people aggregates if there are none (e.g.
+        data loaded before they, or their rollup cube, existed)"""
+        Base.metadata.create_all(self.engine)
+
+        with self.engine.begin() as connection:
+            stored = stored_aggregates(connection)
+            if stored is None or (stored["person_count"] and not stored["rollup"]):
+                rebuild_aggregates(connection)
 
-    def save_from_dataframe(self, df: pd.DataFrame) -> None:
-        """Take df data and store it in one command to the database engine
+    @instrumented()
+    def save_from_dataframe(
+        self,
+        df: pd.DataFrame,
+        if_exists: str = "replace",
+        delete_missing: bool = False,
+        input_key: Union[str, None] = None,
+        deduplicate: bool = False,
+    ) -> dict:
+        """Take df data and store it in one transaction to the database engine (inserted chunk by chunk with the bulk
+        loader), along with its normalized interests (person_interest table), a load watermark and a snapshot of the
+        stats after the load (see stats_snapshot). The people aggregates (people_aggregate, city_count and
+        interest_count tables) are updated with the rows inserted and deleted only. Tables created by
+        create() are kept with their indexes:
+        - 'replace' deletes the current rows before inserting (readers keep seeing the old rows until commit)
+        - 'append' only inserts
+        - 'upsert' keys rows by id (the df index) and compares content hashes to insert new rows and rewrite only the
+        changed ones. It does nothing if df is the same data of the last load watermark (see covers_load)
+
+        Every row is stored with its fingerprint (see cleaning_utils.row_fingerprints). With deduplicate, rows of people
+        stored already under another id, or found earlier in df, are not loaded (e.g. the same person coming from
+        several feeds loaded with 'append'). With delete_missing, only the stored rows kept by the load count (the
+        others are deleted)
 
         :param df: The dataframe to extract data
+        :param if_exists: 'replace', 'append' or 'upsert', defaults to 'replace'
+        :param delete_missing: With 'upsert', also delete rows whose id isn't in df, defaults to False
+        :param input_key: Key of the input that produced df (see is_loaded), recorded in the watermark, defaults to None
+        :param deduplicate: If rows of people already found are skipped, defaults to False
+        :return: Dictionary with 'inserted', 'updated', 'deleted' row counts, 'duplicates' (rows skipped by
+        deduplicate), 'skipped' (nothing to load) and the 'rows_per_sec' of the person insert
         """
-        df.to_sql(
-            name=Person.__tablename__,
-            con=engine,
-            if_exists="replace",  # 'append', 'replace' or 'fail' available
-            method="multi",
-            index=True,
-            index_label="id",
+        hashes = row_hashes(df)
+
+        if if_exists == "upsert":
+            last_watermark = self.last_watermark()
+            if (
+                covers_load(last_watermark, delete_missing)
+                and last_watermark.source_hash == frame_hash(hashes)
+                and input_key in (None, last_watermark.input_key)
+            ):
+                return {
+                    "inserted": 0,
+                    "updated": 0,
+                    "deleted": 0,
+                    "duplicates": 0,
+                    "skipped": True,
+                    "rows_per_sec": 0.0,
+                }
+
+        return self._save_chunks(
+            [(df, hashes)], if_exists, delete_missing, input_key, deduplicate
         )
 
-    def max_age(self) -> int:
-        """Open a session to query the maximum age of people
+    @instrumented()
+    def save_from_chunks(
+        self,
+        chunks: Iterable[pd.DataFrame],
+        if_exists: str = "replace",
+        delete_missing: bool = False,
+        input_key: Union[str, None] = None,
+        deduplicate: bool = False,
+    ) -> dict:
+        """Same as save_from_dataframe, but for an iterable of dataframes (e.g. a generator of cleaned csv chunks):
+        each chunk is written as soon as it's produced, so memory is bounded by the chunk size. All the chunks are
+        stored in one transaction and ids must be unique across chunks. With deduplicate, each chunk is checked against
+        the rows stored by the former ones as well
 
-        :return: The maximum age
+        :param chunks: The dataframes to extract data, one after the other
+        :param if_exists: 'replace', 'append' or 'upsert', defaults to 'replace'
+        :param delete_missing: With 'upsert', also delete rows whose id isn't in any chunk, defaults to False
+        :param input_key: Key of the input that produced the chunks (see is_loaded), defaults to None
+        :param deduplicate: If rows of people already found are skipped, defaults to False
+        :return: Dictionary with 'inserted', 'updated', 'deleted' row counts, 'duplicates' (rows skipped by
+        deduplicate), 'skipped' (nothing changed) and the 'rows_per_sec' of the person inserts
         """
-        session = Session(engine)
-        person_obj = session.query(Person).order_by(Person.age.desc()).first()
-        session.close()
+        return self._save_chunks(
+            ((chunk, row_hashes(chunk)) for chunk in chunks),
+            if_exists,
+            delete_missing,
+            input_key,
+            deduplicate,
+        )
+
+    @instrumented()
+    def save_stats_snapshot(self) -> None:
+        """Compute and store the stats snapshot of the last load (loads write it already, this is for data loaded
+        before snapshots existed)"""
+        with self.engine.begin() as connection:
+            load_id = connection.execute(select(func.max(LoadWatermark.id))).scalar()
+            if load_id is None:
+                raise ValueError("Nothing was loaded yet")
 
-        return person_obj.age
+            connection.execute(
+                delete(PeopleStatsSnapshot).where(
+                    PeopleStatsSnapshot.load_id == load_id
+                )
+            )
+            self._insert_stats_snapshot(connection, load_id)
 
-    def min_age(self) -> int:
-        """Open a session to query the minimum age of people
+    def _save_chunks(
+        self,
+        chunks: Iterable[tuple],
+        if_exists: str,
+        delete_missing: bool,
+        input_key: Union[str, None] = None,
+        deduplicate: bool = False,
+    ) -> dict:
+        """Store (dataframe, row hashes) chunks in one transaction (see save_from_dataframe for the modes)
 
-        :return: The minimum age
+        :param chunks: Iterable of (dataframe, row_hashes of the dataframe) tuples
+        :param if_exists: 'replace', 'append' or 'upsert'
+        :param delete_missing: With 'upsert', also delete rows whose id isn't in any chunk
+        :param input_key: Key of the input that produced the chunks, defaults to None
+        :param deduplicate: If rows of people already found are skipped, defaults to False
+        :return: Dictionary with 'inserted', 'updated', 'deleted', 'duplicates', 'skipped' and 'rows_per_sec'
         """
-        session = Session(engine)
-        person_obj = session.query(Person).order_by(Person.age).first()
-        session.close()
+        if if_exists not in LOAD_MODES:
+            raise ValueError(f"'{if_exists}' is not valid for if_exists")
+
+        digest = hashlib.sha256()
+        result = {
+            "inserted": 0,
+            "updated": 0,
+            "deleted": 0,
+            "duplicates": 0,
+            "skipped": False,
+        }
+        # 'replace' deletes every row, so the aggregates start over
+        delta = AggregateDelta(reset=if_exists == "replace")
+        row_count, inserted_seconds, seen_ids = 0, 0.0, []
+
+        with self.engine.begin() as connection:
+            if if_exists == "replace":
+                connection.execute(delete(PersonInterest))
+                connection.execute(delete(Person))
+
+            for df, hashes in chunks:
+                update_digest(digest, hashes)
+                row_count += len(df)
+                fingerprints = row_fingerprints(df)
 
-        return person_obj.age
+                if deduplicate:
+                    df, hashes, fingerprints, duplicates = self._drop_duplicates(
+                        connection,
+                        df,
+                        hashes,
+                        fingerprints,
+                        # the other stored rows are deleted at the end
+                        seen_ids if delete_missing else None,
+                    )
+                    result["duplicates"] += duplicates
 
-    def avg_age(self) -> float:
-        """Open a session to query the average age of people
+                updated = 0
+                if if_exists == "upsert":
+                    seen_ids.append(df.index.values)
+                    df, hashes, updated = self._upsert_changes(
+                        connection, df, hashes, delta
+                    )
+                result["inserted"] += len(df) - updated
+                result["updated"] += updated
 
-        :return: The average age
+                load_report = self.bulk_loader.load(
+                    connection,
+                    Person.__table__,
+                    df.assign(
+                        row_hash=hashes,
+                        # rows with a null key have no fingerprint
+                        fingerprint=fingerprints.astype("Int64").reindex(df.index),
+                    )
+                    .rename_axis("id")
+                    .reset_index(),
+                )
+                interests = interests_frame(df)
+                self.bulk_loader.load(connection, PersonInterest.__table__, interests)
+                inserted_seconds += load_report["seconds"]
+                delta.add(df, interests)
+
+            if if_exists == "upsert" and delete_missing:
+                stored_ids = pd.read_sql(select(Person.id), connection)["id"]
+                seen = (
+                    np.concatenate(seen_ids)
+                    if seen_ids
+                    else np.array([], dtype="int64")
+                )
+                missing = stored_ids[~stored_ids.isin(seen)]
+                self._delete_ids(connection, missing, delta)
+                result["deleted"] = len(missing)
+
+            result["skipped"] = if_exists == "upsert" and not any(
+                result[key] for key in ("inserted", "updated", "deleted")
+            )
+            written = result["inserted"] + result["updated"]
+            result["rows_per_sec"] = (
+                written / inserted_seconds if inserted_seconds else 0.0
+            )
+
+            load_id = connection.execute(
+                insert(LoadWatermark).values(
+                    mode=if_exists,
+                    delete_missing=if_exists == "upsert" and delete_missing,
+                    source_hash=digest.hexdigest(),
+                    input_key=input_key,
+                    row_count=row_count,
+                    inserted=result["inserted"],
+                    updated=result["updated"],
+                    deleted=result["deleted"],
+                )
+            ).inserted_primary_key[0]
+            apply_delta(connection, delta)
+            # the stats only change with loads: computed once here, readers get them by the load id
+            self._insert_stats_snapshot(connection, load_id)
+
+        for listener in self.load_listeners:
+            listener()
+
+        return result
+
+    @instrumented()
+    def check_aggregates(self) -> dict:
+        """Compare the people aggregates kept up to date by the loads with a full recompute from the stored rows
+
+        :return: Dictionary of the aggregates that differ: {name: (incremental value, recomputed value)}, empty if they
+        are consistent
         """
-        session = Session(engine)
-        result = session.query(func.avg(Person.age).label("avg_age")).first()
-        session.close()
+        with self.engine.connect() as connection:
+            stored = stored_aggregates(connection) or {}
+            recomputed = recompute_aggregates(connection)
+
+        return {
+            name: (stored.get(name), value)
+            for name, value in recomputed.items()
+            if stored.get(name) != value
+        }
 
-        return result[0]
+    @instrumented()
+    def rebuild_aggregates(self) -> None:
+        """Recompute the people aggregates from the stored rows (e.g. if check_aggregates finds differences)"""
+        with self.engine.begin() as connection:
+            rebuild_aggregates(connection)
 
-    def top_x_interests(self, x: int = 1, as_dict: bool = False) -> Union[dict, list]:
-        """Select the top x interests among interest 1, 2, 3, and 4
+    def _upsert_changes(
+        self,
+        connection: Connection,
+        df: pd.DataFrame,
+        hashes: pd.Series,
+        delta: AggregateDelta,
+    ) -> tuple:
+        """Compare the row hashes of df with the stored ones (in df ids range) and delete the stored rows that changed,
+        so they are inserted again along with the new ones
 
-        :param x: How many interests to get, defaults to 1
-        :param as_dict: If full dictionary should be returned, defaults to False
-        :return: Dictionary with {'interest': 'quantity', ...} if as_dict == True, otherwise just the list of top x interests
+        :param connection: The connection of the running transaction
+        :param df: The people dataframe (indexed by person id)
+        :param hashes: The row_hashes of df
+        :param delta: The aggregate changes of the load, the deleted rows are removed from it
+        :return: Tuple of (dataframe with new and changed rows, their hashes, how many changed)
         """
-        session = Session(engine)
-        # select all interests of the database and save them into a dataframe
-        df = pd.read_sql(
-            session.query(
-                Person.interest1, Person.interest2, Person.interest3, Person.interest4
-            ).statement,
-            session.bind,
-        )
-        session.close()
+        if df.empty:
+            return df, hashes, 0
+
+        stored = pd.read_sql(
+            select(Person.id, Person.row_hash).where(
+                Person.id.between(int(df.index.min()), int(df.index.max()))
+            ),
+            connection,
+            index_col="id",
+        )["row_hash"]
+        common = hashes.index.intersection(stored.index)
+        changed = common[hashes[common].values != stored[common].values]
+        new = hashes.index.difference(stored.index)
+
+        # changed rows are deleted and inserted again (along with their interests)
+        self._delete_ids(connection, changed, delta)
+        df = df.loc[new.append(changed)]
 
-        # filter the top interests using pandas instead of sqlalchemy
-        df_result = (
-            pd.concat(
-                [df["interest1"], df["interest2"], df["interest3"], df["interest4"]]
+        return df, hashes[df.index], len(changed)
+
+    def _drop_duplicates(
+        self,
+        connection: Connection,
+        df: pd.DataFrame,
+        hashes: pd.Series,
+        fingerprints: pd.Series,
+        loaded_ids: Union[list, None] = None,
+    ) -> tuple:
+        """Drop the rows of people found earlier in df or stored under another id already (same fingerprint), keeping
+        the first one. Stored fingerprints are looked up with the person.fingerprint index, so the cost depends on the
+        rows loaded, not on the rows stored
+
+        :param connection: The connection of the running transaction (so rows of the former chunks are found)
+        :param df: The people dataframe (indexed by person id)
+        :param hashes: The row_hashes of df
+        :param fingerprints: The row_fingerprints of df
+        :param loaded_ids: Id arrays of the former chunks of the load, if only stored rows with these ids count (e.g.
+        'upsert' with delete_missing, which deletes the others), defaults to None (every stored row counts)
+        :return: Tuple of (dataframe without duplicates, its hashes, its fingerprints, how many rows were dropped)
+        """
+        values = fingerprints.unique().tolist()
+        stored = [
+            pd.read_sql(
+                select(Person.id, Person.fingerprint).where(
+                    Person.fingerprint.in_(
+                        values[start : start + FINGERPRINT_LOOKUP_SIZE]
+                    )
+                ),
+                connection,
             )
-            .value_counts()
-            .sort_values(ascending=False)
+            for start in range(0, len(values), FINGERPRINT_LOOKUP_SIZE)
+        ]
+        stored = (
+            pd.concat(stored)
+            if stored
+            else pd.DataFrame({"id": [], "fingerprint": []}, dtype="int64")
         )
+        # stored rows with an id of df are the same rows (e.g. 'upsert'), not duplicates
+        stored = stored[~stored["id"].isin(df.index)]
+        if loaded_ids is not None and not stored.empty:
+            stored = stored[
+                stored["id"].isin(np.concatenate(loaded_ids) if loaded_ids else [])
+            ]
+        duplicated = (
+            fingerprints.duplicated() | fingerprints.isin(stored["fingerprint"])
+        ).to_numpy()
+        if not duplicated.any():
+            return df, hashes, fingerprints, 0
 
-        # select x interests of the numpy array
-        top_interest = df_result[:x]
-
-        # store the interests in a dictionary
-        result = {}
-        for index in top_interest.index:
-            result[index] = top_interest[index]
+        df = df.drop(index=fingerprints.index[duplicated])
 
-        if as_dict:
-            return result
-        return list(result.keys())
+        return df, hashes[df.index], fingerprints[~duplicated], int(duplicated.sum())
 
-    def most_frequent_city(self) -> str:
-        """Query top city of most people
+    def _insert_stats_snapshot(self, connection: Connection, load_id: int) -> None:
+        """Compute the stats of the stored data and insert them as the snapshot of a load
 
-        :return: The most frequent city of the data
+        :param connection: The connection of the running transaction (so the stats include its changes)
+        :param load_id: The load watermark id
         """
-        session = Session(engine)
-        result = (
-            session.query(func.count(Person.city).label("person_count"), Person.city)
-            .group_by(Person.city)
-            .order_by(desc("person_count"))
+        stats = query_stats(connection, self.snapshot_top_x)
+        connection.execute(
+            insert(PeopleStatsSnapshot).values(
+                load_id=load_id,
+                max_age=stats["max_age"],
+                min_age=stats["min_age"],
+                avg_age=stats["avg_age"],
+                city_with_most_people=stats["city_with_most_people"],
+                top_interests=json.dumps(stats["top_interests"]),
+                top_x=self.snapshot_top_x,
+            )
         )
-        session.close()
 
-        return result[0][1]
+    def _delete_ids(
+        self, connection: Connection, ids: pd.Index, delta: AggregateDelta
+    ) -> None:
+        """Delete people (and their interests) by id, in chunks to keep the IN lists short
+
+        :param connection: The connection of the running transaction
+        :param ids: The ids to delete
+        :param delta: The aggregate changes of the load, the deleted rows are removed from it
+        """
+        ids = [int(person_id) for person_id in ids]
+        for start in range(0, len(ids), DELETE_CHUNK_SIZE):
+            chunk = ids[start : start + DELETE_CHUNK_SIZE]
+            people = pd.read_sql(
+                select(Person.id, Person.age, Person.city, Person.title).where(
+                    Person.id.in_(chunk)
+                ),
+                connection,
+                index_col="id",
+            )
+            interests = pd.read_sql(
+                select(PersonInterest.person_id, PersonInterest.interest).where(
+                    PersonInterest.person_id.in_(chunk)
+                ),
+                connection,
+            )
+            delta.remove(people, interests)
+            connection.execute(
+                delete(PersonInterest).where(PersonInterest.person_id.in_(chunk))
+            )
+            connection.execute(delete(Person).where(Person.id.in_(chunk)))
+
+
+def row_hashes(df: pd.DataFrame) -> pd.Series:
+    """Hash the content of each row of a people dataframe (columns missing from df are hashed as null), so rows can be
+    compared with the stored ones without comparing every column. The hashes don't depend on the columns dtypes
+
+    :param df: The people dataframe (indexed by person id)
+    :return: Series of signed 64 bits hashes (as the row_hash column) indexed as df
+    """
+    content = df.reindex(columns=PERSON_COLUMNS)
+    # narrow ints (e.g. CSVHandler.compact_data) hash differently from int64 if negative, so they are hashed as int64.
+    # category and string columns hash as their object values already
+    content = content.astype(
+        {col: "int64" for col, dtype in content.dtypes.items() if dtype.kind == "i"}
+    )
+    hashes = pd.util.hash_pandas_object(content, index=False)
+
+    return pd.Series(hashes.values.view("int64"), index=df.index, name="row_hash")
+
+
+def update_digest(digest, hashes: pd.Series) -> None:
+    """Feed the (id, row hash) pairs of a dataframe to a hashlib digest. Rows are fed in order, so the final digest
+    doesn't depend on how the data was split into chunks
+
+    :param digest: The hashlib digest (e.g. hashlib.sha256())
+    :param hashes: The row_hashes of the dataframe
+    """
+    pairs = np.column_stack([hashes.index.values.astype("int64"), hashes.values])
+    digest.update(pairs.tobytes())
+
+
+def frame_hash(hashes: pd.Series) -> str:
+    """Combine the row hashes (and ids) of a dataframe into a single hash of the whole content
+
+    :param hashes: The row_hashes of the dataframe
+    :return: Hexadecimal sha256 digest
+    """
+    digest = hashlib.sha256()
+    update_digest(digest, hashes)
+
+    return digest.hexdigest()
+
+
+def interests_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Unpivot the interest1, 2, 3, and 4 columns of a people dataframe into person_interest rows
+
+    :param df: The people dataframe (indexed by person id)
+    :return: Dataframe with 'person_id', 'position' and 'interest' columns (null interests are left out)
+    """
+    cols = [col for col in INTEREST_COLUMNS if col in df.columns]
+    interests = (
+        df[cols]
+        .rename(columns=lambda col: int(col[len("interest") :]))
+        .rename_axis("person_id")
+        .reset_index()
+        .melt(id_vars="person_id", var_name="position", value_name="interest")
+    )
+
+    return interests.dropna(subset=["interest"])
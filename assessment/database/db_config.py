@@ -1,15 +1,235 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Union
+
 from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.orm import Session, declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from monitoring.metrics import instrument_engine
 
 Base = declarative_base()
 
-# engine_params = "sqlite:///foo.db"
-user = "datatest"
-password = "alligator"
-root_pass = "root"
-port = 3306
-host = "database"
-database = "datatestdb"
+# connection settings, overridden by environment variables (DATABASE_URL takes precedence over the single parts)
+user = os.environ.get("DB_USER", "datatest")
+password = os.environ.get("DB_PASSWORD", "alligator")
+root_pass = os.environ.get("DB_ROOT_PASSWORD", "root")
+port = int(os.environ.get("DB_PORT", 3306))
+host = os.environ.get("DB_HOST", "database")
+database = os.environ.get("DB_NAME", "datatestdb")
+
+engine_params = os.environ.get(
+    "DATABASE_URL", f"mysql://{user}:{password}@{host}:{port}/{database}"
+)
+
+# asyncio drivers by dialect (see AsyncPeopleDB)
+ASYNC_DRIVERS = {"mysql": "mysql+aiomysql", "sqlite": "sqlite+aiosqlite"}
+
+# session shared by the code running in a session_scope block (e.g. one API request)
+_scoped_session = ContextVar("scoped_session", default=None)
+# one engine of each kind per process: {'sync'/'async': (pid, engine)}
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+class TimedPoolMixin:
+    """Pool mixin that measures how long checkouts wait for a connection (pool exhausted), for pool_metrics"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        connection = super()._do_get()
+        wait = time.perf_counter() - start
+
+        self.checkouts += 1
+        self.wait_seconds += wait
+        self.max_wait_seconds = max(self.max_wait_seconds, wait)
+
+        return connection
+
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def pool_settings() -> dict:
+    """Connection pool settings from the environment: DB_POOL_SIZE (5), DB_MAX_OVERFLOW (10), DB_POOL_TIMEOUT (30
+    seconds), DB_POOL_RECYCLE (3600 seconds, under MySQL wait_timeout) and DB_POOL_PRE_PING (1)
+
+    :return: Dictionary of create_engine pool arguments
+    """
+    return {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 3600)),
+        "pool_pre_ping": os.environ.get("DB_POOL_PRE_PING", "1") == "1",
+    }
+
+
+def create_db_engine(url: Union[str, None] = None, **kwargs) -> Engine:
+    """Create an engine with the pool_settings and a TimedQueuePool (in-memory SQLite keeps its default pool: every
+    connection would be a different database), its SQL statements timed (see monitoring.metrics.instrument_engine)
+
+    :param url: The database url, defaults to engine_params
+    :param kwargs: create_engine arguments, they override pool_settings
+    :return: The engine
+    """
+    url = url or engine_params
+
+    return instrument_engine(
+        create_engine(url, **_engine_arguments(url, TimedQueuePool, kwargs))
+    )
+
+
+def create_async_db_engine(url: Union[str, None] = None, **kwargs) -> AsyncEngine:
+    """Same as create_db_engine, for the asyncio driver of the url dialect (see to_async_url)
+
+    :param url: The database url, defaults to engine_params
+    :param kwargs: create_async_engine arguments, they override pool_settings
+    :return: The async engine
+    """
+    url = to_async_url(url or engine_params)
+
+    return instrument_engine(
+        create_async_engine(
+            url, **_engine_arguments(url, TimedAsyncAdaptedQueuePool, kwargs)
+        )
+    )
+
+
+def get_engine() -> Engine:
+    """The engine of this process, created on first use: a pool must not be shared with forked processes (e.g. uvicorn
+    workers), so each one gets its own
+
+    :return: The engine
+    """
+    return _process_engine("sync", create_db_engine)
+
+
+def get_async_engine() -> AsyncEngine:
+    """The async engine of this process, created on first use (see get_engine)
+
+    :return: The async engine
+    """
+    return _process_engine("async", create_async_db_engine)
+
+
+async def dispose_engines() -> None:
+    """Close the pooled connections of this process engines and forget them (e.g. at API shutdown)"""
+    with _engines_lock:
+        engines = dict(_engines)
+        _engines.clear()
+
+    for kind, (pid, engine) in engines.items():
+        if pid != os.getpid():
+            continue
+        if kind == "async":
+            await engine.dispose()
+        else:
+            engine.dispose()
+
+
+def to_async_url(url: str) -> str:
+    """The same database url with the asyncio driver of its dialect (e.g. mysql:// -> mysql+aiomysql://)
+
+    :param url: The database url
+    :return: The async database url
+    """
+    dialect, rest = url.split("://", 1)
+    dialect = dialect.split("+")[0]
+    if dialect not in ASYNC_DRIVERS:
+        raise ValueError(f"'{dialect}' has no asyncio driver set")
+
+    return f"{ASYNC_DRIVERS[dialect]}://{rest}"
+
+
+def pool_metrics(engine: Union[Engine, AsyncEngine]) -> dict:
+    """Usage of an engine connection pool, to size it for the worker count
+
+    :param engine: The engine (sync or async)
+    :return: Dictionary with 'size', 'checked_out', 'checked_in' and 'overflow' connections and, for timed pools,
+    'checkouts', 'wait_seconds' (total) and 'max_wait_seconds' spent waiting for a connection
+    """
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return {}
+
+    metrics = {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        # negative while the pool has fewer connections than its size
+        "overflow": pool.overflow(),
+    }
+    if isinstance(pool, TimedPoolMixin):
+        metrics.update(
+            checkouts=pool.checkouts,
+            wait_seconds=pool.wait_seconds,
+            max_wait_seconds=pool.max_wait_seconds,
+        )
+
+    return metrics
+
+
+@contextmanager
+def session_scope(engine: Union[Engine, None] = None) -> Iterator[Session]:
+    """Session shared by everything running inside the block (e.g. one API request): session_scope calls nested in it
+    for the same engine reuse its session (and connection) instead of opening new ones
+
+    :param engine: The engine, defaults to get_engine()
+    :yield: The session
+    """
+    engine = engine or get_engine()
+    session = _scoped_session.get()
+    if session is not None and session.bind is engine:
+        yield session
+        return
+
+    with Session(engine) as session:
+        token = _scoped_session.set(session)
+        try:
+            yield session
+        finally:
+            _scoped_session.reset(token)
+
+
+def _engine_arguments(url: str, poolclass, kwargs: dict) -> dict:
+    """create_engine arguments: pool_settings and poolclass (if the url can be pooled) overridden by kwargs"""
+    arguments = {"echo": os.environ.get("DB_ECHO", "0") == "1"}
+    if not _is_memory_sqlite(url):
+        arguments.update(pool_settings(), poolclass=poolclass)
+    if url.startswith("sqlite"):
+        # pooled connections (e.g. of a request session) may be used and closed by different threads
+        arguments["connect_args"] = {"check_same_thread": False}
+
+    return {**arguments, **kwargs}
+
+
+def _is_memory_sqlite(url: str) -> bool:
+    return url.startswith("sqlite") and url.split("://", 1)[1] in ("", "/:memory:")
+
+
+def _process_engine(kind: str, factory):
+    """Engine of a kind for the current process, created with factory if there's none yet"""
+    with _engines_lock:
+        pid, engine = _engines.get(kind, (None, None))
+        if pid != os.getpid():
+            engine = factory()
+            _engines[kind] = (os.getpid(), engine)
 
-engine_params = f"mysql://{user}:{password}@{host}:{port}/{database}"
-engine = create_engine(engine_params, echo=False)
+        return engine
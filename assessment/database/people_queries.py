@@ -0,0 +1,579 @@
+import json
+from typing import Iterator, Union
+
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import desc, func, select
+
+from database.data_schema import (
+    CityCount,
+    InterestCount,
+    InterestRollup,
+    LoadWatermark,
+    PeopleAggregate,
+    PeopleRollup,
+    PeopleStatsSnapshot,
+    Person,
+    PersonInterest,
+)
+from database.db_config import get_engine, session_scope
+from monitoring.metrics import instrumented
+
+# id of the single people_aggregate row
+AGGREGATE_ID = 1
+# dimensions of the people_rollup cube, grouped stats group by one of them
+ROLLUP_DIMENSIONS = ["city", "title", "age_bucket"]
+# person columns with content (hashed to detect changed rows)
+PERSON_COLUMNS = [
+    col.name
+    for col in Person.__table__.columns
+    if col.name not in ("id", "row_hash", "fingerprint")
+]
+# person columns returned by people queries (iter_people_batches)
+PEOPLE_COLUMNS = ["id"] + PERSON_COLUMNS
+# rows fetched at a time from the server-side cursor of iter_people_batches
+PEOPLE_BATCH_SIZE = 1000
+
+
+class PeopleQueries:
+    """Read-only queries of the people data (stats, snapshots and people), without pandas: the API imports this module
+    only, so its workers start without loading pandas/numpy. PeopleDB (database_handler) adds the loads
+    """
+
+    def __init__(self, db_engine: Union[Engine, None] = None) -> None:
+        """
+        :param db_engine: The engine, defaults to the engine of the process (db_config.get_engine)
+        """
+        self.engine = db_engine or get_engine()
+
+    def last_watermark(
+        self, full_loads_only: bool = False
+    ) -> Union[LoadWatermark, None]:
+        """Query the watermark of the last load
+
+        :param full_loads_only: If True, ignore 'append' loads (they hold only part of the data), defaults to False
+        :return: The last LoadWatermark, or None if nothing was loaded yet
+        """
+        with session_scope(self.engine) as session:
+            query = session.query(LoadWatermark)
+            if full_loads_only:
+                query = query.filter(LoadWatermark.mode != "append")
+
+            return query.order_by(LoadWatermark.id.desc()).first()
+
+    @instrumented()
+    def load_generation(self) -> int:
+        """Query the load generation: id of the last load watermark, which changes with every load (0 if nothing was
+        loaded yet). Cheap to query, so caches of the data can check if it changed
+
+        :return: The load generation
+        """
+        with session_scope(self.engine) as session:
+            return session.execute(select(func.max(LoadWatermark.id))).scalar() or 0
+
+    @instrumented()
+    def is_loaded(self, input_key: str, delete_missing: bool = False) -> bool:
+        """Check if the data stored is the one of a given input, i.e. the last load recorded the same input key (e.g.
+        CSVHandler.cache_key: hash of the raw file and the cleaning configuration) and covers the load asked for (see
+        covers_load)
+
+        :param input_key: The input key
+        :param delete_missing: If the input would be loaded with delete_missing, defaults to False
+        :return: True if loading the input again would change nothing
+        """
+        last_watermark = self.last_watermark()
+
+        return (
+            covers_load(last_watermark, delete_missing)
+            and last_watermark.input_key == input_key
+        )
+
+    @instrumented()
+    def stats(self, top_x: int = 5) -> dict:
+        """Query all people stats in a single session: max, min, and average age; city with most people; and the
+        top x interests. They are read from the people aggregates kept up to date by the loads, so the cost doesn't
+        depend on the number of people, and only two statements are sent (one for the age aggregates plus the top city,
+        one for the interests ranking)
+
+        :param top_x: How many interests to get, defaults to 5
+        :return: Dictionary with 'max_age', 'min_age', 'avg_age', 'city_with_most_people' and 'top_interests' keys
+        """
+        with session_scope(self.engine) as session:
+            return query_stats(session, top_x)
+
+    @instrumented()
+    def grouped_stats(self, by: str = "city", top_x: int = 5, **filters) -> list:
+        """Query the people stats of each city, title or age bucket from the people_rollup cube kept up to date by the
+        loads: groups add up their cells, so the cost depends on the size of the cube, not on the number of people
+
+        :param by: 'city', 'title' or 'age_bucket', defaults to 'city'
+        :param top_x: How many interests to get per group, defaults to 5
+        :param filters: Only people of a city, title and/or age_bucket (see grouped_stats_statement)
+        :return: List of dictionaries as returned by grouped_stats_rows
+        """
+        with session_scope(self.engine) as session:
+            return grouped_stats_rows(
+                session.execute(grouped_stats_statement(by, **filters)).all(),
+                session.execute(grouped_interests_statement(by, **filters)).all(),
+                top_x,
+            )
+
+    @instrumented()
+    def stats_snapshot(
+        self, top_x: int = 5, load_id: Union[int, None] = None
+    ) -> Union[dict, None]:
+        """Read the stats computed at the end of a load (a primary key lookup), instead of computing them
+
+        :param top_x: How many interests to get (up to the snapshot_top_x of the load), defaults to 5
+        :param load_id: The load watermark id (e.g. load_generation()), defaults to the last load
+        :return: Dictionary as returned by stats, None if the load has no snapshot or one with fewer interests
+        """
+        with session_scope(self.engine) as session:
+            if load_id is None:
+                load_id = session.execute(select(func.max(LoadWatermark.id))).scalar()
+            snapshot = session.get(PeopleStatsSnapshot, load_id) if load_id else None
+
+            return snapshot_stats(snapshot, top_x)
+
+    @instrumented()
+    def stats_history(self, limit: int = 10) -> list:
+        """Read the stats snapshots of the last loads
+
+        :param limit: How many loads to get, defaults to 10
+        :return: List of dictionaries with 'load_id', 'created_at' and the snapshot stats (all its top interests), from
+        the last load
+        """
+        with session_scope(self.engine) as session:
+            snapshots = session.execute(stats_history_statement(limit)).scalars()
+
+            return stats_history_rows(snapshots)
+
+    @instrumented()
+    def max_age(self) -> int:
+        """Open a session to query the maximum age of people
+
+        :return: The maximum age
+        """
+        with session_scope(self.engine) as session:
+            return session.query(func.max(Person.age)).scalar()
+
+    @instrumented()
+    def min_age(self) -> int:
+        """Open a session to query the minimum age of people
+
+        :return: The minimum age
+        """
+        with session_scope(self.engine) as session:
+            return session.query(func.min(Person.age)).scalar()
+
+    @instrumented()
+    def avg_age(self) -> float:
+        """Open a session to query the average age of people
+
+        :return: The average age
+        """
+        with session_scope(self.engine) as session:
+            result = session.query(func.avg(Person.age).label("avg_age")).first()
+
+        return result[0]
+
+    @instrumented()
+    def top_x_interests(self, x: int = 1, as_dict: bool = False) -> Union[dict, list]:
+        """Select the top x interests among interest 1, 2, 3, and 4
+
+        :param x: How many interests to get, defaults to 1
+        :param as_dict: If full dictionary should be returned, defaults to False
+        :return: Dictionary with {'interest': 'quantity', ...} if as_dict == True, otherwise just the list of top x interests
+        """
+        # rank the interests in the database: only x (interest, quantity) rows reach python
+        with session_scope(self.engine) as session:
+            top_interests = session.execute(top_interests_statement(x)).all()
+
+        # store the interests in a dictionary
+        result = {interest: quantity for interest, quantity in top_interests}
+
+        if as_dict:
+            return result
+        return list(result.keys())
+
+    @instrumented()
+    def most_frequent_city(self) -> str:
+        """Query top city of most people
+
+        :return: The most frequent city of the data
+        """
+        with session_scope(self.engine) as session:
+            result = (
+                session.query(
+                    func.count(Person.city).label("person_count"), Person.city
+                )
+                .group_by(Person.city)
+                .order_by(desc("person_count"))
+                .first()
+            )
+
+        return result[1]
+
+    @instrumented()
+    def people_with_interest(self, interest: str) -> list:
+        """Query the people that have a given interest (any of interest 1, 2, 3, and 4) using the person_interest index
+
+        :param interest: The interest to search for
+        :return: List of Person objects ordered by id
+        """
+        with session_scope(self.engine) as session:
+            return (
+                session.query(Person)
+                .filter(
+                    Person.id.in_(
+                        select(PersonInterest.person_id).where(
+                            PersonInterest.interest == interest
+                        )
+                    )
+                )
+                .order_by(Person.id)
+                .all()
+            )
+
+    def iter_people_batches(
+        self, batch_size: int = PEOPLE_BATCH_SIZE, **filters
+    ) -> Iterator[list]:
+        """Stream the people matching some filters (see people_statement), batch_size rows at a time from a server-side
+        cursor (stream_results), so memory is bounded by batch_size even when exporting the whole table
+
+        :param batch_size: Rows per batch, defaults to PEOPLE_BATCH_SIZE
+        :param filters: people_statement filters (e.g. city, min_age, after_id, limit)
+        :yield: Lists of rows (PEOPLE_COLUMNS values) ordered by id
+        """
+        with self.engine.connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(
+                people_statement(**filters)
+            )
+            yield from result.partitions(batch_size)
+
+
+def query_stats(executor: Union[Session, Connection], top_x: int) -> dict:
+    """Query all people stats from the people aggregates with two statements (see PeopleQueries.stats), or from all the
+    rows if there are no aggregates (see query_full_stats)
+
+    :param executor: The session or connection to execute the statements with
+    :param top_x: How many interests to get
+    :return: Dictionary with 'max_age', 'min_age', 'avg_age', 'city_with_most_people' and 'top_interests' keys
+    """
+    aggregates = executor.execute(
+        aggregate_stats_statement().add_columns(
+            aggregate_top_city_statement().scalar_subquery()
+        )
+    ).one_or_none()
+    if aggregates is None:
+        return query_full_stats(executor, top_x)
+
+    max_age, min_age, age_sum, age_count, city = aggregates
+    top_interests = executor.execute(aggregate_top_interests_statement(top_x)).all()
+
+    return {
+        "max_age": max_age,
+        "min_age": min_age,
+        "avg_age": age_sum / age_count if age_count else None,
+        "city_with_most_people": city,
+        "top_interests": [interest for interest, _ in top_interests],
+    }
+
+
+def query_full_stats(executor: Union[Session, Connection], top_x: int) -> dict:
+    """Query all people stats from all the rows with two statements (aggregates computed by the database)
+
+    :param executor: The session or connection to execute the statements with
+    :param top_x: How many interests to get
+    :return: Dictionary with 'max_age', 'min_age', 'avg_age', 'city_with_most_people' and 'top_interests' keys
+    """
+    max_age, min_age, avg_age, city = executor.execute(
+        age_stats_statement().add_columns(top_city_statement().scalar_subquery())
+    ).one()
+    top_interests = executor.execute(top_interests_statement(top_x)).all()
+
+    return {
+        "max_age": max_age,
+        "min_age": min_age,
+        "avg_age": float(avg_age) if avg_age is not None else None,
+        "city_with_most_people": city,
+        "top_interests": [interest for interest, _ in top_interests],
+    }
+
+
+def snapshot_stats(
+    snapshot: Union[PeopleStatsSnapshot, None], top_x: int
+) -> Union[dict, None]:
+    """Stats of a snapshot, as returned by PeopleQueries.stats
+
+    :param snapshot: The snapshot (PeopleStatsSnapshot, or a result row of its columns), can be None
+    :param top_x: How many interests to get
+    :return: The stats dictionary, None if there's no snapshot or it has fewer than top_x interests ranked
+    """
+    if snapshot is None or snapshot.top_x < top_x:
+        return None
+
+    return {
+        "max_age": snapshot.max_age,
+        "min_age": snapshot.min_age,
+        "avg_age": snapshot.avg_age,
+        "city_with_most_people": snapshot.city_with_most_people,
+        "top_interests": json.loads(snapshot.top_interests)[:top_x],
+    }
+
+
+def stats_history_statement(limit: int):
+    """Select the stats snapshots of the last loads, from the last one
+
+    :param limit: How many loads to get
+    :return: The select statement
+    """
+    return (
+        select(PeopleStatsSnapshot)
+        .order_by(PeopleStatsSnapshot.load_id.desc())
+        .limit(limit)
+    )
+
+
+def stats_history_rows(snapshots: Iterator) -> list:
+    """Stats of the snapshots of stats_history_statement
+
+    :param snapshots: The snapshots (PeopleStatsSnapshot, or result rows of its columns)
+    :return: List of dictionaries with 'load_id', 'created_at' and the snapshot stats (all its top interests)
+    """
+    return [
+        {
+            "load_id": snapshot.load_id,
+            "created_at": snapshot.created_at,
+            **snapshot_stats(snapshot, snapshot.top_x),
+        }
+        for snapshot in snapshots
+    ]
+
+
+def covers_load(
+    watermark: Union[LoadWatermark, None], delete_missing: bool = False
+) -> bool:
+    """Check if loading the data of a watermark again (as an 'upsert') would change nothing: the watermark is the last
+    one and it isn't an 'append' (the rows stored before it are still there). With delete_missing, it must be a
+    'replace' or a delete_missing 'upsert' too (else other stored rows may be left to delete)
+
+    :param watermark: The last load watermark (None if nothing was loaded yet)
+    :param delete_missing: If the data would be loaded with delete_missing, defaults to False
+    :return: True if the load is covered by the watermark
+    """
+    if watermark is None or watermark.mode == "append":
+        return False
+
+    return not delete_missing or watermark.mode == "replace" or watermark.delete_missing
+
+
+def grouped_stats_rows(stats_rows: list, interest_rows: list, top_x: int) -> list:
+    """Combine the rows of grouped_stats_statement and grouped_interests_statement into the stats of each group
+
+    :param stats_rows: The grouped_stats_statement rows
+    :param interest_rows: The grouped_interests_statement rows
+    :param top_x: How many interests to keep per group
+    :return: List of dictionaries with 'group' (the city, title or age bucket, None for people without one),
+    'person_count', 'max_age', 'min_age', 'avg_age' and 'top_interests' keys, ordered by group
+    """
+    top_interests = {}
+    for group, interest, _ in interest_rows:
+        interests = top_interests.setdefault(group, [])
+        if len(interests) < top_x:
+            interests.append(interest)
+
+    return [
+        {
+            "group": group,
+            "person_count": int(person_count),
+            "max_age": max_age,
+            "min_age": min_age,
+            "avg_age": int(age_sum) / int(age_count) if age_count else None,
+            "top_interests": top_interests.get(group, []),
+        }
+        for group, person_count, age_count, age_sum, min_age, max_age in stats_rows
+    ]
+
+
+def grouped_stats_statement(by: str, **filters):
+    """Build the statement of the people aggregates of each group from the people_rollup cells
+
+    :param by: 'city', 'title' or 'age_bucket'
+    :param filters: city, title and/or age_bucket values the cells must have (None matches anything)
+    :return: A select of (group, person count, age count, age sum, min age, max age) rows ordered by group
+    """
+    group = _rollup_group(PeopleRollup, by)
+    statement = (
+        select(
+            group,
+            func.sum(PeopleRollup.person_count),
+            func.sum(PeopleRollup.age_count),
+            func.sum(PeopleRollup.age_sum),
+            func.min(PeopleRollup.min_age),
+            func.max(PeopleRollup.max_age),
+        )
+        .group_by(group)
+        .order_by(group)
+    )
+
+    return _rollup_filters(statement, PeopleRollup, filters)
+
+
+def grouped_interests_statement(by: str, **filters):
+    """Build the statement that ranks the interests of each group from the interest_rollup cells
+
+    :param by: 'city', 'title' or 'age_bucket'
+    :param filters: As in grouped_stats_statement
+    :return: A select of (group, interest, quantity) rows ordered by group and quantity
+    """
+    group = _rollup_group(InterestRollup, by)
+    quantity = func.sum(InterestRollup.quantity)
+    statement = (
+        select(group, InterestRollup.interest, quantity)
+        .group_by(group, InterestRollup.interest)
+        .order_by(group, quantity.desc(), InterestRollup.interest)
+    )
+
+    return _rollup_filters(statement, InterestRollup, filters)
+
+
+def _rollup_group(table, by: str):
+    if by not in ROLLUP_DIMENSIONS:
+        raise ValueError(f"'{by}' is not valid for by")
+
+    return getattr(table, by)
+
+
+def _rollup_filters(statement, table, filters: dict):
+    for dimension, value in filters.items():
+        if dimension not in ROLLUP_DIMENSIONS:
+            raise ValueError(f"'{dimension}' is not a rollup dimension")
+        if value is not None:
+            statement = statement.where(getattr(table, dimension) == value)
+
+    return statement
+
+
+def people_statement(
+    city: Union[str, None] = None,
+    min_age: Union[int, None] = None,
+    max_age: Union[int, None] = None,
+    title: Union[str, None] = None,
+    interest: Union[str, None] = None,
+    after_id: Union[int, None] = None,
+    limit: Union[int, None] = None,
+):
+    """Build the statement of the people matching some filters (None matches anything), ordered by id for keyset
+    pagination: the next page starts after the id of the last row of the page. Pages are primary key ranges, as fast
+    deep in the table as at its start (OFFSET reads and skips every row before the page)
+
+    :param city: The city, defaults to None
+    :param min_age: The minimum age, defaults to None
+    :param max_age: The maximum age, defaults to None
+    :param title: The title (e.g. 'dr' or 'unknown'), defaults to None
+    :param interest: An interest (any of interest 1, 2, 3, and 4, using the person_interest index), defaults to None
+    :param after_id: Only people with a greater id, defaults to None
+    :param limit: Maximum number of people, defaults to None (all of them)
+    :return: A select of PEOPLE_COLUMNS rows
+    """
+    statement = select(*(getattr(Person, col) for col in PEOPLE_COLUMNS)).order_by(
+        Person.id
+    )
+    if city is not None:
+        statement = statement.where(Person.city == city)
+    if min_age is not None:
+        statement = statement.where(Person.age >= min_age)
+    if max_age is not None:
+        statement = statement.where(Person.age <= max_age)
+    if title is not None:
+        statement = statement.where(Person.title == title)
+    if interest is not None:
+        statement = statement.where(
+            Person.id.in_(
+                select(PersonInterest.person_id).where(
+                    PersonInterest.interest == interest
+                )
+            )
+        )
+    if after_id is not None:
+        statement = statement.where(Person.id > after_id)
+    if limit is not None:
+        statement = statement.limit(limit)
+
+    return statement
+
+
+def age_stats_statement():
+    """Build the statement of the age aggregates
+
+    :return: A select of one (max age, min age, average age) row
+    """
+    return select(func.max(Person.age), func.min(Person.age), func.avg(Person.age))
+
+
+def top_city_statement():
+    """Build the statement of the city with most people (ties broken by city name)
+
+    :return: A select of one (city) row
+    """
+    return (
+        select(Person.city)
+        .where(Person.city.isnot(None))
+        .group_by(Person.city)
+        .order_by(func.count().desc(), Person.city)
+        .limit(1)
+    )
+
+
+def top_interests_statement(x: int):
+    """Build the statement that ranks interests 1, 2, 3, and 4 together from the person_interest table, so the
+    counting happens in the database over the interest index
+
+    :param x: How many interests to rank
+    :return: A select of (interest, quantity) rows ordered by quantity
+    """
+    return (
+        select(PersonInterest.interest, func.count().label("quantity"))
+        .group_by(PersonInterest.interest)
+        .order_by(desc("quantity"), PersonInterest.interest)
+        .limit(x)
+    )
+
+
+def aggregate_stats_statement():
+    """Build the statement of the age aggregates from the people aggregates
+
+    :return: A select of one (max age, min age, age sum, age count) row, no row if there are no aggregates
+    """
+    return select(
+        PeopleAggregate.max_age,
+        PeopleAggregate.min_age,
+        PeopleAggregate.age_sum,
+        PeopleAggregate.age_count,
+    ).where(PeopleAggregate.id == AGGREGATE_ID)
+
+
+def aggregate_top_city_statement():
+    """Build the statement of the city with most people from the city counts (ties broken by city name)
+
+    :return: A select of one (city) row
+    """
+    return (
+        select(CityCount.city)
+        .order_by(CityCount.person_count.desc(), CityCount.city)
+        .limit(1)
+    )
+
+
+def aggregate_top_interests_statement(x: int):
+    """Build the statement that ranks interests from the interest counts
+
+    :param x: How many interests to rank
+    :return: A select of (interest, quantity) rows ordered by quantity
+    """
+    return (
+        select(InterestCount.interest, InterestCount.quantity)
+        .order_by(InterestCount.quantity.desc(), InterestCount.interest)
+        .limit(x)
+    )
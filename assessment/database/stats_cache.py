@@ -0,0 +1,189 @@
+import asyncio
+import threading
+import time
+from collections import Counter
+from typing import Callable, Union
+
+from database.async_database_handler import AsyncPeopleDB
+from database.people_queries import PeopleQueries
+
+
+class StatsCache:
+    """In-process cache of PeopleQueries.stats. The data only changes when it's loaded again (run.py), so stats are kept
+    for ttl seconds, then revalidated against the load generation (id of the last load watermark, a primary key
+    lookup) and only computed again if there was a load since. Loads through the same people_db invalidate them right
+    away. Computation is single-flight: when many requests miss at once, one of them queries the stats and the others
+    wait for its result instead of querying the database too. With use_snapshot, the stats are read from the snapshot
+    written by the load (a primary key lookup) rather than computed. get is for a PeopleQueries (or PeopleDB) and aget
+    (awaitable) for an AsyncPeopleDB
+    """
+
+    def __init__(
+        self,
+        people_db: Union[PeopleQueries, AsyncPeopleDB],
+        ttl: float = 60.0,
+        top_x: int = 5,
+        clock: Callable[[], float] = time.monotonic,
+        use_snapshot: bool = False,
+        live_fallback: bool = True,
+    ) -> None:
+        """
+        :param people_db: The database to query (sync or async)
+        :param ttl: Seconds the stats are served without checking the database, defaults to 60.0
+        :param top_x: Number of top interests of the stats, defaults to 5
+        :param clock: Function returning the current time in seconds, defaults to time.monotonic
+        :param use_snapshot: If the stats are read from the stats snapshot of the load, defaults to False (computed)
+        :param live_fallback: With use_snapshot, compute the stats if the load has no snapshot, otherwise raise
+        LookupError, defaults to True
+        """
+        if ttl < 0:
+            raise ValueError("ttl can't be negative")
+
+        self.people_db = people_db
+        self.ttl = ttl
+        self.top_x = top_x
+        self.clock = clock
+        self.use_snapshot = use_snapshot
+        self.live_fallback = live_fallback
+        # 'hits' (served from cache), 'misses' (stats queried), 'snapshots' (misses read from a stats snapshot) and
+        # 'revalidations' (load generation queried)
+        self.counters = Counter(hits=0, misses=0, snapshots=0, revalidations=0)
+
+        # (stats, load generation, time they were last checked), replaced as a whole so readers never see a mix
+        self._entry = None
+        self._lock = threading.Lock()
+        self._counters_lock = threading.Lock()
+        # asyncio locks can't be shared between event loops, so aget creates one per loop
+        self._async_lock = None
+        self._async_lock_loop = None
+
+        # loads through the same PeopleDB (same process) drop the stats right away instead of after ttl
+        if hasattr(people_db, "load_listeners"):
+            people_db.load_listeners.append(self.invalidate)
+
+    def get(self) -> tuple:
+        """Get the stats, from the cache if they are up to date
+
+        :return: Tuple of (stats dictionary as returned by PeopleQueries.stats, load generation they were computed for)
+        """
+        stats, generation = self._fresh()
+        if stats is not None:
+            self._count("hits")
+            return stats, generation
+
+        # single-flight: whoever gets the lock first refreshes the cache, the others find it fresh once they get it
+        with self._lock:
+            stats, generation = self._fresh()
+            if stats is not None:
+                self._count("hits")
+                return stats, generation
+
+            self._count("revalidations")
+            generation = self.people_db.load_generation()
+            if self._entry is not None and self._entry[1] == generation:
+                self._count("hits")
+                stats = self._entry[0]
+            else:
+                self._count("misses")
+                stats = None
+                if self.use_snapshot:
+                    stats = self.people_db.stats_snapshot(self.top_x, generation)
+                if stats is None:
+                    self._check_live_fallback(generation)
+                    stats = self.people_db.stats(top_x=self.top_x)
+                else:
+                    self._count("snapshots")
+            self._entry = (stats, generation, self.clock())
+
+            return stats, generation
+
+    async def aget(self) -> tuple:
+        """Async version of get: with an AsyncPeopleDB nothing blocks the event loop, with a PeopleQueries get runs
+        in a thread
+
+        :return: Tuple of (stats dictionary as returned by PeopleQueries.stats, load generation they were computed for)
+        """
+        if not isinstance(self.people_db, AsyncPeopleDB):
+            return await asyncio.to_thread(self.get)
+
+        stats, generation = self._fresh()
+        if stats is not None:
+            self._count("hits")
+            return stats, generation
+
+        async with self._get_async_lock():
+            stats, generation = self._fresh()
+            if stats is not None:
+                self._count("hits")
+                return stats, generation
+
+            self._count("revalidations")
+            generation = await self.people_db.load_generation()
+            if self._entry is not None and self._entry[1] == generation:
+                self._count("hits")
+                stats = self._entry[0]
+            else:
+                self._count("misses")
+                stats = None
+                if self.use_snapshot:
+                    stats = await self.people_db.stats_snapshot(self.top_x, generation)
+                if stats is None:
+                    self._check_live_fallback(generation)
+                    stats = await self.people_db.stats(top_x=self.top_x)
+                else:
+                    self._count("snapshots")
+            self._entry = (stats, generation, self.clock())
+
+            return stats, generation
+
+    def invalidate(self) -> None:
+        """Drop the cached stats (e.g. right after a load in the same process), the next get queries them again"""
+        with self._lock:
+            self._entry = None
+
+    def info(self) -> dict:
+        """Cache counters and state
+
+        :return: Dictionary with 'hits', 'misses', 'snapshots', 'revalidations', 'ttl' and the cached 'generation' (None
+        if empty)
+        """
+        with self._counters_lock:
+            info = dict(self.counters)
+
+        entry = self._entry
+
+        return {**info, "ttl": self.ttl, "generation": entry and entry[1]}
+
+    def etag(self, generation: int) -> str:
+        """HTTP ETag of the stats of a load generation
+
+        :param generation: The load generation (as returned by get)
+        :return: The quoted ETag
+        """
+        return f'"stats-{generation}-{self.top_x}"'
+
+    def _fresh(self) -> tuple:
+        """The cached (stats, generation) if checked less than ttl seconds ago, (None, None) otherwise"""
+        entry = self._entry
+        if entry is None or self.clock() - entry[2] >= self.ttl:
+            return None, None
+
+        return entry[0], entry[1]
+
+    def _check_live_fallback(self, generation: int) -> None:
+        """Raise LookupError if the stats of a load without snapshot can't be computed instead"""
+        if self.use_snapshot and not self.live_fallback:
+            raise LookupError(f"No stats snapshot of load {generation}")
+
+    def _get_async_lock(self) -> asyncio.Lock:
+        """The single-flight lock of aget for the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self._async_lock_loop is not loop:
+            self._async_lock = asyncio.Lock()
+            self._async_lock_loop = loop
+
+        return self._async_lock
+
+    def _count(self, counter: str) -> None:
+        with self._counters_lock:
+            self.counters[counter] += 1
@@ -1,6 +1,22 @@
 from typing import Union
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from monitoring.metrics import instrumented
+
+# characters removed by str.strip() among ASCII (str.isspace() is also true for the \x1c to \x1f separators)
+ASCII_WHITESPACE = " \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f"
+# rows checked by compact_dtypes before counting the distinct values of a whole str column
+CATEGORY_SAMPLE_SIZE = 10_000
+# columns identifying a person: rows with the same values are the same person (see drop_duplicate_rows)
+FINGERPRINT_COLUMNS = ["name", "phone_number", "city"]
+# a phone number and its extension (e.g. 'x123' or 'ext. 123'), only matched on the numbers with an 'x'
+PHONE_EXTENSION_REGEX = (
+    r"(?i)^(?P<number>.*?)\s*(?:(?:x|ext\.?)\s*(?P<extension>\d+))?\s*$"
+)
 
 
 def list_column_types(df: pd.DataFrame) -> list:
@@ -15,8 +31,9 @@ def list_column_types(df: pd.DataFrame) -> list:
     return info
 
 
+@instrumented()
 def update_column_types(df: pd.DataFrame, types_dict: dict = {}) -> pd.DataFrame:
-    """Given a dictionary in the form {'column name': 'new data type', ...} sets 'column_name' type to 'new data type' 
+    """Given a dictionary in the form {'column name': 'new data type', ...} sets 'column_name' type to 'new data type'
 
     :param df: The dataframe to update its columns types
     :param types_dict: dictionary in the form {'column name': 'new data type', ...}, defaults to {}
@@ -28,6 +45,7 @@ def update_column_types(df: pd.DataFrame, types_dict: dict = {}) -> pd.DataFrame
     return df
 
 
+@instrumented()
 def rename_columns(
     df: pd.DataFrame, cols_dict: dict = {}, rules_to_apply: list = []
 ) -> pd.DataFrame:
@@ -49,6 +67,7 @@ def rename_columns(
     return df
 
 
+@instrumented()
 def drop_null_columns(
     df: pd.DataFrame,
     null_percentage_threshold: float = 1.0,
@@ -93,6 +112,25 @@ def drop_null_columns(
     return df
 
 
+def null_columns_to_drop(
+    null_counts: pd.Series, entries_count: int, null_percentage_threshold: float = 1.0
+) -> list:
+    """Given null counts per column computed beforehand (e.g. summed over the chunks of a file), return the columns
+    that drop_null_columns (info_only=False) would drop from the whole data
+
+    :param null_counts: Series of null elements count indexed by column name
+    :param entries_count: Total number of rows the counts were computed over
+    :param null_percentage_threshold: The threshold of null elements from 0.0 to 1.0, defaults to 1.0
+    :return: List of the columns names to drop
+    """
+    # same threshold of drop_null_columns: columns are kept if they have at least 'threshold' non-null elements
+    threshold = int(entries_count * (1 - null_percentage_threshold))
+    non_null_counts = entries_count - null_counts
+
+    return list(non_null_counts[non_null_counts < threshold].index)
+
+
+@instrumented()
 def drop_null_rows(
     df: pd.DataFrame,
     null_count: int,
@@ -130,28 +168,143 @@ def drop_null_rows(
     return df
 
 
+@instrumented()
 def data_to_lower_case(df: pd.DataFrame) -> pd.DataFrame:
     """Update all columns values to lower case if they are of type str
 
     :param df: The dataframe to lower case
     :return: The updated dataframe
     """
-    df = df.applymap(lambda x: x.lower() if isinstance(x, str) else x)
-
-    return df
+    return _update_str_values(df, lower=True, strip=False)
 
 
+@instrumented()
 def trim_data(df: pd.DataFrame) -> pd.DataFrame:
     """Remove whitespace (begining and and) of dataframe values that are of type str
 
     :param df: The dataframe to be trimmed
     :return: The updated dataframe
     """
-    df = df.applymap(lambda x: x.strip() if isinstance(x, str) else x)
+    return _update_str_values(df, lower=False, strip=True)
+
+
+@instrumented()
+def normalize_strings(
+    df: pd.DataFrame,
+    string_dtype: Union[None, str] = None,
+    lower: bool = True,
+    strip: bool = True,
+    inplace: bool = False,
+) -> pd.DataFrame:
+    """Lower case and trim dataframe values that are of type str in a single vectorized pass (same result of
+    data_to_lower_case followed by trim_data). Optionally convert the string columns to a pandas string dtype
+    (e.g. 'string[pyarrow]') so later string operations run on Arrow memory
+
+    :param df: The dataframe to normalize
+    :param string_dtype: The dtype for columns with only str values, defaults to None (keep object)
+    :param lower: If str values should be set to lower case, defaults to True
+    :param strip: If str values should be trimmed, defaults to True
+    :param inplace: If True, the updated columns replace the ones of df instead of a copy, defaults to False
+    :return: The updated dataframe
+    """
+    return _update_str_values(df, lower, strip, string_dtype, inplace)
+
+
+def _update_str_values(
+    df: pd.DataFrame,
+    lower: bool,
+    strip: bool,
+    string_dtype: Union[None, str] = None,
+    inplace: bool = False,
+) -> pd.DataFrame:
+    """Lower case and/or trim the str values of object/string columns with vectorized operations. Any other value
+    (null, number, ...) is kept as is, like applymap(lambda x: ... if isinstance(x, str) else x) would do
+
+    :param df: The dataframe to update
+    :param lower: If str values should be set to lower case
+    :param strip: If str values should be trimmed
+    :param string_dtype: The dtype for columns with only str values, defaults to None (keep object)
+    :param inplace: If True, the updated columns replace the ones of df instead of a copy, defaults to False
+    :return: The updated dataframe
+    """
+    updated = {}
+    for col, data_type in df.dtypes.items():
+        if not pd.api.types.is_string_dtype(data_type):
+            continue
+
+        values = df[col]
+        if string_dtype and pd.api.types.infer_dtype(values) == "string":
+            values = values.astype(string_dtype)
+
+        if isinstance(values.dtype, pd.StringDtype):
+            # string dtype columns only hold str (or missing) values: .str runs on all of them at once
+            updated[col] = _transform_str_accessor(values, lower, strip)
+            continue
+
+        # object columns: transform each distinct value only once (columns are very repetitive) and broadcast the
+        # results back with the factorized codes. Nulls have code -1 and are taken back from the column
+        codes, uniques = pd.factorize(values)
+        if not len(uniques):
+            continue
+        transformed = _transform_unique_values(uniques, lower, strip)
+        if transformed is None:
+            continue
+        updated[col] = pd.Series(
+            np.where(codes >= 0, transformed.take(codes), values.to_numpy()),
+            index=values.index,
+        )
+
+    if not inplace:
+        return df.assign(**updated)
+
+    for col, values in updated.items():
+        df[col] = values
 
     return df
 
 
+def _transform_unique_values(uniques: np.ndarray, lower: bool, strip: bool):
+    """Lower case and/or trim an array of distinct values. ASCII-only str arrays run on Arrow compute kernels (with the
+    exact whitespace set of str.strip); other arrays fall back to pandas .str, keeping non-str values as they are
+
+    :param uniques: The distinct non-null values of a column
+    :param lower: If str values should be set to lower case
+    :param strip: If str values should be trimmed
+    :return: Object array with the transformed values, or None if there are no str values
+    """
+    try:
+        values = pa.array(uniques, type=pa.string())
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # not only str values
+        values = None
+
+    if values is not None and pc.all(pc.string_is_ascii(values)).as_py():
+        if lower:
+            values = pc.ascii_lower(values)
+        if strip:
+            values = pc.ascii_trim(values, characters=ASCII_WHITESPACE)
+        return values.to_numpy(zero_copy_only=False)
+
+    uniques = pd.Series(uniques, dtype=object)
+    try:
+        transformed = _transform_str_accessor(uniques, lower, strip)
+    except AttributeError:
+        # .str is only available if there are str values, so there's nothing to update
+        return None
+    # non-str values become null with .str, so they are taken back as they were
+    return transformed.where(transformed.notna(), uniques).to_numpy()
+
+
+def _transform_str_accessor(values: pd.Series, lower: bool, strip: bool) -> pd.Series:
+    """Lower case and/or trim a column with its .str accessor"""
+    if lower:
+        values = values.str.lower()
+    if strip:
+        values = values.str.strip()
+    return values
+
+
+@instrumented()
 def split_titles_from_name(df: pd.DataFrame) -> pd.DataFrame:
     """Search for names with titles (e.g. dr. john smith), split it and create another column
     named 'title'.
@@ -165,6 +318,8 @@ def split_titles_from_name(df: pd.DataFrame) -> pd.DataFrame:
     title_name_df = df[df["name"].str.contains(regex, na=False)].name.str.split(
         ".", expand=True, n=1
     )
+    # no name has a title (e.g. a partition of the data): the split has no columns at all
+    title_name_df = title_name_df.reindex(columns=[0, 1])
     # updated dataframe with the two new columns
     df["title"] = title_name_df[0]
     df["name2"] = title_name_df[1]
@@ -182,3 +337,285 @@ def split_titles_from_name(df: pd.DataFrame) -> pd.DataFrame:
 
     # TODO one interesting thing would be to create categories with titles unique values
     return df
+
+
+@instrumented()
+def normalize_phone_numbers(
+    df: pd.DataFrame,
+    column: str = "phone_number",
+    country_code: str = "1",
+    national_digits: int = 10,
+) -> pd.DataFrame:
+    """Canonicalize a column of phone numbers to '+<country code><number>' with vectorized Arrow and numpy operations, e.g.
+    '(555) 123 4567', '1-555-123-4567', '001.555.123.4567' and '+1 555.123.4567' are all '+15551234567'. Extensions
+    are kept as an 'x<digits>' suffix, numbers of other lengths keep their digits only (and their '+') and values
+    without digits become null
+
+    :param df: The dataframe with the phone numbers (nothing is done if it doesn't have the column)
+    :param column: The phone numbers column, defaults to 'phone_number'
+    :param country_code: Country code of the numbers, defaults to '1'
+    :param national_digits: Digits of a number without its country code, defaults to 10
+    :return: The updated dataframe
+    """
+    if column not in df.columns:
+        return df
+
+    values = df[column]
+    number = _arrow_strings(values)
+    extension = pa.nulls(len(number), pa.string())
+    # the regex is much slower than the other kernels: only run on the numbers that can have an extension
+    has_extension = pc.fill_null(
+        pc.match_substring(number, "x", ignore_case=True), False
+    )
+    if pc.any(has_extension).as_py():
+        parts = pc.extract_regex(
+            pc.filter(number, has_extension), PHONE_EXTENSION_REGEX
+        )
+        number = pc.replace_with_mask(
+            number, has_extension, pc.struct_field(parts, [0])
+        )
+        extension = pc.replace_with_mask(
+            extension, has_extension, pc.struct_field(parts, [1])
+        )
+    digits = _keep_digits(number)
+    length = pc.utf8_length(digits)
+
+    # national numbers: alone, after the country code or after the international prefix and the country code
+    is_national = pc.equal(length, national_digits)
+    for prefix in (country_code, "00" + country_code):
+        is_national = pc.or_(
+            is_national,
+            pc.and_(
+                pc.equal(length, national_digits + len(prefix)),
+                pc.starts_with(digits, prefix),
+            ),
+        )
+    national = pc.utf8_slice_codeunits(digits, -national_digits)
+    other = pc.if_else(
+        pc.starts_with(pc.utf8_ltrim_whitespace(number), "+"),
+        pc.binary_join_element_wise("+", digits, ""),
+        digits,
+    )
+    canonical = pc.if_else(
+        is_national,
+        pc.binary_join_element_wise(f"+{country_code}", national, ""),
+        other,
+    )
+    canonical = pc.if_else(pc.equal(length, 0), pa.scalar(None, pa.string()), canonical)
+    canonical = pc.if_else(
+        pc.fill_null(pc.greater(pc.utf8_length(extension), 0), False),
+        pc.binary_join_element_wise(canonical, "x", extension, ""),
+        canonical,
+    )
+
+    normalized = pd.Series(canonical.to_numpy(zero_copy_only=False), index=values.index)
+    df[column] = (
+        normalized.astype(values.dtype)
+        if isinstance(values.dtype, pd.StringDtype)
+        else normalized
+    )
+
+    return df
+
+
+def _arrow_strings(values: pd.Series) -> pa.Array:
+    """Column values as an Arrow string array, nulls kept (e.g. phone numbers read as numbers by read_csv)"""
+    if values.dtype.kind == "f":
+        # numbers with nulls are read as floats ('5551234567.0')
+        values = values.astype("Int64")
+    array = pa.array(values.astype("string[pyarrow]").array)
+
+    return array.combine_chunks() if isinstance(array, pa.ChunkedArray) else array
+
+
+def _keep_digits(strings: pa.Array) -> pa.Array:
+    """Remove the characters that aren't ASCII digits from an Arrow string array, working on its bytes buffer with numpy
+    (several times faster than a regex replace). Nulls become empty strings
+
+    :param strings: The string array
+    :return: String array of the digits of each value
+    """
+    offsets = np.frombuffer(strings.buffers()[1], dtype=np.int32)[
+        strings.offset : strings.offset + len(strings) + 1
+    ]
+    data = (
+        np.frombuffer(strings.buffers()[2], dtype=np.uint8)
+        if strings.buffers()[2]
+        else np.array([], np.uint8)
+    )
+    data = data[offsets[0] : offsets[-1]]
+    starts = offsets[:-1] - offsets[0]
+
+    # digits count of each value (a last False element so the start of empty values at the end is a valid index)
+    is_digit = np.append((data >= ord("0")) & (data <= ord("9")), False)
+    counts = (
+        np.add.reduceat(is_digit, starts, dtype=np.int32)
+        if len(starts)
+        else np.array([], np.int32)
+    )
+    counts[offsets[1:] == offsets[:-1]] = 0
+    digit_offsets = np.zeros(len(strings) + 1, dtype=np.int32)
+    np.cumsum(counts, out=digit_offsets[1:])
+
+    return pa.StringArray.from_buffers(
+        len(strings), pa.py_buffer(digit_offsets), pa.py_buffer(data[is_digit[:-1]])
+    )
+
+
+def row_fingerprints(
+    df: pd.DataFrame, columns: list = FINGERPRINT_COLUMNS
+) -> pd.Series:
+    """Hash the key columns of each row into a 64 bits fingerprint: rows with the same key values (e.g. the same person
+    coming from several feeds) have the same fingerprint, whatever the columns dtypes. Rows with a null key value can't
+    be identified and have no fingerprint
+
+    :param df: The dataframe
+    :param columns: The key columns (missing ones are left out of the key), defaults to FINGERPRINT_COLUMNS
+    :return: Series of signed 64 bits fingerprints indexed as the identified rows
+    """
+    columns = [col for col in columns if col in df.columns]
+    if not columns:
+        return pd.Series([], index=df.index[:0], dtype="int64", name="fingerprint")
+
+    keys = df[columns]
+    # narrow ints hash differently from int64 if negative (see database_handler.row_hashes)
+    keys = keys.astype(
+        {col: "int64" for col, dtype in keys.dtypes.items() if dtype.kind == "i"}
+    )
+    # key values are mostly distinct (names, phone numbers): hashed as they are rather than factorized first
+    hashes = pd.util.hash_pandas_object(keys, index=False, categorize=False).to_numpy()
+    identified = np.logical_and.reduce(
+        [keys[col].notna().to_numpy() for col in columns]
+    )
+
+    return pd.Series(
+        hashes[identified].view("int64"), index=df.index[identified], name="fingerprint"
+    )
+
+
+class FingerprintIndex:
+    """Set of row fingerprints (e.g. the people kept from the former chunks of a stream, see drop_duplicate_rows), held
+    as a sorted array: lookups and inserts are vectorized binary searches, and each fingerprint takes 8 bytes"""
+
+    def __init__(self) -> None:
+        self.values = np.array([], dtype="int64")
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def contains(self, fingerprints: np.ndarray) -> np.ndarray:
+        """Check which fingerprints are in the index
+
+        :param fingerprints: The fingerprints
+        :return: Boolean array, True for the fingerprints in the index
+        """
+        if not len(self.values):
+            return np.zeros(len(fingerprints), dtype=bool)
+
+        positions = np.searchsorted(self.values, fingerprints)
+
+        return self.values[np.minimum(positions, len(self.values) - 1)] == fingerprints
+
+    def add(self, fingerprints: np.ndarray) -> None:
+        """Add fingerprints to the index (the ones in it already are skipped)
+
+        :param fingerprints: The fingerprints
+        """
+        new = np.unique(fingerprints)
+        new = new[~self.contains(new)]
+        self.values = np.insert(self.values, np.searchsorted(self.values, new), new)
+
+
+@instrumented()
+def drop_duplicate_rows(
+    df: pd.DataFrame,
+    columns: list = FINGERPRINT_COLUMNS,
+    merge: bool = False,
+    seen: Union[FingerprintIndex, None] = None,
+) -> pd.DataFrame:
+    """Drop the rows of people found more than once (same fingerprint of the key columns, see row_fingerprints) in a
+    single vectorized pass: the first row of each person is kept. With merge, the null values of the first row are
+    filled with the ones of its duplicates (e.g. interests only one of the feeds has). With seen, the people in the
+    index (e.g. found in former chunks) are dropped too, and the people kept are added to it
+
+    :param df: The dataframe (with a unique index)
+    :param columns: The key columns, defaults to FINGERPRINT_COLUMNS
+    :param merge: If the first row of a person takes the non-null values of its duplicates, defaults to False
+    :param seen: Fingerprints of the people found before, defaults to None
+    :return: The dataframe without duplicates
+    """
+    fingerprints = row_fingerprints(df, columns)
+    values = fingerprints.to_numpy()
+    found = (
+        seen.contains(values) if seen is not None else np.zeros(len(values), dtype=bool)
+    )
+    duplicated = fingerprints.duplicated().to_numpy() | found
+    if seen is not None:
+        seen.add(values[~duplicated])
+    if not duplicated.any():
+        return df
+
+    keep = ~df.index.isin(fingerprints.index[duplicated])
+    if merge:
+        # people with several rows in df (the ones found before are dropped as they are): their first non-null values
+        repeated = fingerprints[~found & fingerprints.duplicated(keep=False).to_numpy()]
+        firsts = repeated.index[~repeated.duplicated().to_numpy()]
+        merged = df.loc[repeated.index].groupby(repeated.to_numpy(), sort=False).first()
+        merged.index = firsts
+        df = df.copy()
+        for col in merged.columns:
+            first_values = df.loc[firsts, col]
+            if first_values.hasnans:
+                df.loc[firsts, col] = first_values.fillna(merged[col])
+
+    return df[keep]
+
+
+@instrumented()
+def compact_dtypes(
+    df: pd.DataFrame,
+    max_unique_ratio: float = 0.5,
+    string_dtype: Union[None, str] = None,
+) -> pd.DataFrame:
+    """Store a dataframe in less memory, with the same values: downcast int columns to the smallest int type that holds
+    them, convert columns of str values with few distinct ones (e.g. city, title, interests) to category and,
+    optionally, the other columns of str values to a pandas string dtype
+
+    :param df: The dataframe to compact
+    :param max_unique_ratio: Max distinct values over non-null values (0.0 to 1.0) of a str column to be converted to
+    category, defaults to 0.5
+    :param string_dtype: The dtype for the other str columns (e.g. 'string[pyarrow]'), defaults to None (keep object)
+    :return: The compacted dataframe
+    """
+    updated = {}
+    for col, values in df.items():
+        if pd.api.types.is_integer_dtype(
+            values.dtype
+        ) and not pd.api.types.is_extension_array_dtype(values.dtype):
+            updated[col] = pd.to_numeric(values, downcast="integer")
+        elif (
+            values.dtype == object
+            and pd.api.types.infer_dtype(values, skipna=True) == "string"
+        ):
+            # a single hashing pass gives the distinct values and the categorical codes (null values are -1). Columns
+            # with too many distinct values in their first rows already (e.g. names) aren't hashed at all
+            codes, uniques = pd.factorize(values.iloc[:CATEGORY_SAMPLE_SIZE])
+            if len(uniques) <= max_unique_ratio * np.count_nonzero(codes >= 0):
+                codes, uniques = pd.factorize(values)
+            if len(uniques) <= max_unique_ratio * np.count_nonzero(codes >= 0):
+                # sorted categories, as astype("category") would give
+                categorical = pd.Categorical.from_codes(codes, categories=uniques)
+                updated[col] = categorical.reorder_categories(np.sort(uniques))
+            elif string_dtype:
+                updated[col] = values.astype(string_dtype)
+
+    return df.assign(**updated)
+
+
+def memory_usage_mb(df: pd.DataFrame) -> float:
+    """Memory used by a dataframe, counting the str objects it holds (deep)
+
+    :param df: The dataframe to measure
+    :return: The memory in MB
+    """
+    return df.memory_usage(deep=True).sum() / 1024**2
@@ -1,53 +1,271 @@
+import hashlib
+import json
+from contextlib import ExitStack
+from http.client import HTTPResponse
 from pathlib import Path
+from typing import Iterator, Union
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 
 import pandas as pd
+from pyarrow import feather, parquet
 
 from datahandling.cleaning_utils import (
-    data_to_lower_case,
-    drop_null_columns,
-    drop_null_rows,
-    rename_columns,
-    split_titles_from_name,
-    trim_data,
-    update_column_types,
+    FINGERPRINT_COLUMNS,
+    compact_dtypes,
+    memory_usage_mb,
 )
+from datahandling.pipeline import CleaningPipeline
+from monitoring.metrics import instrumented
+
+# column that holds the dataframe index in the columnar cache files
+CACHE_INDEX_COLUMN = "__index__"
+# HTTP validators (ETag, Last-Modified) of the last download, used to download the csv again only if it changed
+DOWNLOAD_INFO_NAME = "people.download.json"
+
+
+def _df_rows(handler: "CSVHandler", *args, **kwargs) -> int:
+    """Rows of the 'df' attribute (rows in of the CSVHandler stages that work on it)"""
+    return len(handler.df)
 
 
 class CSVHandler:
-    def __init__(self, url) -> None:
+    # cleaning parameters shared by the full frame (clean_data) and streaming (iter_clean_chunks) modes. Bump
+    # PIPELINE_VERSION whenever the code of the cleaning steps changes, so cleaned data cached by a former version isn't
+    # reused (changes of the steps config are part of cache_key already)
+    PIPELINE_VERSION = 2
+    NULL_COLUMNS_THRESHOLD = 0.8
+    INTEREST_COLUMNS = ["interest1", "interest2", "interest3", "interest4"]
+    # default cleaning pipeline (see clean_data and CleaningPipeline)
+    PIPELINE_STEPS = [
+        # a
+        {"step": "cast_types", "types": {"Age": "int"}},
+        # b, c
+        {
+            "step": "rename_columns",
+            "columns": {"PhoneNumber": "phone_number"},
+            "lower": True,
+        },
+        # d, e (fused into a single pass)
+        {"step": "lower_case"},
+        {"step": "trim"},
+        # split title (e.g. dr.) from name
+        {"step": "split_titles"},
+        # f
+        {"step": "drop_null_columns", "threshold": NULL_COLUMNS_THRESHOLD},
+        # g
+        {"step": "drop_rows_without_any", "columns": INTEREST_COLUMNS},
+        # h
+        {"step": "normalize_phone_numbers", "column": "phone_number"},
+        # i (runs on the whole data, or in order on the chunks when streaming)
+        {"step": "drop_duplicates", "columns": FINGERPRINT_COLUMNS},
+    ]
+    # compact_dtypes parameters of the cleaned data: str columns with at most 50% distinct values become categories, the
+    # others Arrow strings
+    CATEGORY_MAX_UNIQUE_RATIO = 0.5
+    STRING_DTYPE = "string[pyarrow]"
+    # typed columnar formats for the raw ('people.<format>') and cleaned ('people_clean.<format>') datasets cache
+    CACHE_FORMATS = ("feather", "parquet")
+
+    def __init__(
+        self,
+        url,
+        cache_format: Union[str, None] = "feather",
+        write_json: bool = True,
+        pipeline: Union[CleaningPipeline, None] = None,
+        compact: bool = True,
+    ) -> None:
+        """
+        :param url: Where to download the csv from
+        :param cache_format: 'feather', 'parquet' or None (no columnar cache), defaults to 'feather'
+        :param write_json: If the downloaded data is also saved as json, defaults to True
+        :param pipeline: The cleaning pipeline, defaults to one of PIPELINE_STEPS
+        :param compact: If clean_data compacts the cleaned data dtypes (see compact_data), defaults to True
+        """
+        if cache_format not in self.CACHE_FORMATS + (None,):
+            raise ValueError(f"'{cache_format}' is not a cache format")
+
         self.url = url
         self.base_path = (
             Path(__file__).parent.resolve().parent.resolve().parent.resolve()
         )  # ../assessment
+        self.cache_format = cache_format
+        self.write_json = write_json
+        self.pipeline = pipeline or CleaningPipeline(self.PIPELINE_STEPS)
+        self.compact = compact
         self.df = None
+        # memory of the data before and after the last compact_data
+        self.memory_report = None
+        # (modification time, size, sha256) of the csv last hashed by cache_key
+        self._csv_digest = None
+
+    @instrumented()
+    def download_files(
+        self, chunksize: Union[int, None] = None, force: bool = False
+    ) -> bool:
+        """Download csv files to .csv, columnar cache and .json (if write_json) formats if '../data/' has no files
+        already. If the files exist and were downloaded over HTTP with an ETag or Last-Modified header, a conditional
+        request is sent instead, and the files are downloaded again only if the server has a newer version. With
+        chunksize, the csv is downloaded and written chunk by chunk (memory bounded by chunksize), and neither the json
+        nor the columnar cache is written, since both need the whole file (load_dataframe reads the csv instead)
 
-    def download_files(self) -> None:
-        """Download csv files to .csv and .json formats if '../data/' has no files already"""
+        :param chunksize: Rows per chunk to stream the download, defaults to None (whole file at once)
+        :param force: Download the files even if they exist and are up to date, defaults to False
+        :return: True if the files were downloaded
+        """
         csv_name = "people.csv"
         json_name = "people.json"
+        data_path = self.base_path.joinpath("data").resolve()
+        csv_path = data_path.joinpath(csv_name)
 
-        if self.base_path.joinpath(f"data/{csv_name}").resolve().is_file():
-            print("File already exists, nothing to do.")
-        else:
-            print("File doesn't exist. Downloading and saving files.")
-            data_path = self.base_path.joinpath("data").resolve()
+        validators = {}
+        if csv_path.is_file() and not force:
+            validators = self._download_validators()
+            if not validators:
+                print("File already exists, nothing to do.")
+                return False
+
+        with ExitStack() as stack:
+            source = self.url
+            if self._is_http():
+                source = self._request(validators)
+                if source is None:
+                    print("File is up to date, nothing to do.")
+                    return False
+                stack.enter_context(source)
+
+            print("Downloading and saving files.")
             data_path.mkdir(parents=True, exist_ok=True)
+            # written to a temporary file first, so an interrupted download never leaves a partial people.csv behind
+            partial_csv_path = data_path.joinpath(f"{csv_name}.part")
+
+            if chunksize:
+                # the files below are only written without chunksize and would be stale
+                for stale_path in (
+                    self._cache_path("people"),
+                    data_path.joinpath(json_name),
+                    data_path.joinpath("people.jsonl"),
+                ):
+                    if stale_path:
+                        stale_path.unlink(missing_ok=True)
+
+                csv_file = stack.enter_context(open(partial_csv_path, "w", newline=""))
+
+                for number, chunk in enumerate(
+                    pd.read_csv(source, chunksize=chunksize)
+                ):
+                    chunk.to_csv(csv_file, header=number == 0)
+                csv_file.close()
+            else:
+                df = pd.read_csv(source)
+                df.to_csv(partial_csv_path)
+                if self.cache_format:
+                    self._write_cache(df, self._cache_path("people"))
+                if self.write_json:
+                    df.to_json(data_path.joinpath(json_name))
+
+            partial_csv_path.replace(csv_path)
+            self._save_download_validators(source)
+
+        return True
+
+    @instrumented()
+    def cache_key(self) -> str:
+        """Key of the cleaned data: sha256 of the cleaning configuration (PIPELINE_VERSION, the pipeline steps config and
+        the compact_data parameters) and of the '../data/people.csv' bytes. The same key means cleaning would give the same
+        result, so the cleaned data cache (or the data already in the database) can be used as it is
+
+        :return: The key as a hex string
+        """
+        csv_path = self.base_path.joinpath("data/people.csv").resolve()
+        stat = csv_path.stat()
+        # the file is only hashed again if it changed since the last call
+        if not self._csv_digest or self._csv_digest[:2] != (
+            stat.st_mtime_ns,
+            stat.st_size,
+        ):
+            digest = hashlib.sha256()
+            with open(csv_path, "rb") as csv_file:
+                for block in iter(lambda: csv_file.read(1024**2), b""):
+                    digest.update(block)
+            self._csv_digest = (stat.st_mtime_ns, stat.st_size, digest.hexdigest())
+
+        config = {
+            "pipeline_version": self.PIPELINE_VERSION,
+            "pipeline": self.pipeline.config(),
+            "compact": (
+                [self.CATEGORY_MAX_UNIQUE_RATIO, self.STRING_DTYPE]
+                if self.compact
+                else None
+            ),
+        }
+        key_source = json.dumps(config, sort_keys=True) + self._csv_digest[2]
 
-            df = pd.read_csv(self.url)
-            df.to_csv(data_path.joinpath(csv_name))
-            df.to_json(data_path.joinpath(json_name))
+        return hashlib.sha256(key_source.encode()).hexdigest()
 
+    @instrumented()
     def load_dataframe(self) -> pd.DataFrame:
-        """Load '../data/people.json' file content to CSVHandler 'df' attribute
+        """Load the raw data to CSVHandler 'df' attribute from the columnar cache ('../data/people.<format>') if it
+        exists, which needs little or no parsing, otherwise from '../data/people.json' if it's up to date with the csv,
+        otherwise from '../data/people.csv' (e.g. no cache format and no json written, or a chunked download)
 
+        :raises FileNotFoundError: If none of these files exists
         :return: The dataframe
         """
-        self.df = pd.read_json(self.base_path.joinpath(f"data/people.json").resolve())
+        cache_path = self._cache_path("people")
+        json_path = self.base_path.joinpath("data/people.json").resolve()
+        csv_path = self.base_path.joinpath("data/people.csv").resolve()
+
+        if cache_path and cache_path.is_file():
+            self.df = self._read_cache(cache_path)
+        elif json_path.is_file() and (
+            not csv_path.is_file()
+            or json_path.stat().st_mtime_ns >= csv_path.stat().st_mtime_ns
+        ):
+            self.df = pd.read_json(json_path)
+        elif csv_path.is_file():
+            self.df = pd.read_csv(csv_path, index_col=0)
+        else:
+            raise FileNotFoundError(
+                f"No raw data to load: '{csv_path}' and its caches are missing (see download_files)"
+            )
 
         return self.df
 
-    def clean_data(self):
-        """Apply at least two data cleaning functions. Specifically:
+    @instrumented(rows_in=_df_rows)
+    def save_clean_cache(self) -> None:
+        """Save the (cleaned) 'df' attribute to the columnar cache '../data/people_clean-<key>.<format>', keyed by the
+        current cache_key (cleaned data of former inputs is removed)"""
+        if not self.cache_format:
+            raise ValueError("No cache format set")
+
+        cache_path = self._clean_cache_path()
+        for stale_path in cache_path.parent.glob(f"people_clean*.{self.cache_format}"):
+            stale_path.unlink()
+
+        self._write_cache(self.df, cache_path)
+
+    @instrumented()
+    def load_clean_cache(self) -> Union[pd.DataFrame, None]:
+        """Load the cleaned data saved by save_clean_cache to CSVHandler 'df' attribute, if it was saved for the
+        current cache_key (same csv and cleaning configuration)
+
+        :return: The dataframe, None if there's no cleaned data for the current key
+        """
+        if not self.cache_format:
+            raise ValueError("No cache format set")
+
+        cache_path = self._clean_cache_path()
+        if not cache_path.is_file():
+            return None
+
+        self.df = self._read_cache(cache_path)
+
+        return self.df
+
+    @instrumented(rows_in=_df_rows)
+    def clean_data(self, workers: Union[int, None] = None):
+        """Apply at least two data cleaning functions. Specifically (PIPELINE_STEPS):
         a - change "Age" type to "int" (no need for float)
         b - rename "PhoneNumber" to "phone_number"
         c - set all columns names to lower case
@@ -55,38 +273,170 @@ class CSVHandler:
         e - trim all string values (' swimming', 'swimming ', and 'swimming' should be the same thing)
         f - try to drop entire columns that have at least 80% (0.8) of values as null
         g - drop rows of people that have no interest
+        h - canonicalize phone numbers (e.g. '(555) 123 4567' and '1-555-123-4567' are both '+15551234567')
+        i - drop the rows of people found more than once (same name, phone number and city), keeping the first one
 
         Cleaning suggestions:
         - use .fillnan to fill null values with more meaningful values for each column
-        - apply some mask to phone_number (e.g. add +1 to all numbers with it - if all from USA or replace '.' for '-')
+
+        The steps run through the 'pipeline' attribute, so f is decided from the raw data null counts and the dropped
+        columns are not cleaned at all. With workers, the steps run in parallel processes, each on a partition of the
+        data, with the same result. The cleaned data dtypes are then compacted (see compact_data), unless compact is
+        False
+
+        :param workers: Processes to clean on, defaults to None (serial)
         :return: A cleaned dataframe
         """
-        # a (description above)
-        self.df = update_column_types(self.df, {"Age": int})
-        # b (description above)
-        self.df = rename_columns(
+        self.df = self.pipeline.run(self.df, workers=workers)
+        if self.compact:
+            self.compact_data()
+
+        return self.df
+
+    @instrumented(rows_in=_df_rows)
+    def compact_data(self) -> dict:
+        """Store the 'df' attribute in less memory with the same values (see cleaning_utils.compact_dtypes): smallest
+        int types (e.g. age as int8), categories for the str columns with few distinct values (title, city, interests)
+        and Arrow strings for the others (name, phone_number). Chunks of iter_clean_chunks aren't compacted: they are
+        only kept in memory until they are loaded
+
+        :return: Dictionary with the 'before_mb' and 'after_mb' memory of the data, also kept in 'memory_report'
+        """
+        before_mb = memory_usage_mb(self.df)
+        self.df = compact_dtypes(
             self.df,
-            {"PhoneNumber": "phone_number"},
-            rules_to_apply=[lambda x: x.lower()],
-        )
-        print(self.df.head())
-        # c (description above)
-        self.df = data_to_lower_case(self.df)
-        # d (description above)
-        self.df = trim_data(self.df)
-        # e (description above)
-        self.df = split_titles_from_name(self.df)
-        # f (description above)
-        self.df = drop_null_columns(
-            self.df, null_percentage_threshold=0.8, info_only=False
+            max_unique_ratio=self.CATEGORY_MAX_UNIQUE_RATIO,
+            string_dtype=self.STRING_DTYPE,
         )
-        # g (description above)
-        self.df = drop_null_rows(
-            self.df,
-            null_count=4,
-            info_only=False,
-            cols_of_interest=["interest1", "interest2", "interest3", "interest4"],
-            # cols_of_interest=["interest2", "interest3", "interest4"],
+        self.memory_report = {
+            "before_mb": before_mb,
+            "after_mb": memory_usage_mb(self.df),
+        }
+
+        return self.memory_report
+
+    def iter_clean_chunks(
+        self, chunksize: int = 100_000, workers: Union[int, None] = None
+    ) -> Iterator[pd.DataFrame]:
+        """Streaming version of clean_data: read '../data/people.csv' chunk by chunk and yield every chunk cleaned, so
+        memory is bounded by chunksize instead of the file size. The csv is read twice: a first pass counts null values
+        per column, so the columns to drop (f) are decided over the whole file as in clean_data. With workers, chunks
+        are cleaned in parallel processes (at most two chunks per worker read ahead) and yielded in order
+
+        :param chunksize: Rows per chunk, defaults to 100_000
+        :param workers: Processes to clean chunks on, defaults to None (serial)
+        :yield: The cleaned chunks (indexed by their row number in the csv)
+        """
+        yield from self.pipeline.iter_chunks(
+            lambda: self._read_csv_chunks(chunksize), workers=workers
         )
 
-        return self.df
+    def _cache_path(self, name: str) -> Union[Path, None]:
+        """Path of a dataset in the columnar cache ('../data/<name>.<format>'), None if there's no cache format"""
+        if not self.cache_format:
+            return None
+
+        return self.base_path.joinpath(f"data/{name}.{self.cache_format}").resolve()
+
+    def _clean_cache_path(self) -> Path:
+        """Path of the cleaned data in the columnar cache for the current cache_key"""
+        return self._cache_path(f"people_clean-{self.cache_key()[:16]}")
+
+    def _is_http(self) -> bool:
+        """If the csv is downloaded over HTTP(S) (as opposed to e.g. a local file)"""
+        return str(self.url).startswith(("http://", "https://"))
+
+    def _request(self, validators: dict) -> Union[HTTPResponse, None]:
+        """Send the csv download request, conditional if there are validators of a former download
+
+        :param validators: Dictionary with the 'etag' and/or 'last_modified' of the former download (can be empty)
+        :return: The response to read the csv from, None if the server answered 304 Not Modified
+        """
+        headers = {}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+        try:
+            return urlopen(Request(self.url, headers=headers))
+        except HTTPError as error:
+            if error.code == 304:
+                return None
+            raise
+
+    def _download_validators(self) -> dict:
+        """Validators saved by the last download of the same url, empty if there are none"""
+        info_path = self.base_path.joinpath(f"data/{DOWNLOAD_INFO_NAME}").resolve()
+        if not self._is_http() or not info_path.is_file():
+            return {}
+
+        info = json.loads(info_path.read_text())
+        if info.get("url") != self.url:
+            return {}
+
+        return {
+            key: info.get(key) for key in ("etag", "last_modified") if info.get(key)
+        }
+
+    def _save_download_validators(self, source) -> None:
+        """Save the ETag and Last-Modified headers of a download response (or remove the former ones if the csv
+        wasn't downloaded over HTTP)
+
+        :param source: The response the csv was read from, or its path
+        """
+        info_path = self.base_path.joinpath(f"data/{DOWNLOAD_INFO_NAME}").resolve()
+        if not isinstance(source, HTTPResponse):
+            info_path.unlink(missing_ok=True)
+            return
+
+        info = {
+            "url": self.url,
+            "etag": source.headers.get("ETag"),
+            "last_modified": source.headers.get("Last-Modified"),
+        }
+        info_path.write_text(json.dumps(info))
+
+    def _write_cache(self, df: pd.DataFrame, path: Path) -> None:
+        """Write a dataframe (and its index) to the columnar cache. Feather is written uncompressed, so reading it
+        back is a memory map of the file instead of a decompression
+
+        :param df: The dataframe to write
+        :param path: The cache file path (its suffix is the format)
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # the index is kept as a regular column: feather only stores default indexes
+        table = df.rename_axis(CACHE_INDEX_COLUMN).reset_index()
+        if self.cache_format == "feather":
+            table.to_feather(path, compression="uncompressed")
+        else:
+            table.to_parquet(path, index=False)
+
+    def _read_cache(self, path: Path) -> pd.DataFrame:
+        """Read a dataframe written by _write_cache (memory-mapped)
+
+        :param path: The cache file path
+        :return: The dataframe, with its original index
+        """
+        if self.cache_format == "feather":
+            table = feather.read_table(path, memory_map=True)
+        else:
+            table = parquet.read_table(path, memory_map=True)
+
+        # string columns come back with the default (python) storage otherwise, e.g. after compact_data
+        with pd.option_context("mode.string_storage", "pyarrow"):
+            df = table.to_pandas()
+
+        return df.set_index(CACHE_INDEX_COLUMN).rename_axis(None)
+
+    def _read_csv_chunks(self, chunksize: int) -> Iterator[pd.DataFrame]:
+        """Read '../data/people.csv' (as written by download_files) chunksize rows at a time
+
+        :param chunksize: Rows per chunk
+        :return: Iterator of raw dataframes
+        """
+        return pd.read_csv(
+            self.base_path.joinpath("data/people.csv").resolve(),
+            index_col=0,
+            chunksize=chunksize,
+        )
@@ -0,0 +1,672 @@
+import json
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from itertools import chain
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Union
+
+import numpy as np
+import pandas as pd
+
+from datahandling.cleaning_utils import (
+    FINGERPRINT_COLUMNS,
+    FingerprintIndex,
+    drop_duplicate_rows,
+    drop_null_rows,
+    normalize_phone_numbers,
+    normalize_strings,
+    null_columns_to_drop,
+    split_titles_from_name,
+)
+
+
+class Step:
+    """A cleaning step of CleaningPipeline, built from a config dictionary ({'step': name, **params}). Subclasses
+    implement apply and tell the planner what it can do with them:
+    - row_local: gives the same result on any slice of rows (it can run on chunks or partitions), otherwise the step
+      needs the whole data and has to implement fit
+    - column_local: every column after the step only depends on the column it maps to (see column_mapping), so
+      columns can be dropped before the step
+    - keeps_nulls: keeps the rows and the null count of every column (created_columns have none), so the null counts
+      after the step are known from the ones before
+    - sequential: a step that needs the whole data, but can also run on chunks one after the other, carrying state
+      from a chunk to the next (see start), so it can end a pipeline run by chunks
+    """
+
+    name = None
+    row_local = True
+    column_local = True
+    keeps_nulls = True
+    sequential = False
+    # columns added by the step (without nulls)
+    created_columns = ()
+    # {'lower': bool, 'strip': bool} of cell-wise string steps, adjacent ones are fused into a single pass
+    string_op = None
+
+    def __init__(self, **params) -> None:
+        self.params = params
+        # name in the pipeline report
+        self.label = self.name
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Run the step, updating df in place when possible
+
+        :param df: The dataframe
+        :return: The updated dataframe
+        """
+        raise NotImplementedError
+
+    def fit(self, null_counts: pd.Series, rows: int) -> "Step":
+        """Turn a step that needs the whole data (not row_local) into a row_local one, given the null counts per column
+        and the number of rows of the whole data at the step position
+
+        :param null_counts: Series of null elements count indexed by column name
+        :param rows: Total number of rows
+        :return: The fitted step
+        """
+        raise NotImplementedError
+
+    def start(self) -> "Step":
+        """A copy of a sequential step with a new state, to run on the chunks of a stream in order
+
+        :return: The step to run on the chunks
+        """
+        raise NotImplementedError
+
+    def column_mapping(self, columns: list) -> dict:
+        """Map the columns after the step (in their order) to the column each one comes from
+
+        :param columns: The columns before the step
+        :return: Dictionary of {column after: column before}
+        """
+        return {col: col for col in columns}
+
+    def config(self) -> dict:
+        return {"step": self.name, **self.params}
+
+
+class CastTypes(Step):
+    """Set columns types, e.g. {'step': 'cast_types', 'types': {'Age': 'int'}} (missing columns are skipped)"""
+
+    name = "cast_types"
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        for col, data_type in self.params["types"].items():
+            if col in df.columns:
+                df[col] = df[col].astype(data_type)
+
+        return df
+
+
+class RenameColumns(Step):
+    """Rename columns and optionally set all names to lower case, e.g.
+    {'step': 'rename_columns', 'columns': {'PhoneNumber': 'phone_number'}, 'lower': true}
+    """
+
+    name = "rename_columns"
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        df.rename(columns=self.params.get("columns", {}), inplace=True)
+        if self.params.get("lower"):
+            df.columns = [col.lower() for col in df.columns]
+
+        return df
+
+    def column_mapping(self, columns: list) -> dict:
+        renames = self.params.get("columns", {})
+        mapping = {}
+        for col in columns:
+            new_col = renames.get(col, col)
+            mapping[new_col.lower() if self.params.get("lower") else new_col] = col
+
+        return mapping
+
+
+class NormalizeStrings(Step):
+    """Lower case and/or trim the str values of every column in a single pass, e.g.
+    {'step': 'normalize_strings', 'lower': true, 'strip': true}
+    """
+
+    name = "normalize_strings"
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        return normalize_strings(
+            df,
+            string_dtype=self.params.get("string_dtype"),
+            lower=self.params.get("lower", True),
+            strip=self.params.get("strip", True),
+            inplace=True,
+        )
+
+
+class LowerCase(NormalizeStrings):
+    """Set the str values of every column to lower case: {'step': 'lower_case'}"""
+
+    name = "lower_case"
+    string_op = {"lower": True, "strip": False}
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        return normalize_strings(df, lower=True, strip=False, inplace=True)
+
+
+class Trim(NormalizeStrings):
+    """Trim the str values of every column: {'step': 'trim'}"""
+
+    name = "trim"
+    string_op = {"lower": False, "strip": True}
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        return normalize_strings(df, lower=False, strip=True, inplace=True)
+
+
+class SplitTitles(Step):
+    """Split titles (e.g. dr.) from the names into a 'title' column (see split_titles_from_name): {'step':
+    'split_titles'}. The name must be the first column
+    """
+
+    name = "split_titles"
+    created_columns = ("title",)
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        return split_titles_from_name(df)
+
+    def column_mapping(self, columns: list) -> dict:
+        # same order of split_titles_from_name: title and name (both from the first column), then the other columns
+        return {"title": columns[0], "name": columns[0], **{c: c for c in columns[1:]}}
+
+
+class SelectColumns(Step):
+    """Keep only some columns (in their current order, missing ones are ignored), e.g.
+    {'step': 'select_columns', 'columns': ['name', 'age']}
+    """
+
+    name = "select_columns"
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        keep = set(self.params["columns"])
+        df.drop(columns=[col for col in df.columns if col not in keep], inplace=True)
+
+        return df
+
+    def column_mapping(self, columns: list) -> dict:
+        keep = set(self.params["columns"])
+
+        return {col: col for col in columns if col in keep}
+
+
+class DropColumns(Step):
+    """Drop some columns (missing ones are ignored), e.g. {'step': 'drop_columns', 'columns': ['interest1']}"""
+
+    name = "drop_columns"
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        drop = set(self.params["columns"])
+        df.drop(columns=[col for col in df.columns if col in drop], inplace=True)
+
+        return df
+
+    def column_mapping(self, columns: list) -> dict:
+        drop = set(self.params["columns"])
+
+        return {col: col for col in columns if col not in drop}
+
+
+class DropNullColumns(Step):
+    """Drop the columns that have at least 'threshold' (0.0 to 1.0) of null values over the whole data (see
+    drop_null_columns), e.g. {'step': 'drop_null_columns', 'threshold': 0.8}
+    """
+
+    name = "drop_null_columns"
+    row_local = False
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        return self.fit(df.isnull().sum(), len(df)).apply(df)
+
+    def fit(self, null_counts: pd.Series, rows: int) -> Step:
+        columns = null_columns_to_drop(null_counts, rows, self.params["threshold"])
+        step = DropColumns(columns=columns)
+        step.label = self.label
+
+        return step
+
+
+class DropRowsWithoutAny(Step):
+    """Drop the rows that have all the given columns null (among the ones left), e.g.
+    {'step': 'drop_rows_without_any', 'columns': ['interest1', 'interest2']}
+    """
+
+    name = "drop_rows_without_any"
+    column_local = False
+    keeps_nulls = False
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        columns = [col for col in self.params["columns"] if col in df.columns]
+
+        return drop_null_rows(
+            df, null_count=len(columns), info_only=False, cols_of_interest=columns
+        )
+
+
+class NormalizePhoneNumbers(Step):
+    """Canonicalize the phone numbers of a column (see normalize_phone_numbers), e.g.
+    {'step': 'normalize_phone_numbers', 'column': 'phone_number', 'country_code': '1'}
+    """
+
+    name = "normalize_phone_numbers"
+    # values without digits become null
+    keeps_nulls = False
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        return normalize_phone_numbers(df, **self.params)
+
+
+class DropDuplicates(Step):
+    """Drop the rows of people found more than once (see drop_duplicate_rows), e.g.
+    {'step': 'drop_duplicates', 'columns': ['name', 'phone_number', 'city'], 'merge': false}. Duplicates can be anywhere
+    in the data, so it runs on the whole data, or on the chunks of a stream in order with the fingerprints of the people
+    kept from the former chunks (merge only fills a row from its duplicates of the same chunk)
+    """
+
+    name = "drop_duplicates"
+    row_local = False
+    column_local = False
+    keeps_nulls = False
+    sequential = True
+
+    def __init__(self, **params) -> None:
+        super().__init__(**params)
+        # fingerprints of the people kept from the former chunks (see start), None on the whole data
+        self.seen = None
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        return drop_duplicate_rows(
+            df,
+            columns=self.params.get("columns", FINGERPRINT_COLUMNS),
+            merge=self.params.get("merge", False),
+            seen=self.seen,
+        )
+
+    def fit(self, null_counts: pd.Series, rows: int) -> Step:
+        # nothing to fit from the null counts: it needs the rows themselves
+        return self
+
+    def start(self) -> Step:
+        step = DropDuplicates(**self.params)
+        step.label = self.label
+        step.seen = FingerprintIndex()
+
+        return step
+
+
+STEPS = {
+    step.name: step
+    for step in (
+        CastTypes,
+        RenameColumns,
+        NormalizeStrings,
+        LowerCase,
+        Trim,
+        SplitTitles,
+        SelectColumns,
+        DropColumns,
+        DropNullColumns,
+        DropRowsWithoutAny,
+        NormalizePhoneNumbers,
+        DropDuplicates,
+    )
+}
+
+
+def step_from_config(config: dict) -> Step:
+    """Instantiate a step from its config dictionary
+
+    :param config: Dictionary with the 'step' name (one of STEPS keys) and its parameters
+    :return: The step
+    """
+    params = dict(config)
+    name = params.pop("step", None)
+    if name not in STEPS:
+        raise ValueError(f"'{name}' is not a cleaning step ({', '.join(STEPS)})")
+
+    return STEPS[name](**params)
+
+
+class CleaningPipeline:
+    """Ordered cleaning steps, planned before they run:
+    - adjacent cell-wise string steps (e.g. lower_case and trim) are fused into a single pass
+    - steps that need the whole data (e.g. drop_null_columns) are fitted from the input null counts when the steps
+      before them keep nulls, so they can run chunk by chunk or on partitions
+    - column drops are moved as early as possible, so dropped columns aren't cleaned at all
+
+    The plan runs eagerly on a dataframe (run), or on a stream of chunks (iter_chunks), optionally in worker processes.
+    Each run records every planned step in 'report': total 'seconds', 'rows' after it and, with track_memory, the
+    'memory_mb' of the largest dataframe (whole data, chunk or partition) after it
+    """
+
+    def __init__(self, steps: list, track_memory: bool = False) -> None:
+        """
+        :param steps: Steps config dictionaries (see step_from_config) or Step objects, in order
+        :param track_memory: If the dataframe memory is measured after every step (deep, so it takes about as long as
+        a string step), defaults to False
+        """
+        self.steps = [
+            step if isinstance(step, Step) else step_from_config(step) for step in steps
+        ]
+        self.track_memory = track_memory
+        self.report = []
+
+    @classmethod
+    def from_json(cls, path: Union[str, Path], **kwargs) -> "CleaningPipeline":
+        """Build a pipeline from a json file with the list of steps config dictionaries
+
+        :param path: The json file path
+        :return: The pipeline
+        """
+        return cls(json.loads(Path(path).read_text()), **kwargs)
+
+    def config(self) -> list:
+        """The steps config dictionaries, e.g. to save or hash the pipeline"""
+        return [step.config() for step in self.steps]
+
+    def plan(
+        self,
+        columns: list,
+        null_counts: Union[pd.Series, None] = None,
+        rows: Union[int, None] = None,
+    ) -> list:
+        """Plan the steps for an input: fuse string steps, fit the steps that need the whole data (if null_counts are
+        given) and move the column drops up
+
+        :param columns: The input columns
+        :param null_counts: Null elements count per input column, defaults to None (nothing is fitted)
+        :param rows: Number of input rows (with null_counts)
+        :return: List of the steps to run
+        """
+        steps = fuse_string_steps(self.steps)
+        if null_counts is not None:
+            steps = fit_steps(steps, columns, null_counts, rows)
+
+        return push_down_column_drops(steps, columns)
+
+    def run(self, df: pd.DataFrame, workers: Union[int, None] = None) -> pd.DataFrame:
+        """Run the pipeline on a whole dataframe (updated in place when possible). With workers, the row_local steps
+        run in worker processes, each on a partition of consecutive rows (the result is the same)
+
+        :param df: The dataframe to clean
+        :param workers: Number of processes, defaults to None (in this process)
+        :return: The cleaned dataframe
+        """
+        steps = self.plan(list(df.columns), df.isnull().sum(), len(df))
+        self.report = []
+
+        if not workers or workers < 2:
+            df, records = run_steps(steps, df, self.track_memory)
+            self._record(records)
+            return df
+
+        # steps that still need the whole data run in this process, the others on partitions
+        with ProcessPoolExecutor(workers) as executor:
+            segment = []
+            for step in steps + [None]:
+                if step is not None and step.row_local:
+                    segment.append(step)
+                    continue
+
+                if segment:
+                    bounds = np.linspace(0, len(df), workers + 1, dtype=int)
+                    partitions = [
+                        df.iloc[start:end] for start, end in zip(bounds, bounds[1:])
+                    ]
+                    results = list(
+                        executor.map(
+                            partial(run_steps, segment, track_memory=self.track_memory),
+                            partitions,
+                        )
+                    )
+                    df = pd.concat([partition for partition, _ in results])
+                    self._record(chain.from_iterable(records for _, records in results))
+                    segment = []
+                if step is not None:
+                    df, records = run_steps([step], df, self.track_memory)
+                    self._record(records)
+
+        return df
+
+    def iter_chunks(
+        self,
+        read_chunks: Callable[[], Iterable[pd.DataFrame]],
+        workers: Union[int, None] = None,
+    ) -> Iterator[pd.DataFrame]:
+        """Run the pipeline chunk by chunk, so memory is bounded by the chunk size. If there are steps that need the
+        whole data, the chunks are read twice: a first pass counts the null values to fit them. Sequential steps that
+        end the pipeline (e.g. drop_duplicates) run in this process on the cleaned chunks, in order. With workers,
+        chunks are cleaned in worker processes (at most two chunks per worker read ahead) and yielded in order
+
+        :param read_chunks: Function returning a new iterable of the input chunks at each call
+        :param workers: Number of processes, defaults to None (in this process)
+        :yield: The cleaned chunks
+        """
+        null_counts, rows = None, 0
+        if not all(step.row_local for step in self.steps):
+            null_counts = pd.Series(dtype="int64")
+            for chunk in read_chunks():
+                rows += len(chunk)
+                null_counts = null_counts.add(chunk.isnull().sum(), fill_value=0)
+
+        chunks = iter(read_chunks())
+        first_chunk = next(chunks, None)
+        if first_chunk is None:
+            return
+
+        steps = self.plan(list(first_chunk.columns), null_counts, rows)
+        split = len(steps)
+        while split and not steps[split - 1].row_local and steps[split - 1].sequential:
+            split -= 1
+        if not all(step.row_local for step in steps[:split]):
+            raise ValueError(
+                "Steps that need the whole data can only run by chunks after steps that keep nulls, or at the end if "
+                "they are sequential"
+            )
+        sequential_steps = [step.start() for step in steps[split:]]
+
+        self.report = []
+        clean_chunk = partial(run_steps, steps[:split], track_memory=self.track_memory)
+        chunks = chain([first_chunk], chunks)
+        with ExitStack() as stack:
+            if workers and workers > 1:
+                executor = stack.enter_context(ProcessPoolExecutor(workers))
+                results = bounded_map(executor, clean_chunk, chunks, 2 * workers)
+            else:
+                results = map(clean_chunk, chunks)
+
+            for chunk, records in results:
+                if sequential_steps:
+                    chunk, sequential_records = run_steps(
+                        sequential_steps, chunk, self.track_memory
+                    )
+                    records = records + sequential_records
+                self._record(records)
+                yield chunk
+
+    def _record(self, records: Iterable[tuple]) -> None:
+        """Add (label, seconds, rows, memory bytes) step records to the report, summed by step (memory is the max)"""
+        by_label = {record["step"]: record for record in self.report}
+        for label, seconds, rows, memory in records:
+            if label not in by_label:
+                by_label[label] = {
+                    "step": label,
+                    "seconds": 0.0,
+                    "rows": 0,
+                    "memory_mb": None,
+                }
+                self.report.append(by_label[label])
+            record = by_label[label]
+            record["seconds"] += seconds
+            record["rows"] += rows
+            if memory is not None:
+                record["memory_mb"] = max(
+                    record["memory_mb"] or 0.0, memory / 1024**2
+                )
+
+
+def run_steps(steps: list, df: pd.DataFrame, track_memory: bool = False) -> tuple:
+    """Run planned steps on a dataframe, measuring each one
+
+    :param steps: The steps to run, in order
+    :param df: The dataframe
+    :param track_memory: If the dataframe memory (deep) is measured after every step, defaults to False
+    :return: Tuple of (updated dataframe, list of (step label, seconds, rows after, memory bytes after) tuples)
+    """
+    records = []
+    for step in steps:
+        start = time.perf_counter()
+        df = step.apply(df)
+        seconds = time.perf_counter() - start
+        memory = df.memory_usage(deep=True).sum() if track_memory else None
+        records.append((step.label, seconds, len(df), memory))
+
+    return df, records
+
+
+def fuse_string_steps(steps: list) -> list:
+    """Replace every run of adjacent cell-wise string steps (e.g. lower_case then trim) by a single NormalizeStrings
+
+    :param steps: The steps
+    :return: The fused steps
+    """
+    fused = []
+    for step in steps:
+        previous = fused[-1] if fused else None
+        if step.string_op and previous is not None and previous.string_op:
+            string_op = {
+                key: previous.string_op[key] or step.string_op[key]
+                for key in step.string_op
+            }
+            fused_step = NormalizeStrings(**string_op)
+            fused_step.string_op = string_op
+            fused_step.label = f"{previous.label}+{step.label}"
+            fused[-1] = fused_step
+        else:
+            fused.append(step)
+
+    return fused
+
+
+def fit_steps(steps: list, columns: list, null_counts: pd.Series, rows: int) -> list:
+    """Fit the steps that need the whole data, following the input null counts through the steps before them as long
+    as they keep nulls
+
+    :param steps: The steps
+    :param columns: The input columns
+    :param null_counts: Null elements count per input column
+    :param rows: Number of input rows
+    :return: The steps, fitted ones replaced
+    """
+    fitted = []
+    counts = null_counts.reindex(columns, fill_value=0)
+    for step in steps:
+        if counts is not None and not step.row_local:
+            step = step.fit(counts, rows)
+        fitted.append(step)
+
+        if counts is not None and step.keeps_nulls:
+            mapping = step.column_mapping(list(counts.index))
+            counts = pd.Series(
+                [
+                    0 if col in step.created_columns else counts[source]
+                    for col, source in mapping.items()
+                ],
+                index=list(mapping),
+                dtype="int64",
+            )
+        else:
+            counts = None
+
+    return fitted
+
+
+def push_down_column_drops(steps: list, columns: list) -> list:
+    """Move the column drops (select_columns, drop_columns) before the column_local steps that precede them (up to
+    another column drop), renaming their columns accordingly, so the dropped columns aren't processed by those steps
+
+    :param steps: The steps
+    :param columns: The input columns
+    :return: The reordered steps
+    """
+    steps = list(steps)
+    for index in range(len(steps)):
+        if not isinstance(steps[index], (SelectColumns, DropColumns)):
+            continue
+
+        columns_at = [list(columns)]
+        for step in steps[:index]:
+            columns_at.append(list(step.column_mapping(columns_at[-1])))
+
+        # columns kept and dropped by the drop, followed up through the steps before it, as long as no column kept
+        # comes from the same column as a dropped one (e.g. split_titles 'title' and 'name')
+        kept = set(steps[index].column_mapping(columns_at[index]))
+        dropped = set(columns_at[index]) - kept
+        target = index
+        while (
+            target > 0
+            and steps[target - 1].column_local
+            and not isinstance(steps[target - 1], (SelectColumns, DropColumns))
+        ):
+            mapping = steps[target - 1].column_mapping(columns_at[target - 1])
+            kept_before = {mapping[col] for col in kept}
+            dropped_before = {mapping[col] for col in dropped}
+            if kept_before & dropped_before:
+                break
+            kept, dropped = kept_before, dropped_before
+            target -= 1
+
+        if target == index:
+            continue
+        drop = [col for col in columns_at[target] if col not in kept]
+        moved = steps.pop(index)
+        if drop:
+            step = DropColumns(columns=drop)
+            step.label = moved.label
+            steps.insert(target, step)
+        else:
+            steps.insert(index, NoOp(label=moved.label))
+
+    return [step for step in steps if not isinstance(step, NoOp)]
+
+
+class NoOp(Step):
+    """Placeholder of a step that has nothing left to do (keeps the steps positions while planning)"""
+
+    name = "no_op"
+
+    def __init__(self, label: str) -> None:
+        super().__init__()
+        self.label = label
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        return df
+
+
+def bounded_map(
+    executor: Executor, func: Callable, iterable: Iterable, max_pending: int
+) -> Iterator:
+    """Like executor.map, but items are only taken from iterable as results are consumed (Executor.map takes them
+    all at once), so at most max_pending items are in memory
+
+    :param executor: The executor to run func on
+    :param func: The function to apply
+    :param iterable: The items to apply func to
+    :param max_pending: How many items can be submitted and not yet consumed
+    :yield: func results, in the iterable order
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
@@ -0,0 +1,499 @@
+import functools
+import inspect
+import json
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Iterator, Union
+
+from sqlalchemy import event
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows: no memory measures
+    resource = None
+
+# content type of the Prometheus text exposition format (render_prometheus)
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# SQL statement kinds counted apart, any other statement is 'other'
+STATEMENT_KINDS = ("select", "insert", "update", "delete")
+# Prometheus metrics of the stage and SQL totals: (name, type, help, totals key)
+STAGE_METRICS = [
+    ("etl_stage_calls_total", "counter", "Calls of each stage", "calls"),
+    ("etl_stage_errors_total", "counter", "Calls that raised", "errors"),
+    ("etl_stage_seconds_total", "counter", "Wall time of the calls", "seconds"),
+    ("etl_stage_seconds_max", "gauge", "Wall time of the slowest call", "max_seconds"),
+    ("etl_stage_rows_in_total", "counter", "Rows given to the calls", "rows_in"),
+    ("etl_stage_rows_out_total", "counter", "Rows returned by the calls", "rows_out"),
+    (
+        "etl_stage_sql_statements_total",
+        "counter",
+        "SQL statements executed by the calls",
+        "sql_statements",
+    ),
+    (
+        "etl_stage_sql_seconds_total",
+        "counter",
+        "Time of the SQL statements executed by the calls",
+        "sql_seconds",
+    ),
+    (
+        "etl_stage_peak_traced_memory_bytes",
+        "gauge",
+        "Highest memory allocated by a call above the memory at its start (traced by tracemalloc)",
+        "peak_traced_mb",
+    ),
+]
+SQL_METRICS = [
+    ("etl_sql_statements_total", "counter", "SQL statements executed", "count"),
+    ("etl_sql_errors_total", "counter", "SQL statements that failed", "errors"),
+    ("etl_sql_seconds_total", "counter", "Time of the SQL statements", "seconds"),
+    (
+        "etl_sql_seconds_max",
+        "gauge",
+        "Time of the slowest SQL statement",
+        "max_seconds",
+    ),
+]
+# start times of the statements being executed on a connection (connection.info key)
+_QUERY_START_KEY = "metrics_query_start"
+
+# records of the stages running in the current context (innermost last), they get the SQL statements executed meanwhile
+_active_stages = ContextVar("active_stages", default=())
+# tracemalloc peaks of the running stages seen before their nested stages reset it ({id(record): bytes})
+_traced_peaks = {}
+
+
+class Metrics:
+    """Process-wide totals of the instrumentation: per stage (see measure), per SQL statement kind (see
+    instrument_engine) and per API response status, exposed in the Prometheus format by render_prometheus. Every stage
+    record is also passed to the hooks (functions of one argument, e.g. of a RunReport)
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.hooks = []
+        self.reset()
+
+    def reset(self) -> None:
+        """Set every total back to zero"""
+        with self.lock:
+            # {stage: {'calls', 'errors', 'seconds', 'max_seconds', 'rows_in', 'rows_out', 'sql_statements',
+            # 'sql_seconds', 'peak_traced_mb'}}
+            self.stages = {}
+            # {statement kind: {'count', 'errors', 'seconds', 'max_seconds'}}
+            self.sql = {}
+            # {(handler, status): count}
+            self.responses = Counter()
+
+    def record_stage(self, record: dict) -> None:
+        """Add a finished stage record (see measure) to the totals and pass it to the hooks
+
+        :param record: The stage record
+        """
+        with self.lock:
+            totals = self.stages.setdefault(
+                record["stage"],
+                {
+                    "calls": 0,
+                    "errors": 0,
+                    "seconds": 0.0,
+                    "max_seconds": 0.0,
+                    "rows_in": 0,
+                    "rows_out": 0,
+                    "sql_statements": 0,
+                    "sql_seconds": 0.0,
+                    "peak_traced_mb": 0.0,
+                },
+            )
+            totals["calls"] += 1
+            totals["errors"] += record["error"] is not None
+            totals["seconds"] += record["seconds"]
+            totals["max_seconds"] = max(totals["max_seconds"], record["seconds"])
+            totals["rows_in"] += record["rows_in"] or 0
+            totals["rows_out"] += record["rows_out"] or 0
+            totals["sql_statements"] += record["sql_statements"]
+            totals["sql_seconds"] += record["sql_seconds"]
+            totals["peak_traced_mb"] = max(
+                totals["peak_traced_mb"], record["peak_traced_mb"] or 0.0
+            )
+            hooks = list(self.hooks)
+
+        for hook in hooks:
+            hook(record)
+
+    def record_sql(self, kind: str, seconds: float, error: bool = False) -> None:
+        """Add an executed SQL statement to the totals
+
+        :param kind: The statement kind (one of STATEMENT_KINDS or 'other')
+        :param seconds: How long it took
+        :param error: If it failed, defaults to False
+        """
+        with self.lock:
+            totals = self.sql.setdefault(
+                kind, {"count": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0}
+            )
+            totals["count"] += 1
+            totals["errors"] += error
+            totals["seconds"] += seconds
+            totals["max_seconds"] = max(totals["max_seconds"], seconds)
+
+    def record_response(self, handler: str, status: int) -> None:
+        """Count an API response
+
+        :param handler: Name of the endpoint function
+        :param status: The response status code
+        """
+        with self.lock:
+            self.responses[(handler, status)] += 1
+
+    def snapshot(self) -> dict:
+        """Copy of the totals
+
+        :return: Dictionary with 'stages', 'sql' and 'responses' totals
+        """
+        with self.lock:
+            return {
+                "stages": {
+                    stage: dict(totals) for stage, totals in self.stages.items()
+                },
+                "sql": {kind: dict(totals) for kind, totals in self.sql.items()},
+                "responses": dict(self.responses),
+            }
+
+    def render_prometheus(self) -> str:
+        """The totals in the Prometheus text exposition format (PROMETHEUS_CONTENT_TYPE)
+
+        :return: The metrics text
+        """
+        totals = self.snapshot()
+        lines = []
+        for name, kind, help_text, key in STAGE_METRICS:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for stage, stage_totals in sorted(totals["stages"].items()):
+                value = stage_totals[key]
+                if key == "peak_traced_mb":
+                    value *= 1024**2
+                lines.append(f"{name}{_labels(stage=stage)} {value}")
+
+        for name, kind, help_text, key in SQL_METRICS:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for statement, sql_totals in sorted(totals["sql"].items()):
+                lines.append(f"{name}{_labels(statement=statement)} {sql_totals[key]}")
+
+        lines += [
+            "# HELP etl_http_responses_total API responses",
+            "# TYPE etl_http_responses_total counter",
+        ]
+        for (handler, status), count in sorted(totals["responses"].items()):
+            lines.append(
+                f"etl_http_responses_total{_labels(handler=handler, status=status)} {count}"
+            )
+
+        memory = peak_memory_mb()
+        if memory is not None:
+            lines += [
+                "# HELP etl_process_peak_memory_bytes Peak resident memory of the process",
+                "# TYPE etl_process_peak_memory_bytes gauge",
+                f"etl_process_peak_memory_bytes {memory * 1024**2}",
+            ]
+
+        return "\n".join(lines) + "\n"
+
+
+# totals of this process
+METRICS = Metrics()
+
+
+class RunReport:
+    """Collects every stage record between start and stop (e.g. a run.py run), for a structured JSON report. The
+    memory allocations are traced meanwhile (tracemalloc), so every stage has its own peak (see measure)"""
+
+    def __init__(
+        self, metrics: Union[Metrics, None] = None, trace_memory: bool = True
+    ) -> None:
+        """
+        :param metrics: The metrics to collect the stages of, defaults to METRICS
+        :param trace_memory: If memory allocations are traced between start and stop (it slows them down), defaults
+        to True
+        """
+        self.metrics = metrics or METRICS
+        self.trace_memory = trace_memory
+        self.records = []
+        self.started_at = None
+        self.finished_at = None
+        # SQL totals at start, so the report has the statements executed meanwhile only
+        self._sql_at_start = {}
+        # if start began tracing the memory allocations (so stop ends it)
+        self._started_tracing = False
+
+    def start(self) -> "RunReport":
+        self.started_at = time.time()
+        self._sql_at_start = self.metrics.snapshot()["sql"]
+        self.metrics.hooks.append(self.records.append)
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+        return self
+
+    def stop(self) -> None:
+        self.finished_at = time.time()
+        self.metrics.hooks.remove(self.records.append)
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def __enter__(self) -> "RunReport":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def to_dict(self, **details) -> dict:
+        """The report
+
+        :param details: Other items of the report (e.g. the load result)
+        :return: Dictionary with 'started_at', 'finished_at', 'seconds', 'process_peak_memory_mb' (peak resident memory
+        of the process so far), 'stages' (every stage record in start order, 'started_at' as seconds since the start
+        of the run), 'sql' (statements executed during the run per kind) and the details
+        """
+        finished_at = self.finished_at or time.time()
+        stages = [
+            {**record, "started_at": record["started_at"] - self.started_at}
+            for record in sorted(self.records, key=lambda record: record["started_at"])
+        ]
+        sql = {}
+        for kind, totals in self.metrics.snapshot()["sql"].items():
+            at_start = self._sql_at_start.get(kind, {})
+            sql[kind] = {
+                "count": totals["count"] - at_start.get("count", 0),
+                "errors": totals["errors"] - at_start.get("errors", 0),
+                "seconds": totals["seconds"] - at_start.get("seconds", 0.0),
+            }
+
+        return {
+            "started_at": _isoformat(self.started_at),
+            "finished_at": _isoformat(finished_at),
+            "seconds": finished_at - self.started_at,
+            "process_peak_memory_mb": peak_memory_mb(),
+            "stages": stages,
+            "sql": {kind: totals for kind, totals in sql.items() if totals["count"]},
+            **details,
+        }
+
+    def save(self, path: Union[str, Path], **details) -> Path:
+        """Write the report as JSON
+
+        :param path: The file path
+        :param details: Other items of the report (see to_dict)
+        :return: The file path
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.to_dict(**details), indent=2, default=str))
+
+        return path
+
+
+@contextmanager
+def measure(
+    stage: str, rows_in: Union[int, None] = None, metrics: Union[Metrics, None] = None
+) -> Iterator[dict]:
+    """Measure a block as a stage: wall time, memory and the SQL statements it executed (nested stages included). The
+    block can set the 'rows_out' of the yielded record. If tracemalloc is tracing (e.g. during a RunReport), the
+    record has the highest memory allocated during the block above the memory at its start ('peak_traced_mb', python
+    and numpy allocations), and how much more is allocated at its end ('traced_growth_mb'). The tracemalloc peak is
+    reset at the start of every stage, so the peaks are per stage when stages run one at a time (nested ones pass
+    their peak to their parents)
+
+    :param stage: The stage name
+    :param rows_in: Rows given to the block, defaults to None
+    :param metrics: The metrics to record the stage to, defaults to METRICS
+    :yield: The stage record
+    """
+    parents = _active_stages.get()
+    record = {
+        "stage": stage,
+        "parent": parents[-1]["stage"] if parents else None,
+        "started_at": time.time(),
+        "seconds": None,
+        "rows_in": rows_in,
+        "rows_out": None,
+        "peak_traced_mb": None,
+        "traced_growth_mb": None,
+        "sql_statements": 0,
+        "sql_seconds": 0.0,
+        "error": None,
+    }
+    traced_before = _start_traced_peak(parents)
+    token = _active_stages.set(parents + (record,))
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as error:
+        record["error"] = type(error).__name__
+        raise
+    finally:
+        record["seconds"] = time.perf_counter() - start
+        _active_stages.reset(token)
+        peak = _traced_peaks.pop(id(record), 0)
+        if traced_before is not None and tracemalloc.is_tracing():
+            traced, traced_peak = tracemalloc.get_traced_memory()
+            peak = max(peak, traced_peak)
+            for parent in parents:
+                _traced_peaks[id(parent)] = max(_traced_peaks.get(id(parent), 0), peak)
+            record["peak_traced_mb"] = (peak - traced_before) / 1024**2
+            record["traced_growth_mb"] = (traced - traced_before) / 1024**2
+        (metrics or METRICS).record_stage(record)
+
+
+def instrumented(
+    stage: Union[str, None] = None, rows_in: Union[Callable, None] = None
+) -> Callable:
+    """Decorator measuring every call of a function (or coroutine function) as a stage (see measure). Rows in are the
+    rows of its first dataframe argument and rows out the rows of its result (dataframe or list)
+
+    :param stage: The stage name, defaults to the function qualified name (prefixed by its module name for module
+    functions, e.g. 'cleaning_utils.trim_data')
+    :param rows_in: Function of the call arguments returning the rows in, for functions that get their data elsewhere
+    (e.g. from an attribute), defaults to None
+    :return: The decorator
+    """
+
+    def decorator(func):
+        name = stage or func.__qualname__
+        if "." not in name:
+            name = f"{func.__module__.rsplit('.', 1)[-1]}.{name}"
+
+        def count_rows_in(args, kwargs):
+            return rows_in(*args, **kwargs) if rows_in else _rows(args)
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with measure(name, count_rows_in(args, kwargs)) as record:
+                    result = await func(*args, **kwargs)
+                    record["rows_out"] = _rows([result], lists=True)
+                    return result
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with measure(name, count_rows_in(args, kwargs)) as record:
+                result = func(*args, **kwargs)
+                record["rows_out"] = _rows([result], lists=True)
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+def instrument_engine(engine):
+    """Time the SQL statements of an engine (sync or async) with SQLAlchemy cursor events: totals per statement kind
+    (METRICS) and per running stage (see measure)
+
+    :param engine: The engine
+    :return: The same engine
+    """
+    sync_engine = getattr(engine, "sync_engine", engine)
+    if not event.contains(sync_engine, "before_cursor_execute", _before_execute):
+        event.listen(sync_engine, "before_cursor_execute", _before_execute)
+        event.listen(sync_engine, "after_cursor_execute", _after_execute)
+        event.listen(sync_engine, "handle_error", _handle_error)
+
+    return engine
+
+
+def _start_traced_peak(parents: tuple) -> Union[int, None]:
+    """Reset the tracemalloc peak for a stage starting, after passing the peak so far to the stages running
+
+    :param parents: The records of the stages running
+    :return: The memory traced at the start of the stage, None if tracemalloc isn't tracing
+    """
+    if not tracemalloc.is_tracing():
+        return None
+
+    traced, peak = tracemalloc.get_traced_memory()
+    for parent in parents:
+        _traced_peaks[id(parent)] = max(_traced_peaks.get(id(parent), 0), peak)
+    tracemalloc.reset_peak()
+
+    return traced
+
+
+def peak_memory_mb() -> Union[float, None]:
+    """Peak resident memory of the process so far (its high-water mark), None where it can't be read"""
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault(_QUERY_START_KEY, []).append(time.perf_counter())
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    _record_statement(conn, statement)
+
+
+def _handle_error(exception_context):
+    conn = exception_context.connection
+    if conn is not None and conn.info.get(_QUERY_START_KEY):
+        _record_statement(conn, exception_context.statement or "", error=True)
+
+
+def _record_statement(conn, statement: str, error: bool = False) -> None:
+    """Record a statement whose start was pushed by _before_execute (executemany counts as one statement)"""
+    seconds = time.perf_counter() - conn.info[_QUERY_START_KEY].pop()
+    words = statement.split(None, 1)
+    kind = words[0].lower() if words else "other"
+    if kind not in STATEMENT_KINDS:
+        kind = "other"
+
+    METRICS.record_sql(kind, seconds, error)
+    for record in _active_stages.get():
+        record["sql_statements"] += 1
+        record["sql_seconds"] += seconds
+
+
+def _rows(values, lists: bool = False) -> Union[int, None]:
+    """Rows of the first dataframe (or list) in values, None if there's none"""
+    # no dataframe can be given if pandas isn't imported (e.g. the API)
+    pandas = sys.modules.get("pandas")
+    for value in values:
+        if pandas is not None and isinstance(value, pandas.DataFrame):
+            return len(value)
+        if lists and isinstance(value, list):
+            return len(value)
+
+    return None
+
+
+def _labels(**labels) -> str:
+    """Prometheus labels, with their values escaped"""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in labels.values()
+    )
+
+    return (
+        "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+    )
+
+
+def _isoformat(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
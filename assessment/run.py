@@ -1,26 +1,101 @@
+import os
+
 from database.database_handler import PeopleDB
 from datahandling.csv_file_handler import CSVHandler
+from datahandling.pipeline import CleaningPipeline
+from monitoring.metrics import RunReport
 
 if __name__ == "__main__":
+    # time, rows, memory and SQL statements of every stage of the run, saved as json at the end
+    run_report = RunReport().start()
+
+    # set ETL_CHUNKSIZE (rows) to stream the file through cleaning and loading instead of holding it all in memory
+    chunksize = int(os.environ.get("ETL_CHUNKSIZE", 0)) or None
+    # set ETL_WORKERS (processes) to clean the data on several cores
+    workers = int(os.environ.get("ETL_WORKERS", 0)) or None
+
+    # columnar cache format of the raw/cleaned data ('feather', 'parquet' or 'none') and whether json is also written
+    cache_format = os.environ.get("ETL_CACHE_FORMAT", "feather")
+    write_json = os.environ.get("ETL_WRITE_JSON", "1") == "1"
+    # json file with the cleaning steps to run instead of CSVHandler.PIPELINE_STEPS
+    pipeline_config = os.environ.get("ETL_PIPELINE_CONFIG")
+
     # handle csv data
     csv_handler = CSVHandler(
-        "https://profasee-data-engineer-assessment-api.onrender.com/people.csv"
+        "https://profasee-data-engineer-assessment-api.onrender.com/people.csv",
+        cache_format=None if cache_format == "none" else cache_format,
+        write_json=write_json,
+        pipeline=(
+            CleaningPipeline.from_json(pipeline_config) if pipeline_config else None
+        ),
     )
-    # download csv if not already
-    csv_handler.download_files()
-    # load csv data into memory
-    csv_handler.load_dataframe()
-    # uncomment print below to see raw data
-    # print(csv_handler.df.head())
-    # peform certain data cleanning
-    print(csv_handler.clean_data())
-
-    # setup database
-    people_db = PeopleDB()
+    # download csv if not already (or if the server has a newer one)
+    csv_handler.download_files(chunksize=chunksize)
+
+    # setup database: every load also stores the stats with STATS_SNAPSHOT_TOP_X top interests (served by the API)
+    people_db = PeopleDB(snapshot_top_x=int(os.environ.get("STATS_SNAPSHOT_TOP_X", 10)))
     # create database table if if doesn't exist already
     people_db.create()
-    # load the csv cleaned data into the database
-    people_db.save_from_dataframe(csv_handler.df)
+
+    # hash of the csv and the cleaning configuration: if the data in the database came from the same input, there's
+    # nothing to clean nor load
+    input_key = csv_handler.cache_key()
+
+    load_result = None
+    if people_db.is_loaded(input_key, delete_missing=True):
+        print("Data already loaded, nothing to do.")
+        # data loaded before the stats snapshots existed
+        if people_db.stats_snapshot(top_x=people_db.snapshot_top_x) is None:
+            people_db.save_stats_snapshot()
+    elif chunksize:
+        # clean and load chunk by chunk: only new/changed rows are written, rows gone from the csv are deleted
+        load_result = people_db.save_from_chunks(
+            csv_handler.iter_clean_chunks(chunksize, workers=workers),
+            if_exists="upsert",
+            delete_missing=True,
+            input_key=input_key,
+        )
+        print(load_result)
+        # time and rows of every cleaning step
+        print(csv_handler.pipeline.report)
+    else:
+        # reuse the data cleaned from the same input if it's in the columnar cache
+        if csv_handler.cache_format and csv_handler.load_clean_cache() is not None:
+            print("Using cached cleaned data.")
+        else:
+            # load raw data into memory (from the columnar cache if there's one)
+            csv_handler.load_dataframe()
+            # uncomment print below to see raw data
+            # print(csv_handler.df.head())
+            # peform certain data cleanning
+            print(csv_handler.clean_data(workers=workers))
+            print(csv_handler.pipeline.report)
+            # memory of the cleaned data before and after its dtypes were compacted
+            print(csv_handler.memory_report)
+            # keep the cleaned data in the columnar cache as well
+            if csv_handler.cache_format:
+                csv_handler.save_clean_cache()
+
+        # load the csv cleaned data into the database: only new/changed rows are written, rows gone from the csv are
+        # deleted
+        load_result = people_db.save_from_dataframe(
+            csv_handler.df,
+            if_exists="upsert",
+            delete_missing=True,
+            input_key=input_key,
+        )
+        print(load_result)
+
+    # set ETL_RUN_REPORT to write the run report elsewhere than '../data/run_report.json'
+    run_report.stop()
+    report_path = run_report.save(
+        os.environ.get("ETL_RUN_REPORT")
+        or csv_handler.base_path.joinpath("data/run_report.json"),
+        load=load_result,
+        pipeline=csv_handler.pipeline.report,
+        memory=csv_handler.memory_report,
+    )
+    print(f"Run report saved to {report_path}")
 
     # Uncomment lines below to get the stats at startup
     # print("max age ", people_db.max_age())
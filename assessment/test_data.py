@@ -1,11 +1,49 @@
+import tempfile
+import threading
+import tracemalloc
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
 
 import numpy
 import pandas as pd
 from pandas.testing import assert_frame_equal
 
 import datahandling.cleaning_utils as clut
+from benchmarks.synthetic import RAW_COLUMNS, TITLES, write_raw_people_csv
 from datahandling.csv_file_handler import CSVHandler
+from datahandling.pipeline import CleaningPipeline
+from monitoring.metrics import RunReport
+
+
+def raw_people_frame() -> pd.DataFrame:
+    """Small raw people data with the same columns (and kinds of dirt) of people.csv"""
+    return pd.DataFrame(
+        {
+            "Name": [
+                "Dr. John Smith",
+                " mary JANE ",
+                "Mr. Bob Stone",
+                "Sue Doe",
+                "Ann Lee",
+                "Prof. X Y",
+            ],
+            "Age": [30, 25, 61, 44, 19, 70],
+            "City": ["Austin ", "dallas", "AUSTIN", None, "houston", "plano"],
+            "Interest1": [None, None, None, None, None, None],
+            "Interest2": ["Chess", None, "music ", None, "Swimming", None],
+            "Interest3": [None, "Music", None, None, None, None],
+            "Interest4": [None, None, "reading", None, None, "chess"],
+            "PhoneNumber": [
+                "111-222-3333",
+                "(222) 333 4444",
+                "333.444.5555",
+                "444-555-6666",
+                "555.666.7777",
+                "666 777 8888",
+            ],
+        }
+    )
 
 
 class DataTests(unittest.TestCase):
@@ -51,3 +89,415 @@ class DataTests(unittest.TestCase):
         droped_df = clut.drop_null_columns(self.clean_df, 0.7, info_only=False)
 
         assert_frame_equal(droped_df, dropped_interest_1)
+
+
+class CSVRequestHandler(BaseHTTPRequestHandler):
+    """Stand-in for the people.csv server: serves the server 'csv' bytes with an ETag and answers conditional requests"""
+
+    def do_GET(self):
+        etag = f'"{hash(self.server.csv)}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.server.statuses.append(304)
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.server.statuses.append(200)
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(self.server.csv)))
+        self.end_headers()
+        self.wfile.write(self.server.csv)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalDataTests(unittest.TestCase):
+    """Tests that run on a local csv file (raw_people_frame) instead of downloading people.csv"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.base_path = Path(self.tmp_dir.name)
+        self.source = self.base_path.joinpath("source.csv")
+        raw_people_frame().to_csv(self.source, index=False)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def csv_handler(self, name: str, **kwargs) -> CSVHandler:
+        csv_handler = CSVHandler(str(self.source), **kwargs)
+        csv_handler.base_path = self.base_path.joinpath(name)
+        return csv_handler
+
+    def test_streaming_clean_matches_full_clean(self):
+        full_handler = self.csv_handler("full", compact=False)
+        full_handler.download_files()
+        full_handler.load_dataframe()
+        clean_df = full_handler.clean_data()
+
+        streaming_handler = self.csv_handler("streaming")
+        streaming_handler.download_files(chunksize=2)
+        data_files = streaming_handler.base_path.joinpath("data").glob("people.*")
+        self.assertEqual([path.name for path in data_files], ["people.csv"])
+        streamed_df = pd.concat(streaming_handler.iter_clean_chunks(chunksize=2))
+
+        self.assertNotIn("interest1", streamed_df.columns)
+        assert_frame_equal(streamed_df, clean_df)
+
+    def test_parallel_clean_matches_serial(self):
+        csv_handler = self.csv_handler("parallel", compact=False)
+        csv_handler.download_files()
+        csv_handler.load_dataframe()
+        clean_df = csv_handler.clean_data()
+
+        # one row per worker: some partitions have no name with a title
+        csv_handler.load_dataframe()
+        parallel_df = csv_handler.clean_data(workers=6)
+        assert_frame_equal(parallel_df, clean_df)
+        self.assertTrue(
+            pd.util.hash_pandas_object(parallel_df).equals(
+                pd.util.hash_pandas_object(clean_df)
+            )
+        )
+
+        streamed_df = pd.concat(csv_handler.iter_clean_chunks(chunksize=1, workers=3))
+        assert_frame_equal(streamed_df, clean_df)
+
+    def test_pipeline_matches_cleaning_utils(self):
+        # the cleaning steps called one after the other, as clean_data did before the pipeline
+        expected = clut.update_column_types(raw_people_frame(), {"Age": int})
+        expected = clut.rename_columns(
+            expected,
+            {"PhoneNumber": "phone_number"},
+            rules_to_apply=[lambda x: x.lower()],
+        )
+        expected = clut.trim_data(clut.data_to_lower_case(expected))
+        expected = clut.split_titles_from_name(expected)
+        expected = clut.drop_null_columns(
+            expected, null_percentage_threshold=0.8, info_only=False
+        )
+        expected = clut.drop_null_rows(
+            expected,
+            null_count=3,
+            info_only=False,
+            cols_of_interest=["interest2", "interest3", "interest4"],
+        )
+        expected = clut.drop_duplicate_rows(clut.normalize_phone_numbers(expected))
+
+        pipeline = CleaningPipeline(CSVHandler.PIPELINE_STEPS)
+        clean_df = pipeline.run(raw_people_frame())
+        assert_frame_equal(clean_df, expected)
+        self.assertTrue(
+            pd.util.hash_pandas_object(clean_df).equals(
+                pd.util.hash_pandas_object(expected)
+            )
+        )
+        self.assertEqual(
+            [record["step"] for record in pipeline.report],
+            [
+                "drop_null_columns",
+                "cast_types",
+                "rename_columns",
+                "lower_case+trim",
+                "split_titles",
+                "drop_rows_without_any",
+                "normalize_phone_numbers",
+                "drop_duplicates",
+            ],
+        )
+        self.assertEqual(pipeline.report[-1]["rows"], len(expected))
+
+    def test_pipeline_plan(self):
+        df = raw_people_frame()
+        # the steps up to drop_null_columns
+        pipeline = CleaningPipeline(
+            CSVHandler.PIPELINE_STEPS[:6]
+            + [{"step": "select_columns", "columns": ["title", "name", "city"]}]
+        )
+        steps = pipeline.plan(list(df.columns), df.isnull().sum(), len(df))
+
+        # interest1 (all null) and the columns not selected are dropped before anything else, by their raw names;
+        # name stays for the title
+        self.assertEqual(
+            [(step.name, step.params.get("columns")) for step in steps[:2]],
+            [
+                ("drop_columns", ["Interest1"]),
+                (
+                    "drop_columns",
+                    ["Age", "Interest2", "Interest3", "Interest4", "PhoneNumber"],
+                ),
+            ],
+        )
+        self.assertEqual(
+            [step.label for step in steps[2:]],
+            [
+                "cast_types",
+                "rename_columns",
+                "lower_case+trim",
+                "split_titles",
+            ],
+        )
+        self.assertEqual(list(pipeline.run(df).columns), ["title", "name", "city"])
+
+        with self.assertRaises(ValueError):
+            CleaningPipeline([{"step": "uppercase"}])
+
+    def test_normalize_phone_numbers(self):
+        df = pd.DataFrame(
+            {
+                "phone_number": [
+                    "(555) 123 4567",
+                    "1-555-123-4567",
+                    "+1 555.123.4567 x89",
+                    "001.555.123.4567",
+                    "+44 20 7946 0958",
+                    "12345",
+                    "n/a",
+                    None,
+                ]
+            }
+        )
+        expected = [
+            "+15551234567",
+            "+15551234567",
+            "+15551234567x89",
+            "+15551234567",
+            "+442079460958",
+            "12345",
+            None,
+            None,
+        ]
+        self.assertEqual(
+            clut.normalize_phone_numbers(df.copy())["phone_number"].tolist(), expected
+        )
+
+        # the string dtype is kept
+        normalized = clut.normalize_phone_numbers(df.astype("string[pyarrow]"))
+        self.assertEqual(normalized["phone_number"].dtype, "string[pyarrow]")
+        self.assertEqual(
+            normalized["phone_number"]
+            .astype(object)
+            .where(normalized["phone_number"].notna(), None)
+            .tolist(),
+            expected,
+        )
+
+    def test_drop_duplicate_rows(self):
+        df = pd.DataFrame(
+            {
+                "name": ["john smith", "mary jane", "john smith", "john smith", None],
+                "phone_number": ["+1555", "+1666", "+1555", "+1555", "+1555"],
+                "city": ["austin", "dallas", "austin", "plano", "austin"],
+                "interest1": [None, "chess", "music", "reading", None],
+            },
+            index=[10, 11, 12, 13, 14],
+        )
+
+        # rows with a null key can't be identified: they are kept
+        self.assertEqual(list(clut.drop_duplicate_rows(df).index), [10, 11, 13, 14])
+        merged = clut.drop_duplicate_rows(df, merge=True)
+        self.assertEqual(merged.loc[10, "interest1"], "music")
+        self.assertIsNone(merged.loc[14, "interest1"])
+
+        # the same fingerprints whatever the dtypes
+        fingerprints = clut.row_fingerprints(df)
+        compacted = clut.row_fingerprints(
+            clut.compact_dtypes(
+                df, max_unique_ratio=1.0, string_dtype="string[pyarrow]"
+            )
+        )
+        self.assertTrue(fingerprints.equals(compacted))
+
+        # people of former chunks are dropped with the index
+        seen = clut.FingerprintIndex()
+        chunks = [
+            clut.drop_duplicate_rows(df.iloc[start : start + 2], seen=seen)
+            for start in range(0, len(df), 2)
+        ]
+        assert_frame_equal(pd.concat(chunks), clut.drop_duplicate_rows(df))
+        self.assertEqual(len(seen), 3)
+
+    def test_streaming_drop_duplicates(self):
+        # the same people in a second feed, with other phone number formats
+        source = raw_people_frame()
+        second_feed = source.copy()
+        second_feed["PhoneNumber"] = "+1 " + second_feed["PhoneNumber"].str.replace(
+            r"\D", "", regex=True
+        )
+        pd.concat([source, second_feed], ignore_index=True).to_csv(
+            self.source, index=False
+        )
+        csv_handler = self.csv_handler("duplicates", compact=False)
+        csv_handler.download_files(chunksize=2)
+        streamed_df = pd.concat(csv_handler.iter_clean_chunks(chunksize=2, workers=2))
+
+        # a streamed download has no json nor columnar cache to load: the csv is
+        csv_handler.load_dataframe()
+        clean_df = csv_handler.clean_data()
+        assert_frame_equal(streamed_df, clean_df)
+        self.assertEqual(len(clean_df), 5)
+        self.assertEqual(list(clean_df.index), [0, 1, 2, 4, 5])
+
+    def test_compact_data(self):
+        source = pd.concat([raw_people_frame()] * 10, ignore_index=True)
+        source["Name"] += [f" {number}" for number in source.index]
+        source.to_csv(self.source, index=False)
+        csv_handler = self.csv_handler("compact", compact=False)
+        csv_handler.download_files()
+        csv_handler.load_dataframe()
+        clean_df = csv_handler.clean_data().copy()
+
+        memory_report = csv_handler.compact_data()
+        self.assertLess(memory_report["after_mb"], memory_report["before_mb"])
+        self.assertEqual(csv_handler.df["age"].dtype, "int8")
+        self.assertEqual(csv_handler.df["city"].dtype, "category")
+        self.assertEqual(csv_handler.df["title"].dtype, "category")
+        self.assertEqual(csv_handler.df["name"].dtype, "string[pyarrow]")
+        assert_frame_equal(
+            csv_handler.df.astype(object).where(csv_handler.df.notna(), None),
+            clean_df.astype(object).where(clean_df.notna(), None),
+        )
+
+    def test_synthetic_people_csv(self):
+        write_raw_people_csv(self.source, rows=1000, chunk_size=300)
+        csv_handler = self.csv_handler("synthetic")
+        csv_handler.download_files()
+        raw_df = csv_handler.load_dataframe()
+        self.assertEqual(len(raw_df), 1000)
+        self.assertEqual(list(raw_df.columns), RAW_COLUMNS)
+        self.assertTrue(raw_df["Name"].str.contains(r"\. ").any())
+        self.assertTrue(raw_df["City"].str.isupper().any())
+
+        clean_df = csv_handler.clean_data()
+        self.assertNotIn("interest1", clean_df.columns)
+        self.assertLess(len(clean_df), 1000)
+        for column in ["title", "city", "interest2"]:
+            values = clean_df[column].dropna().astype(str)
+            self.assertTrue((values == values.str.lower().str.strip()).all())
+        self.assertEqual(set(clean_df["title"]), set(TITLES) | {"unknown"})
+
+    def test_run_report(self):
+        csv_handler = self.csv_handler("report")
+        with RunReport() as run_report:
+            csv_handler.download_files()
+            raw_df = csv_handler.load_dataframe()
+            clean_df = csv_handler.clean_data()
+
+        report = run_report.to_dict(rows=len(clean_df))
+        self.assertEqual(report["rows"], len(clean_df))
+        stages = {record["stage"]: record for record in report["stages"]}
+        self.assertEqual(
+            [record["stage"] for record in report["stages"] if not record["parent"]],
+            [
+                "CSVHandler.download_files",
+                "CSVHandler.load_dataframe",
+                "CSVHandler.clean_data",
+            ],
+        )
+        self.assertEqual(stages["CSVHandler.clean_data"]["rows_in"], len(raw_df))
+        self.assertEqual(stages["CSVHandler.clean_data"]["rows_out"], len(clean_df))
+        self.assertEqual(
+            stages["cleaning_utils.drop_null_rows"]["rows_out"], len(clean_df)
+        )
+        # every stage has its own peak (and a parent's includes its nested stages')
+        self.assertGreater(stages["CSVHandler.clean_data"]["peak_traced_mb"], 0)
+        self.assertGreaterEqual(
+            stages["CSVHandler.clean_data"]["peak_traced_mb"],
+            stages["cleaning_utils.compact_dtypes"]["peak_traced_mb"],
+        )
+        self.assertLess(
+            stages["CSVHandler.load_dataframe"]["peak_traced_mb"],
+            stages["CSVHandler.clean_data"]["peak_traced_mb"],
+        )
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertEqual(
+            stages["cleaning_utils.compact_dtypes"]["parent"],
+            "CSVHandler.compact_data",
+        )
+
+    def test_normalize_strings_matches_applymap(self):
+        df = raw_people_frame()
+        df["Mixed"] = [" A ", 1, None, numpy.nan, 2.5, "B "]
+        expected = df.applymap(lambda x: x.lower() if isinstance(x, str) else x)
+        expected = expected.applymap(lambda x: x.strip() if isinstance(x, str) else x)
+
+        assert_frame_equal(clut.normalize_strings(df), expected)
+        assert_frame_equal(clut.trim_data(clut.data_to_lower_case(df)), expected)
+
+    def test_columnar_cache_round_trip(self):
+        for cache_format in CSVHandler.CACHE_FORMATS:
+            csv_handler = self.csv_handler(
+                cache_format, cache_format=cache_format, write_json=False
+            )
+            csv_handler.download_files()
+            self.assertFalse(
+                csv_handler.base_path.joinpath("data/people.json").exists()
+            )
+
+            assert_frame_equal(csv_handler.load_dataframe(), pd.read_csv(self.source))
+
+            self.assertIsNone(csv_handler.load_clean_cache())
+            clean_df = csv_handler.clean_data()
+            csv_handler.save_clean_cache()
+            assert_frame_equal(csv_handler.load_clean_cache(), clean_df)
+
+    def test_load_dataframe_without_cache(self):
+        csv_handler = self.csv_handler("no_cache", cache_format=None, write_json=False)
+        with self.assertRaises(FileNotFoundError):
+            csv_handler.load_dataframe()
+
+        csv_handler.download_files()
+        assert_frame_equal(csv_handler.load_dataframe(), pd.read_csv(self.source))
+
+        # a json older than the csv (e.g. left by a former download) isn't loaded
+        csv_handler.write_json = True
+        csv_handler.download_files(force=True)
+        pd.read_csv(self.source).iloc[:2].to_csv(self.source, index=False)
+        csv_handler.write_json = False
+        csv_handler.download_files(force=True)
+        assert_frame_equal(csv_handler.load_dataframe(), pd.read_csv(self.source))
+
+    def test_clean_cache_keyed_by_input(self):
+        csv_handler = self.csv_handler("keyed")
+        csv_handler.download_files()
+        key = csv_handler.cache_key()
+        csv_handler.load_dataframe()
+        csv_handler.clean_data()
+        csv_handler.save_clean_cache()
+
+        # the same input and configuration give the same key
+        self.assertEqual(self.csv_handler("keyed").cache_key(), key)
+
+        csv_handler.PIPELINE_VERSION += 1
+        self.assertNotEqual(csv_handler.cache_key(), key)
+        self.assertIsNone(csv_handler.load_clean_cache())
+
+        raw_people_frame().head(3).to_csv(self.source, index=False)
+        other_handler = self.csv_handler("keyed")
+        other_handler.download_files(force=True)
+        self.assertNotEqual(other_handler.cache_key(), key)
+        self.assertIsNone(other_handler.load_clean_cache())
+
+    def test_conditional_download(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), CSVRequestHandler)
+        server.csv = self.source.read_bytes()
+        server.statuses = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        csv_handler = self.csv_handler("http")
+        csv_handler.url = f"http://127.0.0.1:{server.server_port}/people.csv"
+
+        self.assertTrue(csv_handler.download_files())
+        key = csv_handler.cache_key()
+        # not modified: nothing is downloaded again
+        self.assertFalse(csv_handler.download_files())
+        self.assertEqual(csv_handler.cache_key(), key)
+
+        server.csv = raw_people_frame().head(3).to_csv(index=False).encode()
+        self.assertTrue(csv_handler.download_files())
+        self.assertEqual(len(csv_handler.load_dataframe()), 3)
+        self.assertNotEqual(csv_handler.cache_key(), key)
+        self.assertEqual(server.statuses, [200, 304, 200])
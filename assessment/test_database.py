@@ -0,0 +1,798 @@
+import asyncio
+import csv
+import io
+import json
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+
+import pandas as pd
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import mysql
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.sql import delete
+
+import api.main
+from database.async_database_handler import AsyncPeopleDB
+from database.data_schema import CityCount, PeopleStatsSnapshot
+from database.database_handler import PeopleDB
+from database.db_config import Base, create_db_engine, pool_metrics, session_scope
+from database.people_queries import PEOPLE_COLUMNS, query_full_stats
+from database.stats_cache import StatsCache
+from datahandling.cleaning_utils import compact_dtypes
+from monitoring.metrics import METRICS, instrument_engine
+
+
+class DatabaseTests(unittest.TestCase):
+    def setUp(self):
+        self.people_db = PeopleDB(create_engine("sqlite://"))
+        self.people_db.create()
+
+        self.df = pd.DataFrame(
+            {
+                "title": ["dr", "unknown", "mr", "unknown", "ms"],
+                "name": ["john smith", "mary jane", "bob stone", "sue doe", "ann lee"],
+                "age": [30, 25, 61, 44, 19],
+                "city": ["austin", "dallas", "austin", "houston", None],
+                "interest1": ["swimming", "chess", None, "swimming", "music"],
+                "interest2": ["chess", "swimming", "music", None, None],
+                "interest3": [None, "music", "swimming", None, None],
+                "interest4": ["reading", None, None, None, None],
+                "phone_number": ["111", "222", "333", "444", "555"],
+            }
+        )
+        self.people_db.save_from_dataframe(self.df)
+
+    def test_stats_matches_single_queries(self):
+        stats = self.people_db.stats(top_x=3)
+
+        self.assertEqual(stats["max_age"], self.people_db.max_age())
+        self.assertEqual(stats["min_age"], self.people_db.min_age())
+        self.assertAlmostEqual(stats["avg_age"], self.people_db.avg_age())
+        self.assertEqual(
+            stats["city_with_most_people"], self.people_db.most_frequent_city()
+        )
+        self.assertEqual(stats["top_interests"], ["swimming", "music", "chess"])
+
+    def test_stats_values(self):
+        stats = self.people_db.stats()
+
+        self.assertEqual(stats["max_age"], 61)
+        self.assertEqual(stats["min_age"], 19)
+        self.assertAlmostEqual(stats["avg_age"], self.df["age"].mean())
+        self.assertEqual(stats["city_with_most_people"], "austin")
+
+    def test_top_x_interests(self):
+        self.assertEqual(
+            self.people_db.top_x_interests(x=2, as_dict=True),
+            {"swimming": 4, "music": 3},
+        )
+        self.assertEqual(self.people_db.top_x_interests(), ["swimming"])
+
+    def test_people_with_interest(self):
+        people = self.people_db.people_with_interest("music")
+        self.assertEqual(
+            [person.name for person in people], ["mary jane", "bob stone", "ann lee"]
+        )
+
+    def test_save_replace_keeps_interests_in_sync(self):
+        self.people_db.save_from_dataframe(self.df.iloc[:2])
+
+        self.assertEqual(
+            self.people_db.top_x_interests(x=3, as_dict=True),
+            {"chess": 2, "swimming": 2, "music": 1},
+        )
+
+    def test_upsert_only_writes_changes(self):
+        df = self.df.copy()
+        df.loc[1, "city"] = "austin"
+        df.loc[5] = ["mr", "tom hill", 50, "dallas", "chess", None, None, None, "666"]
+
+        result = self.people_db.save_from_dataframe(
+            df.drop(index=0), if_exists="upsert", delete_missing=True
+        )
+
+        self.assertEqual(
+            (result["inserted"], result["updated"], result["deleted"]), (1, 1, 1)
+        )
+        self.assertEqual(self.people_db.max_age(), 61)
+        self.assertEqual(self.people_db.most_frequent_city(), "austin")
+        self.assertEqual(
+            [person.name for person in self.people_db.people_with_interest("chess")],
+            ["mary jane", "tom hill"],
+        )
+
+    def test_upsert_skips_same_data(self):
+        result = self.people_db.save_from_dataframe(self.df, if_exists="upsert")
+
+        self.assertTrue(result["skipped"])
+        self.assertEqual(self.people_db.last_watermark().mode, "replace")
+
+    def test_aggregates_follow_loads(self):
+        def assert_consistent():
+            self.assertEqual(self.people_db.check_aggregates(), {})
+            with self.people_db.engine.connect() as connection:
+                expected = query_full_stats(connection, top_x=5)
+            stats = self.people_db.stats()
+            self.assertAlmostEqual(stats.pop("avg_age"), expected.pop("avg_age"))
+            self.assertEqual(stats, expected)
+
+        assert_consistent()
+
+        # append a batch of new people
+        batch = self.df.iloc[:2].set_axis([5, 6])
+        batch.loc[5, "age"] = 12
+        self.people_db.save_from_dataframe(batch, if_exists="append")
+        self.assertEqual(self.people_db.stats()["min_age"], 12)
+        assert_consistent()
+
+        # the youngest and the oldest are deleted or updated: min and max are counted again
+        df = pd.concat([self.df, batch]).drop(index=[2, 5])
+        df.loc[3, "city"] = "dallas"
+        result = self.people_db.save_from_dataframe(
+            df, if_exists="upsert", delete_missing=True
+        )
+        self.assertEqual((result["updated"], result["deleted"]), (1, 2))
+        self.assertEqual(self.people_db.stats()["min_age"], 19)
+        self.assertEqual(self.people_db.stats()["max_age"], 44)
+        assert_consistent()
+
+        self.people_db.save_from_dataframe(self.df.iloc[3:], if_exists="replace")
+        assert_consistent()
+
+        # a difference is reported until the aggregates are rebuilt
+        with self.people_db.engine.begin() as connection:
+            connection.execute(delete(CityCount))
+        self.assertIn("city_counts", self.people_db.check_aggregates())
+        self.people_db.rebuild_aggregates()
+        assert_consistent()
+
+    def test_stats_snapshot(self):
+        self.assertEqual(
+            self.people_db.stats_snapshot(top_x=3), self.people_db.stats(top_x=3)
+        )
+        self.assertIsNone(self.people_db.stats_snapshot(top_x=11))
+
+        first_load = self.people_db.load_generation()
+        self.people_db.save_from_dataframe(self.df.iloc[:2])
+        self.assertEqual(self.people_db.stats_snapshot()["max_age"], 30)
+        self.assertEqual(
+            self.people_db.stats_snapshot(load_id=first_load)["max_age"], 61
+        )
+
+        history = self.people_db.stats_history()
+        self.assertEqual(
+            [stats["load_id"] for stats in history], [first_load + 1, first_load]
+        )
+        self.assertEqual(
+            history[0]["top_interests"], self.people_db.stats(top_x=10)["top_interests"]
+        )
+
+        # a load without snapshot (e.g. from before snapshots existed) gets one
+        with self.people_db.engine.begin() as connection:
+            connection.execute(delete(PeopleStatsSnapshot))
+        self.assertIsNone(self.people_db.stats_snapshot())
+        self.people_db.save_stats_snapshot()
+        self.assertEqual(self.people_db.stats_snapshot(), self.people_db.stats())
+
+    def test_save_compact_dtypes(self):
+        compact_df = compact_dtypes(
+            self.df, max_unique_ratio=0.8, string_dtype="string[pyarrow]"
+        )
+        self.assertEqual(compact_df["age"].dtype, "int8")
+        self.assertEqual(compact_df["title"].dtype, "category")
+
+        # same rows as the object data already saved, so nothing is written
+        result = self.people_db.save_from_dataframe(compact_df, if_exists="upsert")
+        self.assertTrue(result["skipped"])
+
+        self.people_db.save_from_dataframe(compact_df.iloc[1:])
+        self.assertEqual(self.people_db.min_age(), 19)
+        self.assertEqual(
+            self.people_db.top_x_interests(x=2, as_dict=True),
+            {"swimming": 3, "music": 3},
+        )
+        self.assertEqual(self.people_db.stats()["city_with_most_people"], "austin")
+
+    def test_is_loaded(self):
+        self.assertFalse(self.people_db.is_loaded("key"))
+
+        # same data, but a new input key is recorded instead of skipping the load
+        result = self.people_db.save_from_dataframe(
+            self.df, if_exists="upsert", input_key="key"
+        )
+        self.assertFalse(result["inserted"] or result["updated"] or result["deleted"])
+        self.assertTrue(self.people_db.is_loaded("key"))
+        self.assertFalse(self.people_db.is_loaded("other key"))
+
+        self.people_db.save_from_dataframe(self.df.iloc[1:], if_exists="replace")
+        self.assertFalse(self.people_db.is_loaded("key"))
+
+        # the stored data is the input's until another load, and has all of it only after a replace or a
+        # delete_missing upsert
+        self.people_db.save_from_dataframe(self.df, input_key="key")
+        self.assertTrue(self.people_db.is_loaded("key", delete_missing=True))
+        self.people_db.save_from_dataframe(
+            self.df.iloc[[0]].rename(index={0: 7}), if_exists="append"
+        )
+        self.assertFalse(self.people_db.is_loaded("key"))
+        self.people_db.save_from_dataframe(self.df, if_exists="upsert", input_key="key")
+        self.assertTrue(self.people_db.is_loaded("key"))
+        self.assertFalse(self.people_db.is_loaded("key", delete_missing=True))
+
+    def test_upsert_after_append_is_not_skipped(self):
+        self.people_db.save_from_dataframe(
+            self.df.iloc[[0]].rename(index={0: 7}), if_exists="append"
+        )
+        result = self.people_db.save_from_dataframe(
+            self.df, if_exists="upsert", delete_missing=True
+        )
+        self.assertEqual((result["skipped"], result["deleted"]), (False, 1))
+
+        # a plain upsert leaves rows appended since, so the next delete_missing upsert still deletes them
+        self.people_db.save_from_dataframe(
+            self.df.iloc[[0]].rename(index={0: 7}), if_exists="append"
+        )
+        self.people_db.save_from_dataframe(self.df, if_exists="upsert")
+        result = self.people_db.save_from_dataframe(
+            self.df, if_exists="upsert", delete_missing=True
+        )
+        self.assertEqual((result["skipped"], result["deleted"]), (False, 1))
+        self.assertTrue(
+            self.people_db.save_from_dataframe(
+                self.df, if_exists="upsert", delete_missing=True
+            )["skipped"]
+        )
+        self.assertEqual(
+            [row.id for batch in self.people_db.iter_people_batches() for row in batch],
+            list(self.df.index),
+        )
+
+    def test_save_from_chunks_matches_single_dataframe(self):
+        chunks = [self.df.iloc[:2], self.df.iloc[2:4], self.df.iloc[4:]]
+        result = self.people_db.save_from_chunks(
+            chunks, if_exists="upsert", delete_missing=True
+        )
+
+        self.assertTrue(result["skipped"])
+        self.assertEqual(
+            self.people_db.last_watermark().source_hash,
+            self.people_db.last_watermark(full_loads_only=True).source_hash,
+        )
+        self.people_db.save_from_chunks(chunks[1:], if_exists="replace")
+        self.assertEqual(self.people_db.max_age(), 61)
+        self.assertEqual(self.people_db.min_age(), 19)
+        self.assertEqual(
+            self.people_db.top_x_interests(x=2, as_dict=True),
+            {"music": 2, "swimming": 2},
+        )
+
+    def test_deduplicate_loads(self):
+        # another feed: the same people under other ids (one of them twice) and a new one, loaded by chunks
+        feed = pd.concat(
+            [self.df.iloc[[0, 2, 2]], self.df.iloc[[1]].assign(city="plano")]
+        )
+        feed.index = [10, 11, 12, 13]
+        result = self.people_db.save_from_chunks(
+            [feed.iloc[:2], feed.iloc[2:]], if_exists="append", deduplicate=True
+        )
+        self.assertEqual((result["inserted"], result["duplicates"]), (1, 3))
+
+        def stored_ids():
+            return [
+                row.id
+                for batch in self.people_db.iter_people_batches()
+                for row in batch
+            ]
+
+        self.assertEqual(stored_ids(), [0, 1, 2, 3, 4, 13])
+        self.assertFalse(self.people_db.check_aggregates())
+
+        # stored rows loaded again under their own id aren't duplicates
+        result = self.people_db.save_from_dataframe(
+            pd.concat([self.df, feed]),
+            if_exists="upsert",
+            delete_missing=True,
+            deduplicate=True,
+        )
+        self.assertEqual(result["duplicates"], 3)
+        self.assertEqual(stored_ids(), [0, 1, 2, 3, 4, 13])
+
+        self.people_db.save_from_dataframe(feed, if_exists="replace")
+        self.assertEqual(stored_ids(), [10, 11, 12, 13])
+
+    def test_deduplicate_keeps_rekeyed_people(self):
+        # john stored as 0 is loaded as 100: id 0 is deleted as missing, so 100 isn't a duplicate
+        result = self.people_db.save_from_dataframe(
+            self.df.rename(index={0: 100}),
+            if_exists="upsert",
+            delete_missing=True,
+            deduplicate=True,
+        )
+        self.assertEqual(
+            (result["inserted"], result["deleted"], result["duplicates"]), (1, 1, 0)
+        )
+        self.assertEqual(
+            [person.id for person in self.people_db.people_with_interest("reading")],
+            [100],
+        )
+
+        # both ids in the feed: the first one loaded is kept, the other one is deleted
+        result = self.people_db.save_from_chunks(
+            [
+                self.df.iloc[[0]],
+                pd.concat([self.df.iloc[1:], self.df.iloc[[0]].rename(index={0: 100})]),
+            ],
+            if_exists="upsert",
+            delete_missing=True,
+            deduplicate=True,
+        )
+        self.assertEqual(result["duplicates"], 1)
+        self.assertEqual(
+            [person.id for person in self.people_db.people_with_interest("reading")],
+            [0],
+        )
+        self.assertFalse(self.people_db.check_aggregates())
+
+    def test_grouped_stats(self):
+        stats = self.people_db.grouped_stats("city", top_x=2)
+        self.assertEqual(
+            [row["group"] for row in stats], [None, "austin", "dallas", "houston"]
+        )
+        austin = stats[1]
+        self.assertEqual(
+            (austin["person_count"], austin["min_age"], austin["max_age"]), (2, 30, 61)
+        )
+        self.assertAlmostEqual(austin["avg_age"], 45.5)
+        self.assertEqual(austin["top_interests"], ["swimming", "chess"])
+
+        # age histogram of a city, and the cities of a title
+        self.assertEqual(
+            [
+                (row["group"], row["person_count"])
+                for row in self.people_db.grouped_stats("age_bucket", city="austin")
+            ],
+            [(30, 1), (60, 1)],
+        )
+        self.assertEqual(
+            [
+                row["group"]
+                for row in self.people_db.grouped_stats("city", title="unknown")
+            ],
+            ["dallas", "houston"],
+        )
+
+        # the cells follow the loads
+        df = self.df.copy()
+        df.loc[2, "age"] = 35
+        self.people_db.save_from_dataframe(
+            df.drop(index=0), if_exists="upsert", delete_missing=True
+        )
+        self.assertFalse(self.people_db.check_aggregates())
+        austin = self.people_db.grouped_stats("city", city="austin")[0]
+        self.assertEqual(
+            (austin["person_count"], austin["min_age"], austin["max_age"]), (1, 35, 35)
+        )
+
+        with self.assertRaises(ValueError):
+            self.people_db.grouped_stats("name")
+
+    def test_grouped_stats_after_ageless_load(self):
+        # the stored cells have no min_age nor max_age yet
+        self.people_db.save_from_dataframe(self.df.assign(age=None))
+        self.people_db.save_from_dataframe(
+            self.df.iloc[[0, 2]].rename(index={0: 10, 2: 12}), if_exists="append"
+        )
+        self.assertFalse(self.people_db.check_aggregates())
+        austin = self.people_db.grouped_stats("city", city="austin")[0]
+        self.assertEqual(
+            (austin["person_count"], austin["min_age"], austin["max_age"]), (4, 30, 61)
+        )
+
+    def test_iter_people_batches(self):
+        batches = list(self.people_db.iter_people_batches(batch_size=2))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual(
+            [row.name for batch in batches for row in batch], self.df["name"].tolist()
+        )
+
+        def people(**filters):
+            return [
+                row
+                for batch in self.people_db.iter_people_batches(**filters)
+                for row in batch
+            ]
+
+        def names(**filters):
+            return [row.name for row in people(**filters)]
+
+        self.assertEqual(names(city="austin"), ["john smith", "bob stone"])
+        self.assertEqual(
+            names(min_age=25, max_age=44), ["john smith", "mary jane", "sue doe"]
+        )
+        self.assertEqual(names(title="unknown"), ["mary jane", "sue doe"])
+        self.assertEqual(names(interest="music"), ["mary jane", "bob stone", "ann lee"])
+        self.assertEqual(names(interest="music", city="austin"), ["bob stone"])
+
+        # keyset pages: each page starts after the last id of the former one
+        pages = [people(limit=2)]
+        while pages[-1]:
+            pages.append(people(after_id=pages[-1][-1].id, limit=2))
+        self.assertEqual([len(page) for page in pages], [2, 2, 1, 0])
+        self.assertEqual(sum(pages, []), people())
+
+
+class StatsCacheTests(unittest.TestCase):
+    def setUp(self):
+        # a single connection, so every thread sees the same in-memory database
+        self.people_db = PeopleDB(
+            create_engine(
+                "sqlite://",
+                connect_args={"check_same_thread": False},
+                poolclass=StaticPool,
+            )
+        )
+        self.people_db.create()
+        self.df = pd.DataFrame(
+            {
+                "title": ["dr", "unknown", "mr"],
+                "name": ["john smith", "mary jane", "bob stone"],
+                "age": [30, 25, 61],
+                "city": ["austin", "dallas", "austin"],
+                "interest1": ["swimming", "chess", None],
+                "interest2": ["chess", None, "music"],
+                "interest3": [None, None, None],
+                "interest4": [None, None, None],
+                "phone_number": ["111", "222", "333"],
+            }
+        )
+        self.people_db.save_from_dataframe(self.df)
+
+        self.now = 0.0
+        self.stats_cache = StatsCache(self.people_db, ttl=10, clock=lambda: self.now)
+
+    def test_ttl_and_load_generation(self):
+        stats, generation = self.stats_cache.get()
+        self.assertEqual(stats, self.people_db.stats(top_x=5))
+        self.assertEqual(generation, self.people_db.load_generation())
+        self.now = 5
+        self.stats_cache.get()
+        self.assertEqual(self.stats_cache.counters["misses"], 1)
+        self.assertEqual(self.stats_cache.counters["hits"], 1)
+
+        # expired, but there was no load since: revalidated without querying the stats
+        self.now = 15
+        self.assertEqual(self.stats_cache.get(), (stats, generation))
+        self.assertEqual(self.stats_cache.counters["misses"], 1)
+        self.assertEqual(self.stats_cache.counters["revalidations"], 2)
+
+        # a load from another process changes the load generation
+        other_db = PeopleDB(self.people_db.engine)
+        other_db.save_from_dataframe(self.df.iloc[:2])
+        self.assertEqual(self.stats_cache.get(), (stats, generation))
+        self.now = 30
+        stats, generation = self.stats_cache.get()
+        self.assertEqual(stats["max_age"], 30)
+        self.assertEqual(self.stats_cache.counters["misses"], 2)
+
+        # a load through the same PeopleDB invalidates the stats right away
+        self.people_db.save_from_dataframe(self.df)
+        self.assertEqual(self.stats_cache.get()[0]["max_age"], 61)
+        self.assertEqual(self.stats_cache.info()["misses"], 3)
+
+    def test_stats_from_snapshot(self):
+        stats_cache = StatsCache(self.people_db, ttl=0, use_snapshot=True)
+        self.assertEqual(stats_cache.get()[0], self.people_db.stats(top_x=5))
+        self.assertEqual(stats_cache.info()["snapshots"], 1)
+
+        with self.people_db.engine.begin() as connection:
+            connection.execute(delete(PeopleStatsSnapshot))
+        stats_cache.invalidate()
+        self.assertEqual(stats_cache.get()[0], self.people_db.stats(top_x=5))
+        self.assertEqual(stats_cache.info()["misses"], 2)
+        self.assertEqual(stats_cache.info()["snapshots"], 1)
+
+        stats_cache = StatsCache(self.people_db, use_snapshot=True, live_fallback=False)
+        with self.assertRaises(LookupError):
+            stats_cache.get()
+
+    def test_single_flight(self):
+        stats_calls = []
+        stats = self.people_db.stats
+
+        def slow_stats(top_x):
+            stats_calls.append(top_x)
+            time.sleep(0.2)
+            return stats(top_x)
+
+        self.people_db.stats = slow_stats
+        threads = [threading.Thread(target=self.stats_cache.get) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(stats_calls), 1)
+        self.assertEqual(self.stats_cache.counters["hits"], 7)
+
+    def test_people_stats_etag(self):
+        self.addCleanup(setattr, api.main, "stats_cache", api.main.stats_cache)
+        api.main.stats_cache = self.stats_cache
+        client = TestClient(api.main.app)
+
+        response = client.get("/people_stats")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["max_age"], 61)
+        self.assertEqual(response.headers["Cache-Control"], "max-age=10")
+
+        etag = response.headers["ETag"]
+        response = client.get("/people_stats", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.people_db.save_from_dataframe(self.df.iloc[:2])
+        response = client.get("/people_stats", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        self.assertEqual(client.get("/people_stats/cache").json()["misses"], 2)
+
+    def test_metrics(self):
+        self.addCleanup(setattr, api.main, "stats_cache", api.main.stats_cache)
+        api.main.stats_cache = self.stats_cache
+        instrument_engine(self.people_db.engine)
+        METRICS.reset()
+        client = TestClient(api.main.app)
+
+        self.assertEqual(client.get("/people_stats").status_code, 200)
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("text/plain", response.headers["Content-Type"])
+        lines = response.text.splitlines()
+        self.assertIn('etl_stage_calls_total{stage="api.people_stats"} 1', lines)
+        self.assertIn('etl_stage_calls_total{stage="PeopleQueries.stats"} 1', lines)
+        self.assertIn(
+            'etl_http_responses_total{handler="people_stats",status="200"} 1', lines
+        )
+
+        totals = METRICS.snapshot()
+        stats_sql = totals["stages"]["PeopleQueries.stats"]["sql_statements"]
+        self.assertGreater(stats_sql, 0)
+        self.assertGreaterEqual(
+            totals["stages"]["api.people_stats"]["sql_statements"], stats_sql
+        )
+        self.assertGreaterEqual(totals["sql"]["select"]["count"], stats_sql)
+
+    def test_people_export(self):
+        self.addCleanup(setattr, api.main, "people_db", api.main.people_db)
+        api.main.people_db = self.people_db
+        client = TestClient(api.main.app)
+
+        response = client.get("/people", params={"city": " Austin "})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Type"], "application/x-ndjson")
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        self.assertEqual([row["name"] for row in rows], ["john smith", "bob stone"])
+        self.assertEqual(rows[0]["interest2"], "chess")
+
+        response = client.get(
+            "/people", params={"format": "csv", "after_id": rows[0]["id"], "limit": 1}
+        )
+        self.assertTrue(response.headers["Content-Type"].startswith("text/csv"))
+        lines = list(csv.reader(io.StringIO(response.text)))
+        self.assertEqual(lines[0], PEOPLE_COLUMNS)
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[1][PEOPLE_COLUMNS.index("name")], "mary jane")
+
+        self.assertEqual(
+            client.get("/people", params={"format": "xml"}).status_code, 422
+        )
+
+    def test_people_stats_history(self):
+        self.addCleanup(setattr, api.main, "people_db", api.main.people_db)
+        api.main.people_db = self.people_db
+        client = TestClient(api.main.app)
+
+        response = client.get("/people_stats/history", params={"limit": 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [stats["load_id"] for stats in response.json()],
+            [self.people_db.load_generation()],
+        )
+
+    def test_db_pool(self):
+        self.addCleanup(setattr, api.main, "people_db", api.main.people_db)
+        api.main.people_db = self.people_db
+        client = TestClient(api.main.app)
+
+        # the pool of the people_db engine only (a static pool has no size)
+        response = client.get("/db_pool")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.json()), ["sync"])
+        self.assertIsNone(response.json()["sync"]["size"])
+
+    def test_api_imports_without_pandas(self):
+        # a fresh interpreter: this one has imported pandas already
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import json, sys, api.main; print(json.dumps(list(sys.modules)))",
+            ],
+            capture_output=True,
+            check=True,
+            cwd=Path(__file__).parent,
+            text=True,
+        )
+        modules = json.loads(result.stdout)
+        for heavy in ("pandas", "numpy", "pyarrow", "database.database_handler"):
+            self.assertNotIn(heavy, modules)
+
+    def test_people_stats_grouped(self):
+        self.addCleanup(setattr, api.main, "people_db", api.main.people_db)
+        api.main.people_db = self.people_db
+        client = TestClient(api.main.app)
+
+        response = client.get(
+            "/people_stats/grouped", params={"by": "age_bucket", "city": " Austin "}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(),
+            [
+                {
+                    "group": 30,
+                    "person_count": 1,
+                    "max_age": 30,
+                    "min_age": 30,
+                    "avg_age": 30.0,
+                    "top_interests": ["chess", "swimming"],
+                },
+                {
+                    "group": 60,
+                    "person_count": 1,
+                    "max_age": 61,
+                    "min_age": 61,
+                    "avg_age": 61.0,
+                    "top_interests": ["music"],
+                },
+            ],
+        )
+        self.assertEqual(
+            client.get("/people_stats/grouped", params={"by": "name"}).status_code, 422
+        )
+
+    def test_async_people_db(self):
+        # aiosqlite needs a database file: every connection has its own in-memory database
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        db_path = Path(tmp_dir.name).joinpath("people.db")
+        people_db = PeopleDB(create_engine(f"sqlite:///{db_path}"))
+        people_db.create()
+        people_db.save_from_dataframe(self.df)
+        async_db = AsyncPeopleDB(create_async_engine(f"sqlite+aiosqlite:///{db_path}"))
+        stats_cache = StatsCache(async_db, ttl=10)
+
+        async def get_stats():
+            try:
+                results = await asyncio.gather(*(stats_cache.aget() for _ in range(5)))
+                self.assertEqual(await async_db.stats_snapshot(), results[0][0])
+                batches = [
+                    batch
+                    async for batch in async_db.iter_people_batches(
+                        batch_size=2, city="austin"
+                    )
+                ]
+                self.assertEqual(
+                    [[row.name for row in batch] for batch in batches],
+                    [["john smith", "bob stone"]],
+                )
+                self.assertEqual(
+                    await async_db.grouped_stats("title"),
+                    people_db.grouped_stats("title"),
+                )
+                self.assertEqual(
+                    await async_db.stats_history(), people_db.stats_history()
+                )
+                return results, await async_db.load_generation()
+            finally:
+                await async_db.dispose()
+
+        results, generation = asyncio.run(get_stats())
+        self.assertEqual(results[0], (self.people_db.stats(top_x=5), generation))
+        self.assertEqual(stats_cache.info()["misses"], 1)
+        self.assertEqual(stats_cache.info()["hits"], 4)
+
+
+class DBConfigTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.db_url = f"sqlite:///{Path(self.tmp_dir.name).joinpath('people.db')}"
+
+    def test_mysql_schema_matches_models(self):
+        # the MySQL container creates the tables from person.sql: create() doesn't add the columns it lacks (nor
+        # changes their collation)
+        schema = (
+            Path(__file__)
+            .parent.parent.joinpath("mysql-schemas/person.sql")
+            .read_text()
+        )
+        tables = {
+            name: (
+                {
+                    column: (
+                        "NOT NULL" not in definition,
+                        "COLLATE utf8mb4_bin" in definition,
+                    )
+                    for column, definition in re.findall(
+                        r"^  `(\w+)` (.*)$", body, re.M
+                    )
+                },
+                set(re.findall(r"^  KEY `(\w+)`", body, re.M)),
+            )
+            for name, body in re.findall(
+                r"CREATE TABLE `(\w+)` \((.*?)\n\)", schema, re.S
+            )
+        }
+
+        self.assertEqual(
+            tables,
+            {
+                table.name: (
+                    {
+                        column.name: (
+                            column.nullable,
+                            getattr(
+                                column.type.dialect_impl(mysql.dialect()),
+                                "collation",
+                                None,
+                            )
+                            == "utf8mb4_bin",
+                        )
+                        for column in table.columns
+                    },
+                    {index.name for index in table.indexes},
+                )
+                for table in Base.metadata.sorted_tables
+            },
+        )
+
+    def test_pool_metrics(self):
+        engine = create_db_engine(self.db_url, pool_size=1, max_overflow=0)
+        self.addCleanup(engine.dispose)
+        self.assertEqual(pool_metrics(engine)["checked_out"], 0)
+
+        connection = engine.connect()
+        self.assertEqual(pool_metrics(engine)["checked_out"], 1)
+        # a second checkout waits until the connection is returned to the pool
+        threading.Timer(0.2, connection.close).start()
+        with engine.connect():
+            metrics = pool_metrics(engine)
+
+        self.assertEqual(metrics["size"], 1)
+        self.assertEqual(metrics["checked_out"], 1)
+        self.assertEqual(metrics["checkouts"], 2)
+        self.assertGreaterEqual(metrics["max_wait_seconds"], 0.1)
+
+    def test_session_scope(self):
+        engine = create_db_engine(self.db_url)
+        self.addCleanup(engine.dispose)
+        people_db = PeopleDB(engine)
+        people_db.create()
+
+        with session_scope(engine) as session:
+            with session_scope(engine) as inner_session:
+                self.assertIs(inner_session, session)
+            people_db.last_watermark()
+            # the PeopleDB query used (and left open) the connection of the request session
+            self.assertEqual(pool_metrics(engine)["checked_out"], 1)
+
+        self.assertEqual(pool_metrics(engine)["checked_out"], 0)
+        with session_scope(engine) as other_session:
+            self.assertIsNot(other_session, session)
@@ -1,16 +1,122 @@
 -- datatestdb.person definition
+DROP TABLE IF exists interest_rollup;
+DROP TABLE IF exists people_rollup;
+DROP TABLE IF exists interest_count;
+DROP TABLE IF exists city_count;
+DROP TABLE IF exists people_aggregate;
+DROP TABLE IF exists people_stats_snapshot;
+DROP TABLE IF exists load_watermark;
+DROP TABLE IF exists person_interest;
 DROP TABLE IF exists person;
 
 CREATE TABLE `person` (
   `id` int NOT NULL AUTO_INCREMENT,
-  `title` varchar(10) DEFAULT NULL,
+  `title` varchar(10) COLLATE utf8mb4_bin DEFAULT NULL,
   `name` varchar(100) DEFAULT NULL,
   `age` int DEFAULT NULL,
-  `city` varchar(100) DEFAULT NULL,
+  `city` varchar(100) COLLATE utf8mb4_bin DEFAULT NULL,
   `interest1` varchar(100) DEFAULT NULL,
   `interest2` varchar(100) DEFAULT NULL,
   `interest3` varchar(100) DEFAULT NULL,
   `interest4` varchar(100) DEFAULT NULL,
   `phone_number` varchar(50) DEFAULT NULL,
+  `row_hash` bigint DEFAULT NULL,
+  `fingerprint` bigint DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  KEY `ix_person_age` (`age`),
+  KEY `ix_person_city` (`city`),
+  KEY `ix_person_fingerprint` (`fingerprint`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- datatestdb.person_interest definition (interest1 to interest4 normalized, one row per non-null interest)
+CREATE TABLE `person_interest` (
+  `person_id` int NOT NULL,
+  `position` int NOT NULL,
+  `interest` varchar(100) COLLATE utf8mb4_bin NOT NULL,
+  PRIMARY KEY (`person_id`,`position`),
+  KEY `ix_person_interest_interest` (`interest`),
+  CONSTRAINT `person_interest_ibfk_1` FOREIGN KEY (`person_id`) REFERENCES `person` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- datatestdb.load_watermark definition (one row per load into person)
+CREATE TABLE `load_watermark` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `mode` varchar(10) NOT NULL,
+  `source_hash` varchar(64) NOT NULL,
+  `input_key` varchar(64) DEFAULT NULL,
+  `delete_missing` tinyint(1) NOT NULL DEFAULT 0,
+  `row_count` int NOT NULL,
+  `inserted` int NOT NULL,
+  `updated` int NOT NULL,
+  `deleted` int NOT NULL,
+  `loaded_at` datetime NOT NULL,
   PRIMARY KEY (`id`)
-) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
\ No newline at end of file
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- datatestdb.people_aggregate definition (running aggregates of person, a single row updated by every load)
+CREATE TABLE `people_aggregate` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `person_count` int NOT NULL,
+  `age_count` int NOT NULL,
+  `age_sum` bigint NOT NULL,
+  `min_age` int DEFAULT NULL,
+  `max_age` int DEFAULT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- datatestdb.city_count definition (running count of people per city)
+CREATE TABLE `city_count` (
+  `city` varchar(100) COLLATE utf8mb4_bin NOT NULL,
+  `person_count` int NOT NULL,
+  PRIMARY KEY (`city`),
+  KEY `ix_city_count_person_count` (`person_count`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- datatestdb.interest_count definition (running count of person_interest rows per interest)
+CREATE TABLE `interest_count` (
+  `interest` varchar(100) COLLATE utf8mb4_bin NOT NULL,
+  `quantity` int NOT NULL,
+  PRIMARY KEY (`interest`),
+  KEY `ix_interest_count_quantity` (`quantity`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- datatestdb.people_rollup definition (running aggregates of person per city, title and age bucket)
+CREATE TABLE `people_rollup` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `city` varchar(100) COLLATE utf8mb4_bin DEFAULT NULL,
+  `title` varchar(10) COLLATE utf8mb4_bin DEFAULT NULL,
+  `age_bucket` int DEFAULT NULL,
+  `person_count` int NOT NULL,
+  `age_count` int NOT NULL,
+  `age_sum` bigint NOT NULL,
+  `min_age` int DEFAULT NULL,
+  `max_age` int DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  KEY `ix_people_rollup_cell` (`city`,`title`,`age_bucket`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- datatestdb.interest_rollup definition (running count of person_interest rows per interest and people_rollup cell)
+CREATE TABLE `interest_rollup` (
+  `id` int NOT NULL AUTO_INCREMENT,
+  `city` varchar(100) COLLATE utf8mb4_bin DEFAULT NULL,
+  `title` varchar(10) COLLATE utf8mb4_bin DEFAULT NULL,
+  `age_bucket` int DEFAULT NULL,
+  `interest` varchar(100) COLLATE utf8mb4_bin NOT NULL,
+  `quantity` int NOT NULL,
+  PRIMARY KEY (`id`),
+  KEY `ix_interest_rollup_cell` (`city`,`title`,`age_bucket`,`interest`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- datatestdb.people_stats_snapshot definition (people stats computed at the end of each load)
+CREATE TABLE `people_stats_snapshot` (
+  `load_id` int NOT NULL,
+  `max_age` int DEFAULT NULL,
+  `min_age` int DEFAULT NULL,
+  `avg_age` double DEFAULT NULL,
+  `city_with_most_people` varchar(100) DEFAULT NULL,
+  `top_interests` text NOT NULL,
+  `top_x` int NOT NULL,
+  `created_at` datetime NOT NULL,
+  PRIMARY KEY (`load_id`),
+  CONSTRAINT `people_stats_snapshot_ibfk_1` FOREIGN KEY (`load_id`) REFERENCES `load_watermark` (`id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;